@@ -1,6 +1,17 @@
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        if settings.PRELOAD_MODELS:
+            from utils.model_registry import registry
+
+            # Грузим модели в фоне, чтобы не блокировать старт процесса;
+            # первый запрос дождётся загрузки на блокировке реестра.
+            threading.Thread(target=registry.warm_up, name='model-warm-up', daemon=True).start()
@@ -0,0 +1,51 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from utils.completion_cache import completion_cache
+from utils.gigachat_auth import default_token_provider
+from utils.tz_critic_agent2 import TzPipeline, call_gigachat
+
+DEFAULT_INPUT = (
+    "Сервис бронирования переговорных комнат для сотрудников офиса. Сотрудник выбирает комнату и время, "
+    "администратор управляет списком комнат, бронирования синхронизируются с корпоративным календарём."
+)
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает задержку двухпроходного и однопроходного режимов агента раздела'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--agent', default='description', help='Ключ агента: description, goals, users, requirements')
+        parser.add_argument('--input', default=DEFAULT_INPUT, help='Пользовательский ввод')
+        parser.add_argument('--runs', type=int, default=3, help='Число прогонов каждого режима')
+
+    def handle(self, *args, **options):
+        agent_key = options['agent']
+        token = default_token_provider().get_token()
+
+        # Кэш ответов отключён: сравниваются реальные запросы к GigaChat
+        completion_cache.enabled = False
+        two_pass = TzPipeline(llm_callable=call_gigachat, single_pass_agents=[])
+        single_pass = TzPipeline(llm_callable=call_gigachat, single_pass_agents=[agent_key])
+
+        # Прогрев: эмбеддинги и индекс рекомендаций не должны попасть в замер
+        two_pass.critic.retrieve(options['input'])
+        single_pass.critic.retrieve(options['input'])
+
+        for name, pipeline in (('two-pass', two_pass), ('single-pass', single_pass)):
+            timings = []
+            lengths = []
+            for _ in range(options['runs']):
+                started = time.perf_counter()
+                # Вызываем _run_agent напрямую, минуя объединение одинаковых запросов
+                text, _ = pipeline._run_agent(agent_key, "", options['input'], token)
+                timings.append(time.perf_counter() - started)
+                lengths.append(len(text))
+            self.stdout.write(
+                f'{name:<12} runs={len(timings)} '
+                f'mean={statistics.mean(timings):.2f}s median={statistics.median(timings):.2f}s '
+                f'min={min(timings):.2f}s max={max(timings):.2f}s '
+                f'avg_chars={statistics.mean(lengths):.0f}'
+            )
@@ -0,0 +1,91 @@
+import re
+import statistics
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from utils.context_selection import select_context, CRITIC_CONTEXT_TOKENS, CRITIC_FETCH_K, CRITIC_MMR_LAMBDA
+from utils.guideline_index import get_corpus, DEFAULT_CHUNK_OVERLAP, DEFAULT_NAMESPACE
+from utils.model_registry import get_embedding_model, get_llm
+from utils.prompt_budget import count_tokens
+from utils.retrieval_cache import cached_retrieve
+from utils.tz_critic_agent2 import CRITIC_PROMPT
+
+# Фиксированный набор разделов ТЗ: на нём сравниваются размер промпта и ответы критика
+SAMPLE_SECTIONS = [
+    "Сервис онлайн-записи к врачу для сети частных клиник. Пациенты выбирают клинику, специалиста и время "
+    "приёма, получают напоминания. Администраторы клиник ведут расписание врачей.",
+    "Цели: сократить нагрузку на колл-центр на 40%, дать пациентам запись без звонка, собрать статистику "
+    "загрузки врачей. Задачи: веб-приложение, мобильное приложение, интеграция с МИС клиник.",
+    "Пользователи: пациент, врач, администратор клиники, администратор системы. Пациент записывается "
+    "и отменяет запись, врач видит своё расписание, администратор клиники управляет слотами.",
+    "Требования: запись должна подтверждаться SMS; система должна работать 24/7; время ответа API не более "
+    "1 секунды; персональные данные хранятся в РФ; вход по номеру телефона и коду.",
+    "Интеграция с МИС по REST, выгрузка расписания раз в 5 минут. Роли и права доступа настраиваются "
+    "администратором системы. Отчёты по загрузке врачей выгружаются в Excel.",
+]
+
+
+def sentences(text: str) -> set[str]:
+    return {part.strip() for part in re.split(r"(?<=[.!?])\s+|\n+", text) if len(part.strip()) > 20}
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает контекст критика top-k и MMR с дедупликацией: токены промпта, покрытие и (опционально) ответы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--namespace', default=DEFAULT_NAMESPACE)
+        parser.add_argument('--k', type=int, default=5, help='k прежнего top-k ретривера')
+        parser.add_argument('--budget', type=int, default=CRITIC_CONTEXT_TOKENS, help='Бюджет контекста, токенов')
+        parser.add_argument('--fetch-k', type=int, default=CRITIC_FETCH_K)
+        parser.add_argument('--lambda-mult', type=float, default=CRITIC_MMR_LAMBDA)
+        parser.add_argument('--generate', action='store_true',
+                            help='Прогнать критика в обоих режимах и сравнить ответы (запросы к GigaChat)')
+
+    def handle(self, *args, **options):
+        embeddings = get_embedding_model()
+        corpus = get_corpus(embeddings, namespace=options['namespace'])
+        version, vs = corpus.snapshot()
+        version = f"benchmark/{options['namespace']}/{version}"
+        llm = get_llm() if options['generate'] else None
+
+        rows = []
+        for i, section in enumerate(SAMPLE_SECTIONS, start=1):
+            topk_docs = cached_retrieve(vs, section, options['k'], version)
+            mmr_docs = select_context(vs, section, version, budget=options['budget'], fetch_k=options['fetch_k'],
+                                      lambda_mult=options['lambda_mult'], max_overlap=2 * DEFAULT_CHUNK_OVERLAP)
+            topk_context = "\n\n".join(doc.page_content for doc in topk_docs)
+            mmr_context = "\n\n".join(doc.page_content for doc in mmr_docs)
+            prompts = {
+                'topk': CRITIC_PROMPT.format(context=topk_context, question=section),
+                'mmr': CRITIC_PROMPT.format(context=mmr_context, question=section),
+            }
+            topk_sentences = sentences(topk_context)
+            # Какая доля предложений из прежнего контекста осталась в новом
+            coverage = len(topk_sentences & sentences(mmr_context)) / len(topk_sentences) if topk_sentences else 1.0
+            row = {
+                'topk_tokens': count_tokens(prompts['topk']),
+                'mmr_tokens': count_tokens(prompts['mmr']),
+                'coverage': coverage,
+                'spans': len(mmr_docs),
+            }
+
+            line = (f'section {i}: prompt tokens top-k={row["topk_tokens"]} mmr={row["mmr_tokens"]} '
+                    f'({row["mmr_tokens"] / row["topk_tokens"] - 1:+.0%}), spans={row["spans"]}, '
+                    f'top-k coverage={row["coverage"]:.2f}')
+            if llm is not None:
+                outputs = {mode: llm.invoke(prompt).content for mode, prompt in prompts.items()}
+                vectors = np.asarray(embeddings.embed_documents([outputs['topk'], outputs['mmr']]), dtype=np.float32)
+                norms = np.linalg.norm(vectors, axis=1)
+                row['similarity'] = float(vectors[0] @ vectors[1] / (norms[0] * norms[1]))
+                row['length_ratio'] = len(outputs['mmr']) / max(len(outputs['topk']), 1)
+                line += f', output similarity={row["similarity"]:.3f} length ratio={row["length_ratio"]:.2f}'
+            self.stdout.write(line)
+            rows.append(row)
+
+        summary = (f'mean prompt tokens top-k={statistics.mean(row["topk_tokens"] for row in rows):.0f} '
+                   f'mmr={statistics.mean(row["mmr_tokens"] for row in rows):.0f}, '
+                   f'mean coverage={statistics.mean(row["coverage"] for row in rows):.2f}')
+        if llm is not None:
+            summary += f', mean output similarity={statistics.mean(row["similarity"] for row in rows):.3f}'
+        self.stdout.write(self.style.SUCCESS(summary))
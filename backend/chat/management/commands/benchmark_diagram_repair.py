@@ -0,0 +1,65 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import AgentResponse
+from utils.diagram_stats import diagram_stats
+from utils.gigachat_auth import aget_default_access_token
+from utils.mermaid_renderer import arender_diagram
+from utils.tz_critic_agent2 import abuild_pipeline
+
+SECTION_TITLES = {
+    1: "1. Общее описание проекта:\n\n",
+    2: "2. Цели и задачи проекта:\n\n",
+    3: "3. Пользовательские группы:\n\n",
+    4: "4. Требования и функционал:\n\n",
+}
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает исправление диаграмм по ошибке рендера с повторной генерацией: '
+            'вызовы LLM и время на отрисованную диаграмму (запросы к GigaChat и Kroki)')
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--token', help='Чат, ТЗ которого берётся для диаграмм')
+        source.add_argument('--file', help='Текстовый файл с ТЗ')
+        parser.add_argument('--diagrams', default='DFD,Use Case,Activity,C4 Context,ER Diagram')
+        parser.add_argument('--runs', type=int, default=3, help='Прогонов каждой стратегии')
+        parser.add_argument('--attempts', type=int, default=4, help='Вызовов модели на диаграмму')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            with open(options['file'], encoding='utf-8') as f:
+                full_text = f.read()
+        else:
+            responses = AgentResponse.objects.filter(
+                token=options['token'], agent_id__in=list(SECTION_TITLES)).order_by('agent_id', '-created_at')
+            latest = {}
+            for response in responses:
+                latest.setdefault(response.agent_id, response.response)
+            if not latest:
+                raise CommandError(f"No agent responses for token {options['token']}")
+            full_text = "Собранное техническое задание:\n\n" + "".join(
+                f"{SECTION_TITLES[agent_id]}{text}\n\n" for agent_id, text in sorted(latest.items()))
+
+        diagram_types = [title.strip() for title in options['diagrams'].split(',') if title.strip()]
+        asyncio.run(self.run(full_text, diagram_types, options['runs'], options['attempts']))
+
+        # Первая генерация берётся из кэша ответов, поэтому обе стратегии начинают с одного и того же кода
+        for strategy, counters in diagram_stats.stats().items():
+            self.stdout.write(
+                f'{strategy:<10} diagrams={counters["diagrams"]} rendered={counters["rendered"]} '
+                f'first try={counters["first_try"]} LLM calls={counters["llm_calls"]} '
+                f'calls per rendered={counters["llm_calls_per_rendered"]} avg time={counters["avg_seconds"]}s'
+            )
+
+    async def run(self, full_text: str, diagram_types: list[str], runs: int, attempts: int) -> None:
+        token = await aget_default_access_token()
+        diagram_stats.reset()
+        for run in range(runs):
+            for repair in (True, False):
+                pipeline = await abuild_pipeline(diagram_repair=repair)
+                # Разные прогоны — разные тексты, иначе второй прогон целиком берётся из кэша
+                text = full_text if run == 0 else f"{full_text}\n\n(прогон {run + 1})"
+                await pipeline.arender_all_diagrams(text, token, diagram_types, arender_diagram, attempts=attempts)
@@ -0,0 +1,75 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.guideline_index import DEFAULT_DOC_PATH, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+
+LOADERS = {
+    'fast': 'load_docx',
+    'unstructured': 'load_docx_unstructured',
+}
+
+# Выполняется в отдельном процессе: импорт парсера и память считаются с нуля для каждого загрузчика
+MEASURE_SCRIPT = '''
+import json, sys, time
+from utils import guideline_index
+from utils.model_registry import current_rss_mb
+
+loader = getattr(guideline_index, sys.argv[1])
+path, chunk_size, chunk_overlap, repeats = sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])
+splitter = guideline_index.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+rss_before = current_rss_mb()
+started = time.perf_counter()
+documents = loader(path)
+first_load = time.perf_counter() - started
+rss_after = current_rss_mb()
+
+timings = []
+for _ in range(repeats):
+    started = time.perf_counter()
+    chunks = splitter.split_documents(loader(path))
+    timings.append(time.perf_counter() - started)
+timings.sort()
+
+print(json.dumps({
+    "first_load": first_load,
+    "ingest": timings[len(timings) // 2],
+    "rss": rss_after - rss_before,
+    "sections": len(documents),
+    "chunks": len(chunks),
+    "headings": sum(1 for chunk in chunks if chunk.metadata.get("heading")),
+}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает загрузку docx через python-docx и unstructured: первый вызов с импортом, разбор и память'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loaders', default=','.join(LOADERS), help=f'Через запятую, из {", ".join(LOADERS)}')
+        parser.add_argument('--doc', default=DEFAULT_DOC_PATH)
+        parser.add_argument('--repeats', type=int, default=5, help='Повторов разбора с нарезкой для медианы')
+
+    def handle(self, *args, **options):
+        for name in (loader.strip() for loader in options['loaders'].split(',') if loader.strip()):
+            process = subprocess.run(
+                [sys.executable, '-c', MEASURE_SCRIPT, LOADERS[name], options['doc'],
+                 str(DEFAULT_CHUNK_SIZE), str(DEFAULT_CHUNK_OVERLAP), str(options['repeats'])],
+                cwd=settings.BASE_DIR, env=os.environ, capture_output=True, text=True,
+            )
+            if process.returncode != 0:
+                error = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else process.returncode
+                self.stdout.write(self.style.ERROR(f'{name:<13} failed: {error}'))
+                continue
+
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            self.stdout.write(
+                f'{name:<13} first load (import + parse)={result["first_load"] * 1000:.0f}ms '
+                f'rss=+{result["rss"]:.0f}MB ingest p50={result["ingest"] * 1000:.1f}ms '
+                f'sections={result["sections"]} chunks={result["chunks"]} with headings={result["headings"]}'
+            )
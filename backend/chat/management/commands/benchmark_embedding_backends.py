@@ -0,0 +1,77 @@
+import gc
+import statistics
+import time
+
+import faiss
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from chat.management.commands.benchmark_embeddings import synthetic_queries
+from utils.embedding_backends import EMBEDDING_BACKENDS, build_embeddings
+from utils.guideline_index import split_document, DEFAULT_DOC_PATH, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+from utils.model_registry import current_rss_mb
+
+
+def search(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    _, indices = index.search(queries, k)
+    return indices
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает бэкенды эмбеддингов: задержка, память и совпадение выдачи с torch fp32 на tz_guidelines.docx'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', default=','.join(EMBEDDING_BACKENDS),
+                            help=f'Через запятую, из {", ".join(EMBEDDING_BACKENDS)}; первый — эталон')
+        parser.add_argument('--doc', default=DEFAULT_DOC_PATH)
+        parser.add_argument('--queries', type=int, default=50, help='Число синтетических запросов')
+        parser.add_argument('--k', type=int, default=5)
+
+    def handle(self, *args, **options):
+        backends = [name.strip() for name in options['backends'].split(',') if name.strip()]
+        chunks = [doc.page_content for doc in split_document(options['doc'], DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP)]
+        # Запросы к критику — это разделы ТЗ, поэтому берём фрагменты документа и синтетические тексты
+        queries = chunks[:options['queries'] // 2] + synthetic_queries(options['queries'] - options['queries'] // 2)
+        k = options['k']
+        self.stdout.write(f'{len(chunks)} chunks, {len(queries)} queries, k={k}')
+
+        reference = None
+        for backend in backends:
+            # Модели грузятся по очереди в одном процессе: RSS — прирост от загрузки именно этой модели
+            gc.collect()
+            rss_before = current_rss_mb()
+            started = time.perf_counter()
+            embeddings = build_embeddings(backend, device='cpu')
+            embeddings.embed_query(queries[0])  # прогрев
+            load_seconds = time.perf_counter() - started
+            rss_delta = current_rss_mb() - rss_before
+
+            started = time.perf_counter()
+            doc_vectors = np.asarray(embeddings.embed_documents(chunks), dtype=np.float32)
+            index_seconds = time.perf_counter() - started
+
+            latencies = []
+            query_vectors = []
+            for query in queries:
+                started = time.perf_counter()
+                query_vectors.append(embeddings.embed_query(query))
+                latencies.append(time.perf_counter() - started)
+            found = search(doc_vectors, np.asarray(query_vectors, dtype=np.float32), k)
+
+            if reference is None:
+                reference = found
+                overlap = 1.0
+            else:
+                overlap = statistics.mean(
+                    len(set(ours) & set(theirs)) / k for ours, theirs in zip(found, reference))
+
+            latencies.sort()
+            self.stdout.write(
+                f'{backend:<10} load={load_seconds:.1f}s rss=+{rss_delta:.0f}MB '
+                f'index={index_seconds:.1f}s query p50={statistics.median(latencies) * 1000:.1f}ms '
+                f'p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms '
+                f'overlap@{k}={overlap:.2f}'
+            )
+            del embeddings
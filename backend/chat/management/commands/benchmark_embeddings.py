@@ -0,0 +1,58 @@
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from utils.embedding_batcher import BatchingEmbeddings, MAX_BATCH_SIZE, MAX_WAIT_MS
+from utils.model_registry import get_embedding_model
+
+WORDS = (
+    "система пользователь заявка роль доступ отчёт интеграция требование сценарий база данных "
+    "уведомление администратор безопасность интерфейс платёж каталог поиск профиль журнал"
+).split()
+
+
+def synthetic_queries(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(20, 120))) for _ in range(count)]
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный замер embed_query: прямые вызовы модели против микробатчинга'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=256, help='Всего запросов')
+        parser.add_argument('--concurrency', type=int, default=16, help='Одновременных клиентов')
+        parser.add_argument('--max-batch', type=int, default=MAX_BATCH_SIZE)
+        parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS)
+
+    def handle(self, *args, **options):
+        model = get_embedding_model()
+        direct = model.embeddings if isinstance(model, BatchingEmbeddings) else model
+        batched = BatchingEmbeddings(direct, max_batch_size=options['max_batch'], max_wait_ms=options['max_wait_ms'])
+
+        queries = synthetic_queries(options['requests'])
+        direct.embed_query(queries[0])  # прогрев
+
+        for name, embeddings in (('direct', direct), ('batched', batched)):
+            latencies = []
+
+            def timed(text):
+                started = time.perf_counter()
+                embeddings.embed_query(text)
+                latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                list(executor.map(timed, queries))
+            elapsed = time.perf_counter() - started
+
+            latencies.sort()
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            self.stdout.write(
+                f'{name:<8} {len(queries) / elapsed:.1f} req/s  '
+                f'p50={statistics.median(latencies) * 1000:.0f}ms p95={p95 * 1000:.0f}ms'
+            )
+        self.stdout.write(f'batcher: {batched.stats()}')
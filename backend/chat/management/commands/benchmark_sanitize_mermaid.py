@@ -0,0 +1,49 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from utils.sanitize_mermaid_code import sanitize_mermaid_code
+
+PROSE = ("Конечно! Вот пример диаграммы для вашего технического задания. Она показывает основные процессы, "
+         "участников и потоки данных между ними.\n")
+DIAGRAM = """graph TD
+    User[Пользователь] -->|Заявка на ремонт| Service((Обработка заявки))
+    Service -->|Статус| DB[[База данных]]
+    DB -->|Отчёт| Manager(Руководитель)
+"""
+
+
+def make_input(kind: str, size: int) -> str:
+    """Ответ модели размером около size байт: диаграмма в середине длинного текста."""
+    diagram = {
+        'fenced': f"```mermaid\n{DIAGRAM}```\n",
+        'bare': "\n".join("  " + line if i else line for i, line in enumerate(DIAGRAM.splitlines())) + "\n",
+        'prose': "",
+    }[kind]
+    filler = max(size - len(diagram.encode()), 0) // 2
+    repeats = filler // len(PROSE.encode()) + 1
+    return PROSE * repeats + diagram + PROSE * repeats
+
+
+class Command(BaseCommand):
+    help = 'Замеряет sanitize_mermaid_code на ответах модели от 1 КБ до 1 МБ: с ```mermaid, без разметки и без диаграммы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1024,10240,102400,1048576', help='Размеры входа в байтах через запятую')
+        parser.add_argument('--repeats', type=int, default=20, help='Повторов на размер для медианы')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        for kind in ('fenced', 'bare', 'prose'):
+            for size in sizes:
+                text = make_input(kind, size)
+                timings = []
+                for _ in range(options['repeats']):
+                    started = time.perf_counter()
+                    result = sanitize_mermaid_code(text)
+                    timings.append(time.perf_counter() - started)
+                median = statistics.median(timings)
+                self.stdout.write(f'{kind:>6} {len(text.encode()) / 1024:8.0f} KB: median {median * 1000:8.3f} ms, '
+                                  f'{len(text.encode()) / median / 2 ** 20:8.1f} MB/s, '
+                                  f'{len(result.splitlines())} lines extracted')
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.guideline_index import (
+    get_corpus, validate_namespace, DEFAULT_DOC_PATH, DEFAULT_INDEX_DIR, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_NAMESPACE
+)
+from utils.model_registry import get_embedding_model
+
+
+class Command(BaseCommand):
+    help = 'Собирает FAISS-индекс корпуса рекомендаций ТЗ и сохраняет его на диск'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--doc', default=DEFAULT_DOC_PATH, help='Документ, которым заполняется новый корпус')
+        parser.add_argument('--namespace', default=DEFAULT_NAMESPACE,
+                            help='Пространство имён корпуса; новые заполняются только загруженными документами')
+        parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR, help='Каталог для хранения индексов')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--chunk-overlap', type=int, default=DEFAULT_CHUNK_OVERLAP)
+        parser.add_argument('--rebuild', action='store_true', help='Заново эмбеддить все документы корпуса')
+
+    def handle(self, *args, **options):
+        try:
+            namespace = validate_namespace(options['namespace'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        corpus = get_corpus(
+            get_embedding_model(),
+            index_dir=options['index_dir'],
+            chunk_size=options['chunk_size'],
+            chunk_overlap=options['chunk_overlap'],
+            seed_doc_path=options['doc'],
+            namespace=namespace,
+        )
+        if options['rebuild']:
+            corpus.rebuild()
+        version, vs = corpus.snapshot()
+        chunks = vs.index.ntotal if vs is not None else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Guideline index {namespace}/{version} ready: {len(corpus.documents())} documents, {chunks} chunks'))
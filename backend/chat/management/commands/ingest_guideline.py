@@ -0,0 +1,51 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.guideline_index import (
+    get_corpus, store_document, delete_document, validate_namespace, DEFAULT_INDEX_DIR, DEFAULT_CHUNK_SIZE,
+    DEFAULT_CHUNK_OVERLAP, DEFAULT_NAMESPACE, SUPPORTED_EXTENSIONS
+)
+from utils.model_registry import get_embedding_model
+
+
+class Command(BaseCommand):
+    help = 'Добавляет, заменяет или удаляет документ в корпусе рекомендаций ТЗ (инкрементально)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help=f'Документы ({", ".join(SUPPORTED_EXTENSIONS)})')
+        parser.add_argument('--doc-id', help='ID документа в корпусе (по умолчанию имя файла)')
+        parser.add_argument('--remove', action='append', default=[], metavar='DOC_ID', help='Удалить документ')
+        parser.add_argument('--namespace', default=DEFAULT_NAMESPACE, help='Пространство имён корпуса')
+        parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR)
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--chunk-overlap', type=int, default=DEFAULT_CHUNK_OVERLAP)
+
+    def handle(self, *args, **options):
+        if options['doc_id'] and len(options['paths']) > 1:
+            raise CommandError('--doc-id can only be used with a single document')
+        try:
+            namespace = validate_namespace(options['namespace'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        corpus = get_corpus(
+            get_embedding_model(),
+            index_dir=options['index_dir'],
+            chunk_size=options['chunk_size'],
+            chunk_overlap=options['chunk_overlap'],
+            namespace=namespace,
+        )
+        for doc_id in options['remove']:
+            version = corpus.remove(doc_id)
+            delete_document(doc_id, options['index_dir'], namespace)
+            self.stdout.write(f'Removed {doc_id}, index {version}')
+
+        for path in options['paths']:
+            if not path.lower().endswith(SUPPORTED_EXTENSIONS):
+                raise CommandError(f'Unsupported document type: {path}')
+            doc_id = options['doc_id'] or os.path.basename(path)
+            version = corpus.ingest(doc_id, store_document(doc_id, path, options['index_dir'], namespace))
+            self.stdout.write(f'Ingested {doc_id}, index {version}')
+
+        self.stdout.write(self.style.SUCCESS(f'Guideline index {namespace}/{corpus.snapshot()[0]} ready'))
@@ -17,3 +17,28 @@ class AgentResponse(models.Model):
 
     def __str__(self):
         return f"Response for token {self.token} from agent {self.agent_id}"
+
+
+class CompletionCacheEntry(models.Model):
+    key = models.CharField(max_length=64, primary_key=True, verbose_name="Хэш запроса")
+    cache = models.CharField(max_length=32, default="completions", verbose_name="Кэш")
+    response = models.TextField(verbose_name="Ответ модели")
+    created_at = models.DateTimeField(auto_now=True, verbose_name="Дата сохранения")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['cache', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Cached completion {self.key[:12]}"
+
+
+class ChatGuidelineNamespace(models.Model):
+    token = models.UUIDField(unique=True, verbose_name="Идентификатор чата")
+    namespace = models.CharField(max_length=64, verbose_name="Корпус рекомендаций")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    def __str__(self):
+        return f"Guideline namespace {self.namespace} for token {self.token}"
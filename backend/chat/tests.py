@@ -1,3 +1,543 @@
-from django.test import TestCase
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from chat.models import CompletionCacheEntry
+from utils import completion_cache as cache_module
+from utils import embedding_backends
+from utils import gigachat_auth
+from utils import tz_critic_agent2
+from utils.completion_cache import CompletionCache, cache_key, cached_call, acached_call
+from utils.embedding_batcher import BatchingEmbeddings
+from utils.guideline_index import embedding_model_name
+from utils.lru_cache import LRUCache
+from utils.single_flight import SingleFlight, request_key
+from utils.tz_critic_agent2 import DiagramAgent, TzPipeline
+
+
+class CacheKeyTests(SimpleTestCase):
+    def test_key_depends_on_model_temperature_and_prompt(self):
+        key = cache_key("GigaChat", 0.3, "prompt")
+        self.assertEqual(key, cache_key("GigaChat", 0.3, "prompt"))
+        self.assertNotEqual(key, cache_key("GigaChat-Pro", 0.3, "prompt"))
+        self.assertNotEqual(key, cache_key("GigaChat", 0.7, "prompt"))
+        self.assertNotEqual(key, cache_key("GigaChat", 0.3, "prompt 2"))
+
+
+class CompletionCacheMemoryTests(SimpleTestCase):
+    def make_cache(self, **kwargs):
+        return CompletionCache(**{"max_entries": 10, "ttl": 60, "use_db": False, "enabled": True, **kwargs})
+
+    def test_get_returns_stored_value_and_counts_hits_and_misses(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_entry_expires_after_ttl(self):
+        cache = self.make_cache(ttl=60)
+        with mock.patch.object(cache_module.time, "time", return_value=1000.0):
+            cache.set("key", "value")
+        with mock.patch.object(cache_module.time, "time", return_value=1059.0):
+            self.assertEqual(cache.get("key"), "value")
+        with mock.patch.object(cache_module.time, "time", return_value=1061.0):
+            self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = self.make_cache(max_entries=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+
+        self.assertEqual(cache.get("a"), "1")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "3")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_disabled_cache_stores_nothing(self):
+        cache = self.make_cache(enabled=False)
+        cache.set("key", "value")
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.stats()["misses"], 0)
+
+    async def test_async_get_and_set(self):
+        cache = self.make_cache()
+        self.assertIsNone(await cache.aget("key"))
+        await cache.aset("key", "value")
+        self.assertEqual(await cache.aget("key"), "value")
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_values_of_any_type_are_returned_as_is(self):
+        cache = LRUCache(max_entries=10)
+        ids = ["chunk-1", "chunk-2"]
+        cache.set("ids", ids)
+        self.assertIs(cache.get("ids"), ids)
+        self.assertIsNone(cache.get("other"))
+        self.assertEqual(cache.stats()["hit_rate"], 0.5)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+
+class CompletionCacheDatabaseTests(TestCase):
+    def make_cache(self, **kwargs):
+        return CompletionCache(**{"max_entries": 10, "ttl": 60, "use_db": True, "enabled": True, **kwargs})
+
+    def test_value_is_shared_through_database(self):
+        self.make_cache().set("key", "value")
+        self.assertEqual(CompletionCacheEntry.objects.get(key="key").response, "value")
+
+        # Другой воркер с пустой памятью находит ответ в Postgres и кладёт его в свой LRU
+        cache = self.make_cache()
+        self.assertEqual(cache.get("key"), "value")
+        self.assertEqual(cache.get("key"), "value")
+        stats = cache.stats()
+        self.assertEqual((stats["db_hits"], stats["hits"], stats["misses"]), (1, 1, 0))
+
+    def test_set_overwrites_database_entry(self):
+        self.make_cache().set("key", "old")
+        self.make_cache().set("key", "new")
+        self.assertEqual(CompletionCacheEntry.objects.get(key="key").response, "new")
+
+    def test_expired_database_entry_is_a_miss(self):
+        self.make_cache().set("key", "value")
+        CompletionCacheEntry.objects.filter(key="key").update(created_at=timezone.now() - timedelta(seconds=120))
+
+        cache = self.make_cache(ttl=60)
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_entries_without_ttl_are_read_from_database(self):
+        self.make_cache(ttl=float("inf"), name="summaries").set("key", "value")
+        CompletionCacheEntry.objects.filter(key="key").update(created_at=timezone.now() - timedelta(days=365))
+        self.assertEqual(self.make_cache(ttl=float("inf"), name="summaries").get("key"), "value")
+
+    def age_entries(self, *keys: str, seconds: float = 0) -> None:
+        # Строки с разным временем сохранения: первая в keys — самая старая
+        for age, key in enumerate(reversed(keys)):
+            CompletionCacheEntry.objects.filter(key=key).update(
+                created_at=timezone.now() - timedelta(seconds=seconds + age))
+
+    def test_prune_deletes_expired_rows(self):
+        cache = self.make_cache(ttl=60)
+        cache.set("old", "1")
+        cache.set("new", "2")
+        self.age_entries("old", seconds=120)
+
+        self.assertEqual(cache.prune_db(), 1)
+        self.assertEqual(list(CompletionCacheEntry.objects.values_list("key", flat=True)), ["new"])
+        self.assertEqual(cache.stats()["db_pruned"], 1)
+
+    def test_prune_keeps_newest_rows_within_cap(self):
+        cache = self.make_cache(max_db_entries=2)
+        for key in ("a", "b", "c", "d"):
+            cache.set(key, key)
+        self.age_entries("a", "b", "c", "d")
+
+        self.assertEqual(cache.prune_db(), 2)
+        self.assertEqual(set(CompletionCacheEntry.objects.values_list("key", flat=True)), {"c", "d"})
+
+    def test_prune_only_touches_own_rows(self):
+        self.make_cache(ttl=float("inf"), name="summaries").set("summary", "1")
+        cache = self.make_cache(ttl=60, max_db_entries=0)
+        cache.set("completion", "2")
+        self.age_entries("summary", "completion", seconds=120)
+
+        self.assertEqual(cache.prune_db(), 1)
+        self.assertEqual(list(CompletionCacheEntry.objects.values_list("key", flat=True)), ["summary"])
+
+    def test_writes_prune_database_periodically(self):
+        cache = self.make_cache(max_db_entries=2, db_prune_every=3)
+        for key in ("a", "b"):
+            cache.set(key, key)
+        self.age_entries("a", "b", seconds=10)
+        cache.set("c", "c")
+        self.assertEqual(set(CompletionCacheEntry.objects.values_list("key", flat=True)), {"b", "c"})
+
+    async def test_async_writes_prune_database(self):
+        cache = self.make_cache(max_db_entries=1, db_prune_every=2)
+        await cache.aset("a", "a")
+        await CompletionCacheEntry.objects.filter(key="a").aupdate(created_at=timezone.now() - timedelta(seconds=10))
+        await cache.aset("b", "b")
+        self.assertEqual([key async for key in CompletionCacheEntry.objects.values_list("key", flat=True)], ["b"])
+
+    def test_database_errors_are_treated_as_a_miss(self):
+        cache = self.make_cache()
+        with self.assertLogs("utils.completion_cache", level="WARNING"):
+            with mock.patch.object(CompletionCache, "_db_queryset", side_effect=RuntimeError("connection lost")):
+                self.assertIsNone(cache.get("key"))
+            with mock.patch.object(CompletionCacheEntry.objects, "update_or_create",
+                                   side_effect=RuntimeError("connection lost")):
+                cache.set("key", "value")
+        # Запись в память не зависит от второго уровня
+        self.assertEqual(cache.get("key"), "value")
+
+
+class CachedCallTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cache_module, "completion_cache",
+                                    CompletionCache(max_entries=10, ttl=60, use_db=False, enabled=True))
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_second_call_is_served_from_cache(self):
+        fn = mock.Mock(return_value="answer")
+        self.assertEqual(cached_call("key", fn, "prompt", temperature=0.3), "answer")
+        self.assertEqual(cached_call("key", fn, "prompt", temperature=0.3), "answer")
+        fn.assert_called_once_with("prompt", temperature=0.3)
+
+    def test_use_cache_false_bypasses_read_but_stores_fresh_answer(self):
+        self.cache.set("key", "stale")
+        fn = mock.Mock(return_value="fresh")
+
+        self.assertEqual(cached_call("key", fn, use_cache=False), "fresh")
+        fn.assert_called_once_with()
+        self.assertEqual(self.cache.get("key"), "fresh")
+        self.assertEqual(self.cache.stats()["bypasses"], 1)
+
+    def test_failed_call_is_not_cached(self):
+        fn = mock.Mock(side_effect=[RuntimeError("timeout"), "answer"])
+        with self.assertRaises(RuntimeError):
+            cached_call("key", fn)
+        self.assertEqual(cached_call("key", fn), "answer")
+        self.assertEqual(fn.call_count, 2)
+
+    async def test_async_cached_call(self):
+        afn = mock.AsyncMock(return_value="answer")
+        self.assertEqual(await acached_call("key", afn, "prompt"), "answer")
+        self.assertEqual(await acached_call("key", afn, "prompt"), "answer")
+        afn.assert_awaited_once_with("prompt")
+
+        self.assertEqual(await acached_call("key", afn, "prompt", use_cache=False), "answer")
+        self.assertEqual(afn.await_count, 2)
+
+
+class RequestKeyTests(SimpleTestCase):
+    def test_parts_are_separated(self):
+        self.assertEqual(request_key("token", 1, "text"), request_key("token", 1, "text"))
+        self.assertNotEqual(request_key("ab", "c"), request_key("a", "bc"))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def wait_for(self, condition, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition was not met in time")
+            time.sleep(0.005)
+
+    def run_in_threads(self, flight: SingleFlight, key: str, fn, count: int) -> list:
+        """Запускает count одинаковых вызовов flight.do(); возвращает результаты или исключения."""
+        results = [None] * count
+
+        def call(i):
+            try:
+                results[i] = flight.do(key, fn)
+            except BaseException as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        threads, results = self.run_in_threads(flight, "key", work, 3)
+        # Отпускаем лидера, только когда остальные присоединились к его вызову
+        self.wait_for(lambda: flight.stats()["shared"] == 2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(results, ["result"] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats(), {"leaders": 1, "shared": 2})
+
+    def test_exception_is_raised_for_every_caller(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+
+        def work():
+            release.wait(5)
+            raise ValueError("failed")
+
+        threads, results = self.run_in_threads(flight, "key", work, 2)
+        self.wait_for(lambda: flight.stats()["shared"] == 1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_finished_call_is_not_reused(self):
+        flight = SingleFlight("test")
+        fn = mock.Mock(side_effect=["first", "second"])
+        self.assertEqual(flight.do("key", fn), "first")
+        self.assertEqual(flight.do("key", fn), "second")
+        self.assertEqual(flight.stats(), {"leaders": 2, "shared": 0})
+
+    def test_different_keys_run_separately(self):
+        flight = SingleFlight("test")
+        self.assertEqual(flight.do("a", lambda: 1), 1)
+        self.assertEqual(flight.do("b", lambda: 2), 2)
+        self.assertEqual(flight.stats()["shared"], 0)
+
+    async def test_async_calls_share_one_execution(self):
+        flight = SingleFlight("test")
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        results = await asyncio.gather(*(flight.ado("key", work, 21) for _ in range(3)))
+        self.assertEqual(results, [42, 42, 42])
+        self.assertEqual(calls, [21])
+        self.assertEqual(flight.stats(), {"leaders": 1, "shared": 2})
+
+    async def test_async_exception_is_raised_for_every_caller(self):
+        flight = SingleFlight("test")
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        results = await asyncio.gather(*(flight.ado("key", work) for _ in range(2)), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_async_system_exit_reaches_callers_without_stopping_loop(self):
+        flight = SingleFlight("test")
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise SystemExit("GigaChat API error")
+
+        for _ in range(2):
+            with self.assertRaises(SystemExit):
+                await flight.ado("key", work)
+        # Event loop продолжает работать
+        self.assertEqual(await flight.ado("other", asyncio.sleep, 0, "ok"), "ok")
+
+    async def test_cancelled_waiter_does_not_cancel_shared_work(self):
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "result"
+
+        first = asyncio.create_task(flight.ado("key", work))
+        second = asyncio.create_task(flight.ado("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+
+        self.assertEqual(await second, "result")
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+
+class ProviderGigaChatClientTests(SimpleTestCase):
+    def setUp(self):
+        self.provider = gigachat_auth.GigaChatTokenProvider("credentials")
+        self.refresh_threads = []
+
+        def refresh():
+            self.refresh_threads.append(threading.current_thread())
+            self.provider._token = f"token-{len(self.refresh_threads)}"
+            self.provider._expires_at = time.time() + 3600
+
+        patcher = mock.patch.object(self.provider, "_refresh_locked", side_effect=refresh)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = gigachat_auth._ProviderGigaChatClient(token_provider=self.provider, base_url="http://gigachat")
+
+    async def test_async_call_refreshes_token_off_the_event_loop(self):
+        async def call():
+            return self.client.token
+
+        self.assertEqual(await self.client._adecorator(call), "token-1")
+        self.assertIsNot(self.refresh_threads[0], threading.current_thread())
+
+        # Токен в пределах запаса refresh_margin обновляется до запроса, тоже вне event loop
+        self.provider._expires_at = time.time() + 30
+        self.assertEqual(await self.client._adecorator(call), "token-2")
+        self.assertTrue(all(thread is not threading.current_thread() for thread in self.refresh_threads))
+
+    def test_sync_token_read_refreshes_when_missing(self):
+        self.assertEqual(self.client.token, "token-1")
+        self.assertEqual(self.client.token, "token-1")
+        self.assertEqual(len(self.refresh_threads), 1)
+
+
+class RecordingEmbeddings:
+    """Модель-заглушка: вектор — длина текста; запоминает размеры пачек и одновременные вызовы."""
+
+    def __init__(self):
+        self.batches = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.batches.append(len(texts))
+        time.sleep(0.01)
+        with self._lock:
+            self.active -= 1
+        return [[float(len(text))] for text in texts]
+
+
+class BatchingEmbeddingsTests(SimpleTestCase):
+    def test_concurrent_queries_share_one_batch(self):
+        model = RecordingEmbeddings()
+        batcher = BatchingEmbeddings(model, max_batch_size=8, max_wait_ms=200)
+        texts = ["a", "bb", "ccc", "dddd"]
+        results = [None] * len(texts)
+
+        def query(i):
+            results[i] = batcher.embed_query(texts[i])
+
+        threads = [threading.Thread(target=query, args=(i,)) for i in range(len(texts))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(results, [[1.0], [2.0], [3.0], [4.0]])
+        self.assertEqual(model.batches, [4])
+
+    def test_large_call_is_split_and_never_runs_alongside_batches(self):
+        model = RecordingEmbeddings()
+        batcher = BatchingEmbeddings(model, max_batch_size=4, max_wait_ms=1)
+        documents = ["x" * (i + 1) for i in range(10)]
+        queries = []
+
+        thread = threading.Thread(target=lambda: queries.append(batcher.embed_query("query")))
+        thread.start()
+        vectors = batcher.embed_documents(documents)
+        thread.join(5)
+
+        self.assertEqual(vectors, [[float(i + 1)] for i in range(10)])
+        self.assertEqual(queries, [[5.0]])
+        self.assertTrue(all(size <= 4 for size in model.batches))
+        self.assertEqual(sum(model.batches), 11)
+        self.assertEqual(model.max_active, 1)
+
+
+class EmbeddingBackendTests(SimpleTestCase):
+    def setUp(self):
+        # Модель не загружается: проверяется только, с какими параметрами её создают
+        patcher = mock.patch("langchain_huggingface.HuggingFaceEmbeddings",
+                             side_effect=lambda **kwargs: mock.Mock(**kwargs))
+        self.embeddings_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(embedding_backends, "_default_device", return_value="cpu")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def build(self, backend: str):
+        self.embeddings_class.reset_mock()
+        embeddings = embedding_backends.build_embeddings(backend)
+        self.assertEqual(self.embeddings_class.call_args.kwargs["encode_kwargs"], embedding_backends.ENCODE_KWARGS)
+        return embeddings
+
+    def test_backend_selects_model_and_runtime(self):
+        torch = self.build("torch")
+        self.assertEqual((torch.model_name, torch.model_kwargs), (embedding_backends.EMBEDDING_MODEL_NAME,
+                                                                   {"device": "cpu"}))
+        small = self.build("small")
+        self.assertEqual(small.model_name, embedding_backends.SMALL_EMBEDDING_MODEL_NAME)
+        onnx = self.build("onnx")
+        self.assertEqual((onnx.model_name, onnx.model_kwargs), (embedding_backends.EMBEDDING_MODEL_NAME,
+                                                                 {"device": "cpu", "backend": "onnx"}))
+
+        quantized = ("embedding_models/model", "onnx/model_qint8_avx2.onnx")
+        with mock.patch.object(embedding_backends, "quantized_onnx_model", return_value=quantized):
+            int8 = self.build("onnx-int8")
+        self.assertEqual(int8.model_name, "embedding_models/model")
+        self.assertEqual(int8.model_kwargs["model_kwargs"], {"file_name": "onnx/model_qint8_avx2.onnx"})
+
+    def test_unknown_backend_is_rejected(self):
+        with self.assertRaisesMessage(ValueError, "Unknown embedding backend 'tensorrt'"):
+            embedding_backends.build_embeddings("tensorrt")
+
+    def test_index_name_distinguishes_backends(self):
+        torch, onnx, small = self.build("torch"), self.build("onnx"), self.build("small")
+        with mock.patch.object(embedding_backends, "quantized_onnx_model",
+                               return_value=("embedding_models/model", "onnx/model_qint8_avx2.onnx")):
+            int8 = self.build("onnx-int8")
+
+        self.assertEqual(embedding_model_name(torch), embedding_backends.EMBEDDING_MODEL_NAME)
+        self.assertEqual(embedding_model_name(onnx), f"{embedding_backends.EMBEDDING_MODEL_NAME}@onnx")
+        self.assertEqual(embedding_model_name(int8), "embedding_models/model@onnx:onnx/model_qint8_avx2.onnx")
+        self.assertEqual(embedding_model_name(small), embedding_backends.SMALL_EMBEDDING_MODEL_NAME)
+        # Обёртка-батчер не меняет версию индекса
+        self.assertEqual(embedding_model_name(BatchingEmbeddings(onnx)), embedding_model_name(onnx))
+
+
+class TzPipelineLazyTests(SimpleTestCase):
+    def setUp(self):
+        # Критик, эмбеддинги и LLM не должны создаваться, пока они не понадобились
+        for name in ("TzCriticAgent", "get_embedding_model", "get_llm"):
+            patcher = mock.patch.object(tz_critic_agent2, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_diagram_request_does_not_build_critic(self):
+        pipeline = TzPipeline(llm_callable=mock.Mock())
+        arender = mock.AsyncMock(return_value=("png", None, None))
+        with mock.patch.object(DiagramAgent, "agenerate", mock.AsyncMock(return_value="flowchart TD\nA --> B")):
+            outputs, errors = asyncio.run(pipeline.arender_all_diagrams("ТЗ для ленивого конвейера", "token",
+                                                                        ["DFD", "ER Diagram"], arender))
+
+        self.assertEqual((outputs, errors), ({"DFD": "png", "ER Diagram": "png"}, {}))
+        self.assertNotIn("critic", pipeline.__dict__)
+        self.assertNotIn("agents", pipeline.__dict__)
+        self.TzCriticAgent.assert_not_called()
+        self.get_embedding_model.assert_not_called()
+        self.get_llm.assert_not_called()
+
+    def test_critic_is_built_once_from_registry_or_given_models(self):
+        pipeline = TzPipeline(llm_callable=mock.Mock(), guideline_namespace="team")
+        self.assertIs(asyncio.run(pipeline.acritic()), pipeline.critic)
+        self.TzCriticAgent.assert_called_once()
+        self.assertEqual(self.TzCriticAgent.call_args.kwargs["embedding_model"], self.get_embedding_model.return_value)
+        self.assertEqual(self.TzCriticAgent.call_args.kwargs["namespace"], "team")
+
+        embedding_model = mock.Mock()
+        TzPipeline(llm_callable=mock.Mock(), embedding_model=embedding_model, llm=mock.Mock()).critic
+        self.assertIs(self.TzCriticAgent.call_args.kwargs["embedding_model"], embedding_model)
+        self.get_embedding_model.assert_called_once()
+        self.get_llm.assert_called_once()
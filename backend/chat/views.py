@@ -1,61 +1,59 @@
 from drf_spectacular.utils import extend_schema, OpenApiExample, OpenApiResponse, OpenApiParameter
 from rest_framework.response import Response
-from rest_framework.views import APIView
+from adrf.views import APIView
 from rest_framework import status
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+import json
 import logging
 import uuid
-import environ
-import base64
-import torch
-import os
-from langchain_gigachat.chat_models import GigaChat
-from langchain_huggingface import HuggingFaceEmbeddings
-
-from chat.models import AgentResponse
+
+from chat.models import AgentResponse, ChatGuidelineNamespace
 from chat.serializer import ChatResponseSerializer, ErrorResponseSerializer
-from sentence_transformers import SentenceTransformer
-from utils.tz_critic_agent2 import get_access_token, TzPipeline, call_gigachat
+from utils.completion_cache import completion_cache
+from utils.diagram_stats import diagram_stats, render_stats
+from utils.gigachat_auth import aget_default_access_token
+from utils.guideline_index import corpora_stats, list_namespaces, DEFAULT_NAMESPACE
+from utils.model_registry import registry
+from utils.render_cache import render_cache
+from utils import prompt_budget, retrieval_cache, token_usage
+from utils.single_flight import agent_flight, diagram_flight, summary_flight
+from utils.tz_critic_agent2 import abuild_pipeline
 
 logger = logging.getLogger(__name__)
 
 
-class ChatAPIView(APIView):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        env = environ.Env()
-        client_id = env('CLIENT_ID')
-        client_secret = env('CLIENT_SECRET')
-
-        self.access_token: str = get_access_token(client_id, client_secret)
-        basic_creds = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-
-        # 2) (Опционально) Через переменную окружения
-        os.environ["GIGACHAT_CREDENTIALS"] = basic_creds
-        # 3) Инициализируем LLM и эмбеддинги
-        self.llm = GigaChat(
-            # либо просто GigaChat(), если задали GIGACHAT_CREDENTIALS
-            credentials=basic_creds,
-            auth_url="https://ngw.devices.sberbank.ru:9443/api/v2/oauth",
-            base_url="https://gigachat.devices.sberbank.ru/api/v1",
-            scope="GIGACHAT_API_PERS",
-            verify_ssl_certs=False,
-        )
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        model_name = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
-        model_kwargs = {"device": device}
-        encode_kwargs = {"normalize_embeddings": False}
+async def aget_last_response(token: str, agent_id: int) -> str:
+    """Последний ответ этого агента, а если его нет — предыдущего (для агентов 2-4)."""
+    current_agent_response = await AgentResponse.objects.filter(
+        token=token, agent_id=agent_id).order_by('-created_at').afirst()
+    if current_agent_response:
+        return current_agent_response.response
+    if agent_id > 1:
+        prev_agent_response = await AgentResponse.objects.filter(
+            token=token, agent_id=agent_id - 1).order_by('-created_at').afirst()
+        if prev_agent_response:
+            return prev_agent_response.response
+    return ""
 
-        try:
-            model = SentenceTransformer(model_name_or_path=model_name, device=device)
-        except Exception as e:
-            logger.exception(f"Error loading embedding model: {e}")
 
-        self.local_embedding = HuggingFaceEmbeddings(
-            model_name=model_name,
-            model_kwargs=model_kwargs,
-            encode_kwargs=encode_kwargs
-        )
+async def aresolve_guideline_namespace(token: str, requested: str | None) -> str:
+    """
+    Корпус рекомендаций для критика этого чата. Явно переданный запоминается за токеном,
+    иначе берётся сохранённый ранее или корпус по умолчанию.
+    """
+    if requested:
+        if requested not in list_namespaces():
+            raise LookupError(requested)
+        await ChatGuidelineNamespace.objects.aupdate_or_create(token=token, defaults={'namespace': requested})
+        return requested
+    selected = await ChatGuidelineNamespace.objects.filter(token=token).afirst()
+    return selected.namespace if selected else DEFAULT_NAMESPACE
+
 
+class ChatAPIView(APIView):
     @extend_schema(
         summary='Генерация ТЗ через чат с ИИ агентом',
         description="""
@@ -101,6 +99,12 @@ class ChatAPIView(APIView):
                         'type': 'string',
                         'description': 'Текст сообщения от пользователя для обработки ИИ-агентом.',
                         'example': 'Напиши ТЗ для сайта интернет-магазина'
+                    },
+                    'guidelines': {
+                        'type': 'string',
+                        'description': 'Корпус рекомендаций для критика (пространство имён из /api/v1/guidelines). '
+                                       'Запоминается для чата; по умолчанию — default.',
+                        'example': 'default'
                     }
                 },
                 'required': ['text']
@@ -167,7 +171,7 @@ class ChatAPIView(APIView):
             )
         }
     )
-    def post(self, request, agent_id):
+    async def post(self, request, agent_id):
         try:
             if agent_id not in {1, 2, 3, 4, 6}:
                 return Response({'error': f'Agent with id {agent_id} not found. Available agents: 1, 2, 3, 4, 6'}, status=status.HTTP_400_BAD_REQUEST)
@@ -186,43 +190,36 @@ class ChatAPIView(APIView):
                 except ValueError:
                     return Response({'error': 'Invalid token format'}, status=status.HTTP_400_BAD_REQUEST)
 
-            last_response = ""
-            if agent_id == 1:
-                prev_response = AgentResponse.objects.filter(token=token, agent_id=agent_id).order_by('-created_at').first()
-                if prev_response:
-                    last_response = prev_response.response
-            else:
-                current_agent_response = AgentResponse.objects.filter(token=token, agent_id=agent_id).order_by('-created_at').first()
-
-                if current_agent_response:
-                    last_response = current_agent_response.response
-                else:
-                    prev_agent_response = AgentResponse.objects.filter(token=token, agent_id=agent_id - 1).order_by('-created_at').first()
-                    if prev_agent_response:
-                        last_response = prev_agent_response.response
+            last_response = await aget_last_response(token, agent_id)
             # ============================================== Вызов агента ==============================================
             response_agent = 'error'
 
-            pipeline = TzPipeline(llm_callable=call_gigachat, embedding_model=self.local_embedding, llm=self.llm)
+            if agent_id != 6:
+                try:
+                    namespace = await aresolve_guideline_namespace(token, request.data.get('guidelines'))
+                except LookupError:
+                    return Response({'error': 'Unknown guidelines namespace'}, status=status.HTTP_400_BAD_REQUEST)
+                access_token = await aget_default_access_token()
+                pipeline = await abuild_pipeline(guideline_namespace=namespace)
 
             if agent_id == 1:
                 # Агент 1: Общее описание
-                response_agent = pipeline.run_agent("description", last_response, text, self.access_token)
+                response_agent = await pipeline.arun_agent("description", last_response, text, access_token)
             elif agent_id == 2:
                 # Агент 2: Цели проекта
-                response_agent = pipeline.run_agent("goals", last_response, text, self.access_token)
+                response_agent = await pipeline.arun_agent("goals", last_response, text, access_token)
             elif agent_id == 3:
                 # Агент 3: Пользовательские группы
-                response_agent = pipeline.run_agent("users", last_response, text, self.access_token)
+                response_agent = await pipeline.arun_agent("users", last_response, text, access_token)
             elif agent_id == 4:
                 # Агент 4: Требования
-                response_agent = pipeline.run_agent("requirements", last_response, text, self.access_token)
+                response_agent = await pipeline.arun_agent("requirements", last_response, text, access_token)
 
             elif agent_id == 6:
-                all_responses = AgentResponse.objects.filter(
+                all_responses = [resp async for resp in AgentResponse.objects.filter(
                     token=token,
                     agent_id__in=[1, 2, 3, 4]
-                ).order_by('agent_id', '-created_at').distinct('agent_id')
+                ).order_by('agent_id', '-created_at').distinct('agent_id')]
 
                 structured_response = "Собранное техническое задание:\n\n"
 
@@ -238,7 +235,7 @@ class ChatAPIView(APIView):
 
                     structured_response += f"{section}{resp.response}\n\n"
 
-                AgentResponse.objects.create(token=token, agent_id=agent_id, response=structured_response)
+                await AgentResponse.objects.acreate(token=token, agent_id=agent_id, response=structured_response)
 
                 return Response({'token': token, 'text': structured_response}, status=status.HTTP_200_OK)
             # ============================================== Вызов агента ==============================================
@@ -247,7 +244,7 @@ class ChatAPIView(APIView):
                 if response_agent.endswith("?"):
                     pass
                 else:
-                    AgentResponse.objects.create(token=token, agent_id=agent_id, response=response_agent)
+                    await AgentResponse.objects.acreate(token=token, agent_id=agent_id, response=response_agent)
 
             return Response({'token': token, 'text': response_agent}, status=status.HTTP_200_OK)
 
@@ -258,3 +255,101 @@ class ChatAPIView(APIView):
         except Exception as e:
             logger.exception(f'Error contacting agent: {e}')
             return Response({'error': 'Internal Server Error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ChatStreamView(View):
+    """
+    Потоковый (Server-Sent Events) вариант ChatAPIView для агентов 1-4.
+
+    Тело запроса такое же, как у ChatAPIView. В ответ приходят события:
+    `stage` (clarify / retrieval / critic), `token` (фрагменты текста модели по мере генерации),
+    `done` (токен чата и итоговый текст; итог сохраняется в AgentResponse) или `error`.
+    Стриминг работает при запуске через fort/asgi.py.
+    """
+    STREAM_AGENTS = {1: "description", 2: "goals", 3: "users", 4: "requirements"}
+
+    async def post(self, request, agent_id):
+        if agent_id not in self.STREAM_AGENTS:
+            return JsonResponse({'error': f'Agent with id {agent_id} does not support streaming. Available agents: 1, 2, 3, 4'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON body'}, status=status.HTTP_400_BAD_REQUEST)
+
+        token = data.get('token')
+        text = data.get('text')
+        if not text:
+            return JsonResponse({'error': 'The \'text\' field is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not token:
+            token = str(uuid.uuid4())
+        else:
+            try:
+                uuid.UUID(token)
+            except ValueError:
+                return JsonResponse({'error': 'Invalid token format'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            namespace = await aresolve_guideline_namespace(token, data.get('guidelines'))
+        except LookupError:
+            return JsonResponse({'error': 'Unknown guidelines namespace'}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(self._stream(agent_id, token, text, namespace),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def _stream(self, agent_id: int, token: str, text: str, namespace: str):
+        try:
+            access_token = await aget_default_access_token()
+            pipeline = await abuild_pipeline(guideline_namespace=namespace)
+
+            last_response = await aget_last_response(token, agent_id)
+            async for event, data in pipeline.astream_agent(
+                    self.STREAM_AGENTS[agent_id], last_response, text, access_token):
+                if event == 'done':
+                    if not data['question']:
+                        await AgentResponse.objects.acreate(token=token, agent_id=agent_id, response=data['text'])
+                    yield _sse('done', {'token': token, 'text': data['text']})
+                else:
+                    yield _sse(event, data)
+
+        except Exception as e:
+            logger.exception(f'Error streaming agent response: {e}')
+            yield _sse('error', {'error': 'Internal Server Error'})
+
+
+class ChatStatsAPIView(APIView):
+    @extend_schema(
+        summary='Статистика кэша ответов, моделей и объединения запросов',
+        description='Счётчики попаданий/промахов кэша ответов GigaChat, время загрузки моделей, '
+                    'бюджеты промптов и израсходованные токены в текущем процессе.',
+        responses={200: OpenApiResponse(description='Статистика процесса')},
+    )
+    async def get(self, request):
+        embedding_model = registry.get("embedding") if registry.is_loaded("embedding") else None
+        return Response({
+            "embedding_batcher": embedding_model.stats() if hasattr(embedding_model, "stats") else None,
+            "completion_cache": completion_cache.stats(),
+            "diagrams": diagram_stats.stats(),
+            "diagram_render": render_stats.stats(),
+            "guideline_indexes": corpora_stats(),
+            "models": registry.stats(),
+            "prompt_budget": prompt_budget.stats(),
+            "render_cache": render_cache.stats(),
+            "retrieval_cache": retrieval_cache.stats(),
+            "single_flight": {
+                "agent": agent_flight.stats(),
+                "diagrams": diagram_flight.stats(),
+                "summaries": summary_flight.stats(),
+            },
+            "token_usage": token_usage.stats(),
+        }, status=status.HTTP_200_OK)
@@ -1,7 +1,8 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from drf_spectacular.utils import extend_schema, OpenApiExample, OpenApiResponse
 from rest_framework.response import Response
-from rest_framework.views import APIView
+from adrf.views import APIView
 from rest_framework import status
 from markdown import markdown
 from atlassian import Confluence
@@ -68,7 +69,7 @@ class ConfluenceApiView(APIView):
             representation='storage'
         )
 
-    def _generate_confluence_html(self, responses, token: str) -> str:
+    def _generate_confluence_html(self, responses, mermaid_image: MermaidImage | None, token: str) -> str:
         """Generate HTML content for Confluence with responses and diagrams."""
         sections = {
             1: "1. Общее описание проекта",
@@ -90,8 +91,7 @@ class ConfluenceApiView(APIView):
                     """
 
         # Add diagram section
-        try:
-            mermaid_image = MermaidImage.objects.get(token=token)
+        if mermaid_image is not None:
             images_b64 = mermaid_image.images_b64 or {}
             if images_b64:
                 html_content += '<h2>Mermaid Диаграммы</h2>'
@@ -102,7 +102,7 @@ class ConfluenceApiView(APIView):
                         """
             else:
                 logger.info(f"No diagrams found for token {token}")
-        except MermaidImage.DoesNotExist:
+        else:
             logger.info(f"No MermaidImage found for token {token}")
 
         return html_content
@@ -248,23 +248,25 @@ class ConfluenceApiView(APIView):
             )
         }
     )
-    def post(self, request):
+    async def post(self, request):
         # Validate token
         token = request.data.get('token')
         if not token:
             return Response(self.ERROR_MISSING_TOKEN, status=status.HTTP_400_BAD_REQUEST)
 
-        # Initialize Confluence client
-        confluence = self._get_confluence_client()
+        # Initialize Confluence client (atlassian-python-api is blocking, so it runs in a worker thread)
+        confluence = await sync_to_async(self._get_confluence_client, thread_sensitive=False)()
         if not confluence:
             return Response(self.ERROR_CONFLUENCE_CONFIG, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         # Fetch agent responses
-        responses = AgentResponse.objects.filter(token=token, agent_id__in=[1, 2, 3, 4]).order_by('agent_id', '-created_at').distinct('agent_id')
+        responses = [resp async for resp in AgentResponse.objects.filter(
+            token=token, agent_id__in=[1, 2, 3, 4]).order_by('agent_id', '-created_at').distinct('agent_id')]
+        mermaid_image = await MermaidImage.objects.filter(token=token).afirst()
 
         # Generate HTML content with diagrams
         try:
-            html_content = self._generate_confluence_html(responses, token)
+            html_content = self._generate_confluence_html(responses, mermaid_image, token)
         except Exception as e:
             logger.exception(f"Error generating HTML content: {e}")
             return Response(self.ERROR_SERVER, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -272,11 +274,13 @@ class ConfluenceApiView(APIView):
         # Create or update Confluence page
         try:
             page_title = f"Техническое задание [token: {token}]"
-            result = self._create_or_update_page(confluence, page_title, html_content)
+            result = await sync_to_async(self._create_or_update_page, thread_sensitive=False)(
+                confluence, page_title, html_content)
             page_url = f"{self.confluence_url}{result['_links']['webui']}"
 
             page_id = result['id']
-            rendered = confluence.get_page_by_id(page_id, expand="body.view")
+            rendered = await sync_to_async(confluence.get_page_by_id, thread_sensitive=False)(
+                page_id, expand="body.view")
             html_view = rendered["body"]["view"]["value"]
 
             return Response({'page_url': page_url, 'page_id': page_id, 'html': html_view}, status=status.HTTP_200_OK)
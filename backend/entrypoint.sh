@@ -3,5 +3,6 @@
 python manage.py makemigrations chat
 python manage.py makemigrations mermaid
 python manage.py migrate
+python manage.py build_guideline_index
 
 exec "$@"
\ No newline at end of file
@@ -75,6 +75,8 @@ REST_FRAMEWORK = {
 }
 
 INSTALLED_APPS = [
+    # Заменяет runserver на ASGI-сервер (fort/asgi.py), нужен для потоковых ответов
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -84,6 +86,7 @@ INSTALLED_APPS = [
     'chat.apps.ChatConfig',
     'mermaid.apps.MermaidConfig',
     'confluence.apps.ConfluenceConfig',
+    'guidelines.apps.GuidelinesConfig',
     'rest_framework',
     'drf_spectacular',
     'corsheaders',
@@ -120,6 +123,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'fort.wsgi.application'
+ASGI_APPLICATION = 'fort.asgi.application'
 
 
 # Database
@@ -142,6 +146,11 @@ CONFLUENCE_USERNAME = env('CONFLUENCE_USERNAME')
 CONFLUENCE_API_TOKEN = env('CONFLUENCE_API_TOKEN')
 CONFLUENCE_SPACE_KEY = env('CONFLUENCE_SPACE_KEY')
 
+#MODELS
+
+# Загружать эмбеддинги и LLM-клиент при старте процесса, а не на первом запросе
+PRELOAD_MODELS = env.bool('PRELOAD_MODELS', default=False)
+
 
 
 # Password validation
@@ -18,20 +18,26 @@ from django.contrib import admin
 from django.urls import path
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
-from chat.views import ChatAPIView
+from chat.views import ChatAPIView, ChatStreamView, ChatStatsAPIView
 from chat.mock import ChatMockAPIView
 from mermaid.views import MermaidAPIView
 from mermaid.mock import MermaidMockAPIView
 from confluence.views import ConfluenceApiView
+from guidelines.views import GuidelineListAPIView, GuidelineDetailAPIView, GuidelineJobAPIView
 
 urlpatterns = [
        path('admin/', admin.site.urls),
        path('api/v1/chat/<int:agent_id>', ChatAPIView.as_view()),
+       path('api/v1/chat/<int:agent_id>/stream', ChatStreamView.as_view()),
+       path('api/v1/chat/stats', ChatStatsAPIView.as_view()),
        path('api/v1/mermaid', MermaidAPIView.as_view()),
 
        path('api/v1/mermaid/mock', MermaidMockAPIView.as_view()),
        path('api/v1/chat/<int:agent_id>/mock', ChatMockAPIView.as_view()),
        path('api/v1/create-confluence-tz/', ConfluenceApiView.as_view(), name='create-confluence-tz'),
+       path('api/v1/guidelines', GuidelineListAPIView.as_view()),
+       path('api/v1/guidelines/jobs/<str:job_id>', GuidelineJobAPIView.as_view()),
+       path('api/v1/guidelines/<str:doc_id>', GuidelineDetailAPIView.as_view()),
 
        path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
        path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='docs'),
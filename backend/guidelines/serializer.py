@@ -0,0 +1,29 @@
+from rest_framework import serializers
+
+from utils.guideline_index import SUPPORTED_EXTENSIONS, DEFAULT_NAMESPACE, NAMESPACE_RE
+
+
+class GuidelineUploadSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    doc_id = serializers.CharField(required=False, max_length=200)
+    namespace = serializers.RegexField(NAMESPACE_RE, required=False, default=DEFAULT_NAMESPACE)
+
+    def validate(self, attrs):
+        doc_id = attrs.get('doc_id') or attrs['file'].name
+        if not doc_id.lower().endswith(SUPPORTED_EXTENSIONS):
+            raise serializers.ValidationError(
+                f'Unsupported document type, expected one of {", ".join(SUPPORTED_EXTENSIONS)}')
+        if doc_id in ('.', '..') or '/' in doc_id or '\\' in doc_id:
+            raise serializers.ValidationError('Invalid doc_id')
+        attrs['doc_id'] = doc_id
+        return attrs
+
+
+class GuidelineJobSerializer(serializers.Serializer):
+    id = serializers.CharField()
+    action = serializers.CharField()
+    doc_id = serializers.CharField()
+    namespace = serializers.CharField()
+    status = serializers.CharField()
+    version = serializers.CharField(allow_null=True)
+    error = serializers.CharField(allow_null=True)
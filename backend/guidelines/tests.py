@@ -0,0 +1,279 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from unittest import mock
+
+from django.test import SimpleTestCase
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from utils import context_selection, guideline_index
+from utils.prompt_budget import Tokenizer
+from utils.retrieval_cache import embedding_cache, retrieval_cache
+
+
+class HashEmbeddings(Embeddings):
+    """Детерминированные векторы по хэшу текста — без загрузки модели."""
+    model_name = "test-hash-embeddings"
+
+    def embed_query(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], "little")
+        return np.random.default_rng(seed).random(8).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class GuidelineCorpusTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.index_dir = f"{self.tmp}/index"
+        self.seed_path = f"{self.tmp}/tz_guidelines.txt"
+        self.embeddings = HashEmbeddings()
+        # Общий на процесс реестр корпусов не должен переживать тест
+        self.addCleanup(guideline_index._corpora.clear)
+
+    def write_seed(self, text: str) -> None:
+        with open(self.seed_path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def get_corpus(self):
+        return guideline_index.get_corpus(self.embeddings, self.index_dir, seed_doc_path=self.seed_path)
+
+
+class GetCorpusTests(GuidelineCorpusTestCase):
+    def test_edited_seed_document_is_reingested(self):
+        self.write_seed("Раздел 1. Цели проекта должны быть измеримы.")
+        corpus = self.get_corpus()
+        version, _ = corpus.snapshot()
+
+        self.assertEqual(self.get_corpus().snapshot()[0], version)
+
+        self.write_seed("Раздел 1. Цели проекта должны быть измеримы и согласованы с заказчиком.")
+        new_version, vs = self.get_corpus().snapshot()
+        self.assertNotEqual(new_version, version)
+        self.assertIn("согласованы с заказчиком", vs.similarity_search("цели", k=1)[0].page_content)
+
+    def test_missing_seed_document_keeps_existing_corpus(self):
+        self.write_seed("Раздел 1. Цели проекта.")
+        version = self.get_corpus().snapshot()[0]
+        guideline_index._corpora.clear()
+
+        os.remove(self.seed_path)
+        self.assertEqual(self.get_corpus().snapshot()[0], version)
+
+
+class NamespaceTests(GuidelineCorpusTestCase):
+    def team_corpus(self, namespace: str, text: str):
+        path = os.path.join(self.tmp, f"{namespace}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        corpus = guideline_index.get_corpus(self.embeddings, self.index_dir, seed_doc_path=self.seed_path,
+                                            namespace=namespace)
+        corpus.ingest(f"{namespace}.txt", path)
+        return corpus
+
+    def test_namespace_names_are_validated(self):
+        self.assertEqual(guideline_index.validate_namespace("team-a_1"), "team-a_1")
+        for name in ("", "../default", "команда", "a" * 65):
+            with self.subTest(name), self.assertRaises(ValueError):
+                guideline_index.validate_namespace(name)
+        with self.assertRaises(ValueError):
+            guideline_index.namespace_dir(self.index_dir, "../default")
+
+        self.assertEqual(guideline_index.namespace_dir(self.index_dir), self.index_dir)
+        self.assertEqual(guideline_index.namespace_dir(self.index_dir, "team"), f"{self.index_dir}/ns/team")
+
+    def test_namespaces_have_separate_documents(self):
+        self.write_seed("Раздел 1. Общие рекомендации.")
+        default = self.get_corpus()
+        team = self.team_corpus("team", "Рекомендации команды платежей.")
+        os.makedirs(f"{self.index_dir}/ns/bad name")
+
+        self.assertEqual(guideline_index.list_namespaces(self.index_dir), ["default", "team"])
+        self.assertEqual(list(default.documents()), ["tz_guidelines.txt"])
+        self.assertEqual(list(team.documents()), ["team.txt"])
+        # Сид загружается только в пространство по умолчанию
+        self.assertEqual(self.team_corpus("other", "Прочее.").documents().keys(), {"other.txt"})
+
+    def test_least_recently_used_indexes_are_unloaded_over_budget(self):
+        corpora = [self.team_corpus(name, f"Рекомендации команды {name}.") for name in ("a", "b", "c")]
+        for corpus in corpora:
+            corpus.snapshot()
+        size_mb = corpora[0].memory_bytes() / 1024 / 1024
+        self.assertGreater(size_mb, 0)
+
+        guideline_index._enforce_memory_budget(keep=corpora[0].root, budget_mb=2 * size_mb)
+        self.assertEqual([corpus.is_loaded() for corpus in corpora], [True, False, True])
+
+        guideline_index._enforce_memory_budget(keep=corpora[2].root, budget_mb=0)
+        self.assertEqual([corpus.is_loaded() for corpus in corpora], [False, False, True])
+
+        # Выгруженный индекс загружается с диска при следующем обращении
+        _, vs = corpora[1].snapshot()
+        self.assertIsNotNone(vs)
+        self.assertIn("Рекомендации команды b.", vs.similarity_search("b", k=1)[0].page_content)
+
+
+class LoadDocxTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def save(self, document) -> str:
+        path = os.path.join(self.tmp, "guidelines.docx")
+        document.save(path)
+        return path
+
+    def test_sections_follow_styled_and_bold_numbered_headings(self):
+        import docx
+
+        document = docx.Document()
+        document.add_paragraph("Вводный абзац.")
+        document.add_paragraph().add_run("1. Что должно быть в ТЗ?").bold = True
+        document.add_paragraph().add_run("a. Цели проекта").bold = True
+        document.add_paragraph("Цели формулируются измеримо.")
+        document.add_paragraph().add_run("b. Требования к продукту").bold = True
+        document.add_heading("Функциональные  требования", level=3)
+        document.add_paragraph("2. Нумерованный, но не жирный абзац остаётся текстом.")
+        document.add_paragraph().add_run("2. Частые ошибки").bold = True
+        document.add_paragraph("Размытые формулировки.")
+
+        sections = guideline_index.load_docx(self.save(document))
+
+        self.assertEqual([section.metadata["heading"] for section in sections], [
+            "",
+            "1. Что должно быть в ТЗ?",
+            "1. Что должно быть в ТЗ? > a. Цели проекта",
+            "1. Что должно быть в ТЗ? > b. Требования к продукту",
+            "1. Что должно быть в ТЗ? > b. Требования к продукту > Функциональные требования",
+            "2. Частые ошибки",
+        ])
+        self.assertEqual([section.metadata["section"] for section in sections], list(range(6)))
+        self.assertEqual(sections[2].page_content, "a. Цели проекта\n\nЦели формулируются измеримо.")
+        self.assertIn("2. Нумерованный, но не жирный абзац", sections[4].page_content)
+
+    def test_tables_are_kept_in_section_text_row_by_row(self):
+        import docx
+
+        document = docx.Document()
+        document.add_heading("Роли", level=1)
+        table = document.add_table(rows=3, cols=2)
+        for row, cells in zip(table.rows, [("Роль", "Права"), ("Администратор", "Всё"), ("Гость", "")]):
+            for cell, text in zip(row.cells, cells):
+                cell.text = text
+        merged = document.add_table(rows=1, cols=3)
+        merged.cell(0, 0).merge(merged.cell(0, 1)).text = "Объединённая"
+        merged.cell(0, 2).text = "Ячейка"
+        document.add_paragraph("После таблицы.")
+
+        [section] = guideline_index.load_docx(self.save(document))
+
+        self.assertEqual(section.page_content, "Роли\n\nРоль | Права\nАдминистратор | Всё\nГость"
+                                               "\n\nОбъединённая | Ячейка\n\nПосле таблицы.")
+
+
+class JobTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(guideline_index, "_jobs", guideline_index.OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_job(self, corpus_factory) -> dict:
+        job_id = guideline_index.submit_job(corpus_factory, "ingest", "doc.txt", "doc.txt")
+        guideline_index._ingest_executor.submit(lambda: None).result(timeout=5)
+        return guideline_index.get_job(job_id)
+
+    def test_job_reports_version_or_error(self):
+        corpus = mock.Mock(**{"ingest.return_value": "v1"})
+        self.assertEqual(self.run_job(lambda: corpus)["version"], "v1")
+
+        corpus.ingest.side_effect = ValueError("broken docx")
+        with self.assertLogs("utils.guideline_index", level="ERROR"):
+            job = self.run_job(lambda: corpus)
+        self.assertEqual((job["status"], job["error"]), ("failed", "broken docx"))
+
+    def test_only_recent_finished_jobs_are_kept(self):
+        corpus = mock.Mock(**{"ingest.return_value": "v1"})
+        with mock.patch.object(guideline_index, "FINISHED_JOBS_KEPT", 2):
+            jobs = [self.run_job(lambda: corpus)["id"] for _ in range(4)]
+
+        self.assertEqual([job["id"] for job in guideline_index.list_jobs()], jobs[2:])
+        self.assertIsNone(guideline_index.get_job(jobs[0]))
+
+
+class FixedEmbeddings(Embeddings):
+    """Заранее заданные векторы для известных текстов."""
+    model_name = "test-fixed-embeddings"
+
+    def __init__(self, vectors: dict):
+        self.vectors = vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = np.asarray(self.vectors[text], dtype=np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class SelectContextTests(SimpleTestCase):
+    QUERY = "цели проекта"
+
+    def setUp(self):
+        # Токены считаются приближённо, без загрузки токенизатора
+        patcher = mock.patch.object(context_selection, "count_tokens", Tokenizer().count)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for cache in (embedding_cache, retrieval_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def make_store(self, chunks: list[tuple[str, str, list[float]]]) -> FAISS:
+        """chunks — (источник, текст, вектор); запрос направлен по первой оси."""
+        embeddings = FixedEmbeddings({self.QUERY: [1, 0, 0], **{text: vector for _, text, vector in chunks}})
+        return FAISS.from_texts([text for _, text, _ in chunks], embeddings,
+                                metadatas=[{"source": source} for source, _, _ in chunks])
+
+    def select(self, vs: FAISS, **kwargs) -> list:
+        return context_selection.select_context(vs, self.QUERY, "v1", **{"fetch_k": 10, **kwargs})
+
+    def test_mmr_prefers_diverse_chunk_over_near_duplicate(self):
+        best = "Цели проекта должны быть измеримыми и согласованными с заказчиком."
+        duplicate = "Цели проекта должны быть измеримы и согласованы со всеми заказчиками."
+        diverse = "Для каждой цели указывается срок достижения и ответственный за неё."
+        vs = self.make_store([("a.docx", best, [0.95, 0.31, 0]), ("b.docx", duplicate, [0.94, 0.34, 0]),
+                              ("c.docx", diverse, [0.8, 0, 0.6])])
+        budget = 2 * Tokenizer().count(best) + 1
+
+        self.assertEqual([doc.page_content for doc in self.select(vs, budget=budget, lambda_mult=0.5)],
+                         [best, diverse])
+        # Только релевантность: почти дубль ближе к запросу, чем другой по смыслу фрагмент
+        self.assertEqual([doc.page_content for doc in self.select(vs, budget=budget, lambda_mult=1.0)],
+                         [best, duplicate])
+
+    def test_overlapping_chunks_of_one_document_are_merged(self):
+        shared = "общий кусок текста на границе соседних фрагментов"
+        left = "Требования к системе описываются списком, " + shared
+        right = shared + ", после чего приводятся ограничения."
+        vs = self.make_store([("a.docx", left, [0.9, 0.44, 0]), ("a.docx", right, [0.85, 0, 0.53])])
+
+        [span] = self.select(vs, budget=1000, lambda_mult=1.0)
+        self.assertEqual(span.page_content, left + ", после чего приводятся ограничения.")
+        self.assertEqual(span.metadata["chunks"], 2)
+
+    def test_same_text_from_other_document_is_not_merged(self):
+        text = "Пользователи системы перечисляются с указанием их ролей и прав доступа."
+        vs = self.make_store([("a.docx", text, [0.9, 0.44, 0]), ("b.docx", text + " ", [0.85, 0, 0.53])])
+
+        self.assertEqual([doc.metadata["source"] for doc in self.select(vs, budget=1000)], ["a.docx", "b.docx"])
+
+    def test_most_relevant_chunk_is_kept_when_nothing_fits_budget(self):
+        best = "Цели проекта должны быть измеримыми и согласованными с заказчиком."
+        vs = self.make_store([("a.docx", best, [1, 0.1, 0]), ("b.docx", "Другой фрагмент рекомендаций.", [0, 1, 0])])
+
+        self.assertEqual([doc.page_content for doc in self.select(vs, budget=1)], [best])
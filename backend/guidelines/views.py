@@ -0,0 +1,114 @@
+import logging
+
+from adrf.views import APIView
+from asgiref.sync import sync_to_async
+from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
+from rest_framework import status
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
+
+from guidelines.serializer import GuidelineUploadSerializer, GuidelineJobSerializer
+from utils.cpu_pool import run_cpu
+from utils.guideline_index import (
+    default_corpus, store_document, submit_job, get_job, list_jobs, list_namespaces, validate_namespace,
+    DEFAULT_NAMESPACE
+)
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE_PARAMETER = OpenApiParameter(
+    name='namespace',
+    type=str,
+    location=OpenApiParameter.QUERY,
+    description='Пространство имён корпуса рекомендаций (по умолчанию default)',
+    required=False,
+)
+
+
+def _namespace(request) -> str:
+    return validate_namespace(request.query_params.get('namespace') or DEFAULT_NAMESPACE)
+
+
+class GuidelineListAPIView(APIView):
+    parser_classes = [MultiPartParser]
+
+    @extend_schema(
+        summary='Документы корпуса рекомендаций ТЗ',
+        description='Текущая версия индекса рекомендаций пространства имён, документы в нём, '
+                    'список пространств имён и фоновые задачи загрузки.',
+        parameters=[NAMESPACE_PARAMETER],
+        responses={200: OpenApiResponse(description='Состояние корпуса')},
+    )
+    async def get(self, request):
+        try:
+            namespace = _namespace(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if namespace not in list_namespaces():
+            return Response({'error': 'Unknown guidelines namespace'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Первое обращение загружает модель эмбеддингов и индекс — не в event loop
+        corpus = await run_cpu(default_corpus, namespace)
+        version, _ = corpus.snapshot()
+        documents = {
+            doc_id: {'sha256': document['sha256'], 'chunks': len(document['chunk_ids'])}
+            for doc_id, document in corpus.documents().items()
+        }
+        return Response({
+            'namespace': namespace,
+            'namespaces': list_namespaces(),
+            'version': version,
+            'documents': documents,
+            'jobs': list_jobs(),
+        }, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        summary='Загрузка документа с рекомендациями ТЗ',
+        description="""
+        Добавляет документ (docx, markdown, txt, pdf) в корпус рекомендаций критика или заменяет документ
+        с тем же doc_id. Корпус выбирается полем namespace; новое пространство имён создаётся первой загрузкой. Нарезка и эмбеддинг идут в фоне: эмбеддятся только новые фрагменты, после чего
+        критик атомарно переключается на новую версию индекса. Статус — GET /api/v1/guidelines/jobs/<job_id>.
+        """,
+        request={'multipart/form-data': GuidelineUploadSerializer},
+        responses={202: GuidelineJobSerializer, 400: OpenApiResponse(description='Некорректный файл')},
+    )
+    async def post(self, request):
+        serializer = GuidelineUploadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        doc_id = serializer.validated_data['doc_id']
+        namespace = serializer.validated_data['namespace']
+        path = await sync_to_async(store_document, thread_sensitive=False)(
+            doc_id, serializer.validated_data['file'], namespace=namespace)
+        job_id = submit_job(lambda: default_corpus(namespace), 'ingest', doc_id, path, namespace=namespace)
+        logger.info(f'Guideline document {doc_id} queued for ingestion (job {job_id})')
+        return Response(get_job(job_id), status=status.HTTP_202_ACCEPTED)
+
+
+class GuidelineDetailAPIView(APIView):
+    @extend_schema(
+        summary='Удаление документа из корпуса рекомендаций ТЗ',
+        description='Удаляет фрагменты документа из индекса по их ID (в фоне) и переключает критика на новую версию.',
+        parameters=[NAMESPACE_PARAMETER],
+        responses={202: GuidelineJobSerializer},
+    )
+    async def delete(self, request, doc_id: str):
+        try:
+            namespace = _namespace(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        job_id = submit_job(lambda: default_corpus(namespace), 'remove', doc_id, namespace=namespace)
+        return Response(get_job(job_id), status=status.HTTP_202_ACCEPTED)
+
+
+class GuidelineJobAPIView(APIView):
+    @extend_schema(
+        summary='Статус фоновой задачи корпуса рекомендаций',
+        responses={200: GuidelineJobSerializer, 404: OpenApiResponse(description='Задача не найдена')},
+    )
+    async def get(self, request, job_id: str):
+        job = get_job(job_id)
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job, status=status.HTTP_200_OK)
@@ -1,3 +1,521 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from utils import mermaid_renderer, render_cache as render_cache_module
+from utils.diagram_stats import render_stats
+from utils.mermaid_renderer import extract_candidates, normalize_mermaid, render_candidates, render_key
+from utils.mermaid_validator import diagram_type, validate_mermaid
+from utils.render_cache import RenderCache
+from utils.sanitize_mermaid_code import sanitize_mermaid_code
+
+# Диаграммы в том виде, в каком их генерируют агенты пайплайна
+DFD = """graph TD
+    User[Пользователь] -->|Заявка на ремонт| Service((Обработка заявки))
+    Service -->|Статус| DB[[База данных]]
+    DB -->|Отчёт| Manager(Руководитель) %% ответ уходит руководителю
+"""
+USE_CASE = """%%{ init: {'theme': 'default'} }%%
+graph TD
+    C[Customer] --> Login
+    Login -->|<<include>>| Authenticate
+    subgraph MySystem
+        Login
+        Purchase
+    end
+"""
+ACTIVITY = """flowchart TB
+    start([Start])
+    task1["Получить запрос (API)"]
+    decision{"Валидны ли данные?"}
+    task2["Сохранить в БД"]
+    task3["Вернуть ошибку"]
+    endNode([End])
+
+    start --> task1 --> decision
+    decision -- Yes --> task2 --> endNode
+    decision -- No --> task3 --> endNode
+"""
+C4 = """C4Context
+  title Интернет-магазин
+  Person(customer, "Customer")
+  System_Boundary(OnlineStore, "Online Store") {
+    System(webApp, "Web Application")
+  }
+  System_Ext(paymentSvc, "Payment Gateway")
+
+  Rel(customer, webApp, "Places orders via web UI")
+  Rel(webApp, paymentSvc, "Requests payment", "REST/JSON")
+"""
+ER = """erDiagram
+    Customer {
+        id INT PK
+        name VARCHAR(255) "Имя, 100%% заполнено"
+        email VARCHAR
+    }
+    Order {
+        id INT PK
+        customerId INT FK
+        total DECIMAL(10,2)
+    }
+    Customer ||--o{ Order : "places"
+"""
+
+# Ответы модели из примеров в utils/sanitize_mermaid_code.py и результат их очистки
+DFD_FENCED = """
+ ```mermaid
+graph TD
+    Client[Client] --> |Create Repair Request| ServiceEngineer((Service Engineer))
+    ServiceEngineer --> |Assign Task| Technician((Technician))
+    Technician --> |Perform Repair| Equipment[Equipment]
+    Equipment --> |Update Status| Database[[Database]]
+    Database --> |Generate Report| DepartmentManager(Department Manager)
+    DepartmentManager --> |Approve Expenses| FinanceDepartment(Finance Department)
+    FinanceDepartment --> |Analyze Costs| ITSupportTeam(IT Support Team)
+    ITSupportTeam --> |Monitor System| SystemAdministrator(System Administrator)
+    SystemAdministrator --> |Manage Access Rights| Client
+```
+"""
+ACTIVITY_BARE = """Конечно! Вот пример того, как можно создать диаграмму активности в формате Mermaid.js для вашего технического задания:
+
+mermaid
+flowchart TB
+    start([Начало])
+    task1["Обработка запроса пользователя"]
+    decision{"Запрос корректен?"}
+    task2["Проверка данных"]
+    task3["Сохранение в базу данных"]
+    task4["Отправка уведомления"]
+    fork1{Параллельная обработка}
+    join1{Объединение потоков}
+    task5["Формирование отчета"]
+    end1([Конец])
+
+    start --> task1
+    task1 --> decision
+    decision -- Да --> task2
+    decision -- Нет --> task3
+    task2 --> fork1
+    fork1 --> task4 & task5
+    task4 --> join1
+    task5 --> join1
+    join1 --> end1
+
+
+Этот код создает диаграмму активности, которая включает в себя обработку запроса пользователя, проверку его корректности, сохранение данных в базе, отправку уведомления и формирование отчета. Параллельное выполнение задач показано через использование операторов fork и join."""
+DFD_WITH_COMMENTS = """
+      ```mermaid
+        graph TD
+
+        // Внешние сущности
+        User[User]
+        Client[Client]
+
+        // Процессы
+        Process(Создание заявки на ремонт)
+        Process(Отслеживание статуса заявки)
+        Process(Выполнение ремонтных работ)
+        Process(Закрытие заявки)
+        Process(Аналитика и отчетность)
+
+        // Хранилища данных
+        DB[[База данных]]
+
+        // Потоки данных
+        User -->|Заявка на ремонт| Client
+        Client -->|Статус заявки| Process
+        Client -->|Информация о ремонте| Process
+        Client -->|Уведомление об окончании ремонта| Process
+        Client -->|Отчеты| Process
+
+        // Стрелки
+        A -->|Данные| B
+        ```
+"""
+USE_CASE_UNSUPPORTED = """
+         ```mermaid
+            usecaseDiagram
+                actor Customer as C
+                Customer — (Login)
+                (Login) --›|(includes authentication)| (Authenticate)
+                rectangle MySystem { (Login) (Purchase) }
+        ```
+"""
+ACTIVITY_END_NODE = """
+         Конечно! Вот пример реализации твоего запроса:
+
+        ```mermaid
+        flowchart TB
+          start[Начало]
+
+          task1["Получить запрос от пользователя"]
+          decision{"Проверить валидность данных?"}
+
+          task2["Обработать запрос"]
+          task3["Отправить ответ пользователю"]
+
+          join[Завершение]
+
+          start --> task1 --> decision
+          decision -- Валидно --> task2 --> task3 --> join
+          decision -- Невалидно --> task1 --> end
+
+          end[Конец]
+        ```
+
+        Этот код создаст диаграмму деятельности в стиле BPMN с начальной и конечной точками, а также с действиями для обработки запроса.
+"""
+C4_IN_PROSE = """
+         Для того чтобы создать C4-модель в формате Mermaid.js на основе предоставленного тобой текста технического задания, нужно выделить основные элементы модели и их взаимосвязи. Вот как это может выглядеть:
+
+        ```mermaid
+        C4Context
+          Person(customer, "Customer")
+          System_Boundary(OnlineStore, "Online Store") {
+            System(webApp, "Web Application")
+          }
+          System_Ext(paymentSvc, "Payment Gateway")
+
+          Rel(customer, webApp, "Places orders via web UI")
+          Rel(webApp, paymentSvc, "Requests payment", "REST/JSON")
+        ```
+
+        Этот код создаёт основную систему `OnlineStore`, включает в неё подсистему `webApp` и указывает на внешнюю систему `paymentSvc`. Также он показывает связь между `customer` (внешний участник) и `webApp` через размещение заказов (`Places orders via web UI`). Кроме того, указывается взаимодействие между `webApp` и `paymentSvc` для запроса оплаты через REST/JSON протокол.
+"""
+ER_TWO_BLOCKS = """
+        Для того чтобы сгенерировать ER-диаграмму в формате Mermaid.js, необходимо следовать следующим шагам:
+
+        1. **Выделение сущностей и атрибутов**:
+           - **Customer**:
+             - `PK id INT`
+             - `name VARCHAR`
+             - `email VARCHAR`
+           - **Order**:
+             - `PK id INT`
+             - `FK customerId INT`
+             - `orderDate DATE`
+
+        2. **Определение связей с кардинальностями**:
+           - Связь между `Customer` и `Order`: `Customer ||--o{ Order : "places"` (где `places` означает, что один клиент может разместить много заказов).
+
+        Вот как это будет выглядеть в виде кода для Mermaid.js:
+
+        ```mermaid
+        erDiagram
+          Customer {
+            PK id INT,
+            name VARCHAR,
+            email VARCHAR
+          }
+          Order {
+            PK id INT,
+            FK customerId INT,
+            orderDate DATE
+          }
+          Customer ||--o{ Order : "places"
+        ```
+
+        Этот код создаст следующую ER-диаграмму:
+
+        ```mermaid
+        Customer
+          * PK id INT
+          * name VARCHAR
+          * email VARCHAR
+        Order
+          * PK id INT
+          * FK customerId INT
+          * orderDate DATE
+        Customer --o{ Order : "places"
+        ```
+"""
+SANITIZED = {
+    DFD_FENCED: """graph TD
+Client[Client] --> |Create Repair Request| ServiceEngineer((Service Engineer))
+ServiceEngineer --> |Assign Task| Technician((Technician))
+Technician --> |Perform Repair| Equipment[Equipment]
+Equipment --> |Update Status| Database[[Database]]
+Database --> |Generate Report| DepartmentManager(Department Manager)
+DepartmentManager --> |Approve Expenses| FinanceDepartment(Finance Department)
+FinanceDepartment --> |Analyze Costs| ITSupportTeam(IT Support Team)
+ITSupportTeam --> |Monitor System| SystemAdministrator(System Administrator)
+SystemAdministrator --> |Manage Access Rights| Client""",
+    ACTIVITY_BARE: """flowchart TB
+start([Начало])
+decision{Запрос корректен?}
+fork1{Параллельная обработка}
+join1{Объединение потоков}
+end1([Конец])
+start --> task1
+task1 --> decision
+decision -- Да --> task2
+decision -- Нет --> task3
+task2 --> fork1
+fork1 --> task4 & task5
+task4 --> join1
+task5 --> join1
+join1 --> end1""",
+    DFD_WITH_COMMENTS: """graph TD
+Process(Создание заявки на ремонт)
+Process(Отслеживание статуса заявки)
+Process(Выполнение ремонтных работ)
+Process(Закрытие заявки)
+Process(Аналитика и отчетность)
+DB[[База данных]]
+User -->|Заявка на ремонт| Client
+Client -->|Статус заявки| Process
+Client -->|Информация о ремонте| Process
+Client -->|Уведомление об окончании ремонта| Process
+Client -->|Отчеты| Process
+A -->|Данные| B""",
+    USE_CASE_UNSUPPORTED: """Customer — (Login)
+(Login) --›|(includes authentication)| (Authenticate)
+rectangle MySystem { (Login) (Purchase) }""",
+    ACTIVITY_END_NODE: """flowchart TB
+decision{Проверить валидность данных?}
+start --> task1 --> decision
+decision -- Валидно --> task2 --> task3 --> join
+decision -- Невалидно --> task1 --> end""",
+    C4_IN_PROSE: """Person(customer, Customer)
+System_Boundary(OnlineStore, Online Store) {
+System(webApp, Web Application)
+}
+System_Ext(paymentSvc, Payment Gateway)
+Rel(customer, webApp, Places orders via web UI)
+Rel(webApp, paymentSvc, Requests payment, REST/JSON)""",
+    ER_TWO_BLOCKS: """erDiagram
+Customer {
+}
+Order {
+}
+Customer ||--o{ Order : places""",
+}
+
+
+class ValidateMermaidTests(SimpleTestCase):
+    def test_agent_diagrams_are_valid(self):
+        for name, code in {"dfd": DFD, "use case": USE_CASE, "activity": ACTIVITY, "c4": C4, "er": ER}.items():
+            with self.subTest(name):
+                self.assertEqual(validate_mermaid(code), [])
+
+    def test_diagram_type(self):
+        self.assertEqual(diagram_type(DFD), "flowchart")
+        self.assertEqual(diagram_type(USE_CASE), "flowchart")
+        self.assertEqual(diagram_type(ER), "er")
+        self.assertEqual(diagram_type(C4), "c4")
+        self.assertEqual(diagram_type("sequenceDiagram\n    A->>B: Hi"), "other")
+        self.assertIsNone(diagram_type("Вот ваша диаграмма"))
+
+    def test_trailing_comment_is_ignored(self):
+        self.assertEqual(validate_mermaid("graph TD %% заголовок\n    A --> B %% note"), [])
+        self.assertEqual(validate_mermaid('graph TD\n    A["50%% готово"] --> B'), [])
+
+    def test_unmodeled_syntax_is_left_to_renderer(self):
+        self.assertEqual(validate_mermaid("flowchart TD\n    A@{ shape: rect }\n    A --> B"), [])
+        self.assertEqual(validate_mermaid('flowchart TD\n    A@{\n      shape: rect\n      label: "Текст"\n    }\n'
+                                          '    A e1@--> B'), [])
+        # Строки после блока метаданных снова проверяются
+        self.assertEqual(validate_mermaid("flowchart TD\n    A@{\n      shape: rect\n    }\n    A --> "),
+                         ["line 5: link without target node: A -->"])
+
+    def test_unmodeled_syntax_is_sent_to_kroki(self):
+        valid, _, error, _ = render_candidates("test", "```mermaid\nflowchart TD\n    A@{ shape: rect } --> B\n```")
+        self.assertEqual(valid, ["flowchart TD\nA@{ shape: rect } --> B"])
+        self.assertIsNone(error)
+
+    def test_broken_flowchart(self):
+        code = """graph TD
+    A[Пользователь (клиент)] --> B
+    B --> C
+    C -->
+    end --> D
+    subgraph S
+        D
+"""
+        self.assertEqual(validate_mermaid(code), [
+            "line 2: brackets inside unquoted text of node 'A', wrap the text in double quotes: "
+            "A[Пользователь (клиент)] --> B",
+            "line 4: link without target node: C -->",
+            "line 5: 'end' is a reserved word and cannot be used as a node id: end --> D",
+            "line 6: 'subgraph' is not closed with 'end'",
+        ])
+
+    def test_broken_header(self):
+        self.assertEqual(validate_mermaid("graph DOWN\n    A --> B"),
+                         ["line 1: invalid flowchart header, expected 'graph TD' or 'flowchart TB': graph DOWN"])
+        self.assertEqual(validate_mermaid("Вот диаграмма:\ngraph TD"), [
+            "line 1: unknown diagram type, expected 'graph TD', 'flowchart TB', 'erDiagram' or 'C4Context': "
+            "Вот диаграмма:"])
+        self.assertEqual(validate_mermaid("  \n"), ["diagram is empty"])
+
+    def test_broken_er(self):
+        code = """erDiagram
+    Customer {
+        id INT PK,
+        name VARCHAR
+    }
+    Customer -- Order
+    Order {
+        id INT PK
+"""
+        self.assertEqual(validate_mermaid(code), [
+            "line 3: invalid attribute, expected 'type name [PK|FK|UK] [\"comment\"]' without trailing commas: "
+            "id INT PK,",
+            "line 6: invalid relationship, expected 'A ||--o{ B : label': Customer -- Order",
+            "line 7: entity block is not closed with '}'",
+        ])
+
+    def test_broken_c4(self):
+        code = """C4Context
+    Person(customer)
+    System_Boundary(store, "Store")
+    Container(app, "App") {
+    }
+    Rel(customer, app, "Uses)
+    Relation(customer, app, "Uses")
+"""
+        self.assertEqual(validate_mermaid(code), [
+            "line 2: 'Person' needs at least 2 arguments: Person(customer)",
+            "line 3: boundary 'System_Boundary' must be followed by '{': System_Boundary(store, \"Store\")",
+            "line 4: only boundaries can contain elements, 'Container' cannot: Container(app, \"App\") {",
+            "line 5: '}' without an open boundary",
+            "line 6: unclosed quote: Rel(customer, app, \"Uses)",
+            "line 7: unknown C4 element 'Relation': Relation(customer, app, \"Uses\")",
+        ])
+
+
+class ExtractCandidatesTests(SimpleTestCase):
+    def setUp(self):
+        render_stats.reset()
+        self.addCleanup(render_stats.reset)
+
+    def test_normalize_drops_line_endings_indentation_and_blank_lines(self):
+        self.assertEqual(normalize_mermaid("flowchart TD\r\n    A --> B\r\n\r\n\tB --> C  \r\n"),
+                         "flowchart TD\nA --> B\nB --> C")
+        # В mindmap вложенность задаётся отступами — снимается только общий
+        self.assertEqual(normalize_mermaid("\n  mindmap\n    root\n      child  \n"), "mindmap\n  root\n    child")
+
+    def test_sanitized_variants_are_deduplicated(self):
+        candidates, outputs = extract_candidates("```mermaid\r\nflowchart TD\r\n    A --> B\r\n\r\n    B --> C\r\n```")
+
+        self.assertEqual(candidates, ["flowchart TD\nA --> B\nB --> C"])
+        self.assertEqual(outputs, ["```mermaid\nflowchart TD\n    A --> B\n\n    B --> C\n```"] + candidates * 2)
+        self.assertEqual(render_stats.stats(), {"implausible": 1, "duplicates": 1})
+
+    def test_clean_code_gives_one_candidate(self):
+        candidates, outputs = extract_candidates("flowchart TD\n  A --> B\n")
+
+        self.assertEqual(candidates, ["flowchart TD\nA --> B"])
+        # Без markdown-блока sanitize_mermaid_code_2 ничего не возвращает — пустой результат не в счёт
+        self.assertEqual(outputs, candidates * 2)
+        self.assertEqual(render_stats.stats(), {"duplicates": 1})
+
+    def test_reply_without_diagram_gives_no_candidates(self):
+        self.assertEqual(extract_candidates("Не могу построить диаграмму."), ([], ["Не могу построить диаграмму."]))
+        self.assertEqual(render_stats.stats(), {"implausible": 1})
+
+        valid, _, error, error_code = render_candidates("test", "Не могу построить диаграмму.")
+        self.assertEqual(valid, [])
+        self.assertEqual(error_code, "Не могу построить диаграмму.")
+        self.assertTrue(error)
+
+
+class SanitizeMermaidCodeTests(SimpleTestCase):
+    def test_samples_match_previous_output(self):
+        for number, (code, expected) in enumerate(SANITIZED.items(), start=1):
+            with self.subTest(sample=number):
+                self.assertEqual(sanitize_mermaid_code(code), expected)
+
+    def test_empty_and_prose_only_replies(self):
+        self.assertEqual(sanitize_mermaid_code(""), "")
+        self.assertEqual(sanitize_mermaid_code("Диаграмма не нужна."), "")
+
+
+class RenderCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def make_cache(self, **kwargs):
+        return RenderCache(**{"max_memory_bytes": 1024, "directory": self.directory, "max_disk_bytes": 1024,
+                              "enabled": True, **kwargs})
+
+    def files(self) -> list[str]:
+        return sorted(os.listdir(self.directory))
+
+    def test_memory_evicts_least_recently_used_by_size(self):
+        cache = self.make_cache(max_memory_bytes=10, directory=None)
+        cache.set("a", b"aaaa")
+        cache.set("b", b"bbbb")
+        cache.get("a")
+        cache.set("c", b"cccc")
+
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (b"aaaa", None, b"cccc"))
+        stats = cache.stats()
+        self.assertEqual((stats["evictions"], stats["size"]), (1, 2))
+
+        # Картинка больше всего бюджета в память не попадает и ничего не вытесняет
+        cache.set("big", b"x" * 11)
+        self.assertIsNone(cache.get("big"))
+        self.assertEqual(cache.get("c"), b"cccc")
+
+    def test_disk_tier_is_shared_between_instances(self):
+        self.make_cache().set("key", b"png")
+        cache = self.make_cache()
+        self.assertEqual(cache.get("key"), b"png")
+        self.assertEqual(cache.get("key"), b"png")
+        stats = cache.stats()
+        self.assertEqual((stats["disk_hits"], stats["hits"], stats["misses"]), (1, 1, 0))
+
+    def test_disk_is_evicted_to_ninety_percent_of_budget(self):
+        cache = self.make_cache(max_memory_bytes=0, max_disk_bytes=100)
+        for number, key in enumerate(["k1", "k2", "k3"]):
+            cache.set(key, b"x" * 30)
+            # Явное время последнего чтения: k1 — самый давний
+            os.utime(os.path.join(self.directory, key), (1000 + number, 1000 + number))
+        cache.get("k1")  # чтение обновляет время, k1 становится самым свежим
+
+        cache.set("k4", b"x" * 30)
+
+        # 120 байт > 100: удаляются самые давние, пока не останется не больше 90
+        self.assertEqual(self.files(), ["k1", "k3", "k4"])
+        stats = cache.stats()
+        self.assertEqual((stats["disk_evictions"], stats["disk_mb"]), (1, round(90 / 1024 / 1024, 2)))
+
+    def test_disk_write_replaces_file_atomically(self):
+        cache = self.make_cache()
+        with mock.patch.object(render_cache_module.os, "replace", wraps=os.replace) as replace:
+            cache.set("key", b"png")
+        source, target = replace.call_args.args
+        self.assertTrue(source.endswith(".tmp"))
+        self.assertEqual(target, os.path.join(self.directory, "key"))
+        self.assertEqual(self.files(), ["key"])
+
+    def test_failed_disk_write_leaves_no_partial_file(self):
+        cache = self.make_cache(max_memory_bytes=0)
+        with self.assertLogs("utils.render_cache", level="WARNING"):
+            with mock.patch.object(render_cache_module.os, "replace", side_effect=OSError("disk full")):
+                cache.set("key", b"png")
+        self.assertEqual(self.files(), [])
+        self.assertIsNone(cache.get("key"))
+
+    def test_render_key_ignores_indentation_of_flowchart(self):
+        code = "graph TD\n    A[Клиент] --> B((Заявка))\n    B --> C[[БД]]\n"
+        reindented = "\n  graph TD\n\tA[Клиент] --> B((Заявка))\n\n        B --> C[[БД]]"
+        self.assertEqual(render_key(code), render_key(reindented))
+        self.assertNotEqual(render_key(code), render_key(code.replace("C[[БД]]", "D[[БД]]")))
+        self.assertNotEqual(render_key(code), render_key(code, output_format="svg"))
+
+    def test_sync_render_is_cached_and_bounded_by_timeout(self):
+        cache = self.make_cache()
+        response = mock.Mock(content=b"png")
+        with mock.patch.object(mermaid_renderer, "render_cache", cache), \
+                mock.patch.object(mermaid_renderer.requests, "post", return_value=response) as post:
+            self.assertEqual(mermaid_renderer.render_mermaid_to_png("graph TD\n    A --> B"), b"png")
+            self.assertEqual(mermaid_renderer.render_mermaid_to_png("graph TD\nA --> B"), b"png")
+        post.assert_called_once()
+        self.assertEqual(post.call_args.kwargs["timeout"],
+                         (mermaid_renderer.KROKI_CONNECT_TIMEOUT, mermaid_renderer.KROKI_READ_TIMEOUT))
@@ -1,70 +1,21 @@
 from django.http import JsonResponse
 from drf_spectacular.utils import extend_schema, OpenApiResponse, OpenApiExample
 from rest_framework.response import Response
-from rest_framework.views import APIView
+from adrf.views import APIView
 from rest_framework import status
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_gigachat.chat_models import GigaChat
 import logging
-import environ
-import base64
-import os
 
 from mermaid.models import MermaidImage
 from chat.models import AgentResponse
-from utils.dfd_generator import get_access_token, generate_mermaid_dfd_from_description
-from utils.mermaid_renderer import render_mermaid_to_png, MermaidRenderError
+from utils.gigachat_auth import aget_default_access_token
+from utils.mermaid_renderer import arender_diagram, MermaidRenderError
 from mermaid.serializer import MermaidRequestSerializer, ErrorResponseSerializer
-from utils.sanitize_mermaid_code_2 import sanitize_mermaid_code_2
-from utils.sanitize_mermaid_code import sanitize_mermaid_code
-from utils.tz_critic_agent2 import TzPipeline, call_gigachat
+from utils.tz_critic_agent2 import abuild_pipeline
 
 logger = logging.getLogger(__name__)
 
 
 class MermaidAPIView(APIView):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        env = environ.Env()
-        client_id = env('CLIENT_ID')
-        client_secret = env('CLIENT_SECRET')
-
-        self.access_token: str = get_access_token(client_id, client_secret)
-        basic_creds = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-
-        # 2) (Опционально) Через переменную окружения
-        os.environ["GIGACHAT_CREDENTIALS"] = basic_creds
-        # 3) Инициализируем LLM и эмбеддинги
-        self.llm = GigaChat(
-            # либо просто GigaChat(), если задали GIGACHAT_CREDENTIALS
-            credentials=basic_creds,
-            auth_url="https://ngw.devices.sberbank.ru:9443/api/v2/oauth",
-            base_url="https://gigachat.devices.sberbank.ru/api/v1",
-            scope="GIGACHAT_API_PERS",
-            verify_ssl_certs=False,
-        )
-        model_name = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
-        model_kwargs = {"device": "cpu"}
-        encode_kwargs = {"normalize_embeddings": False}
-        self.local_embedding = HuggingFaceEmbeddings(
-            model_name=model_name,
-            model_kwargs=model_kwargs,
-            encode_kwargs=encode_kwargs
-        )
-
-    def _render_diagram(self, title: str, code: str) -> tuple[str | None, bool]:
-        """Attempt to render a diagram with retries on sanitized code."""
-        for render_func in [lambda c: c, sanitize_mermaid_code_2, sanitize_mermaid_code]:
-            try:
-                clear_code = render_func(code)
-                if clear_code:
-                    png_bytes = render_mermaid_to_png(clear_code)
-                    return base64.b64encode(png_bytes).decode(), True
-            except Exception as e:
-                logger.debug(f"Render attempt failed for {title}: {e}")
-        logger.exception(f'Error rendering diagram {title}')
-        return None, False
-
     @extend_schema(
         summary='Генерация или изменение набора Mermaid-диаграмм через ИИ-агента',
         description="""
@@ -147,7 +98,7 @@ class MermaidAPIView(APIView):
             )
         }
     )
-    def post(self, request):
+    async def post(self, request):
         try:
             token = request.data.get('token')
             payload = request.data
@@ -161,12 +112,12 @@ class MermaidAPIView(APIView):
                 return Response({'error': 'The "token" fields are required'}, status=status.HTTP_400_BAD_REQUEST)
 
             # Initialize pipeline
-            pipeline = TzPipeline(llm_callable=call_gigachat, embedding_model=self.local_embedding, llm=self.llm)
+            access_token = await aget_default_access_token()
+            pipeline = await abuild_pipeline()
 
             # Gather responses for structured input
-            all_responses = AgentResponse.objects.filter(token=token, agent_id__in=[1, 2, 3, 4]).order_by('agent_id',
-                                                                                                          '-created_at').distinct(
-                'agent_id')
+            all_responses = [resp async for resp in AgentResponse.objects.filter(
+                token=token, agent_id__in=[1, 2, 3, 4]).order_by('agent_id', '-created_at').distinct('agent_id')]
 
             structured_response = "Собранное техническое задание:\n\n"
             for resp in all_responses:
@@ -178,51 +129,21 @@ class MermaidAPIView(APIView):
                 }[resp.agent_id]
                 structured_response += f"{section}{resp.response}\n\n"
 
-            # Initial diagram generation
-            all_diags = pipeline.generate_all_diagrams(structured_response, self.access_token, texts)
-            diagrams_dict = {}
-            failed_diagrams = []
-
-            # First pass: Try rendering all diagrams
-            for title, code in all_diags.items():
-                b64_image, success = self._render_diagram(title, code)
-                if success:
-                    diagrams_dict[title] = b64_image
-                else:
-                    failed_diagrams.append(title)
-
-            # Retry failed diagrams up to 3 times
-            retry_count = 3
-            while failed_diagrams and retry_count > 0:
-                logger.info(f'Retry attempt {4 - retry_count} for failed diagrams: {failed_diagrams}')
-                retry_count -= 1
-                try:
-                    all_diags = pipeline.generate_all_diagrams(structured_response, self.access_token, failed_diagrams)
-                except Exception as e:
-                    logger.exception(f'Error regenerating diagrams: {e}')
-                    break
-
-                new_failed_diagrams = []
-                for title in failed_diagrams:
-                    code = all_diags.get(title)
-                    if not code:
-                        logger.warning(f'Diagram {title} not found in regenerated diagrams')
-                        new_failed_diagrams.append(title)
-                        continue
-
-                    b64_image, success = self._render_diagram(title, code)
-                    if success:
-                        diagrams_dict[title] = b64_image
-                    else:
-                        new_failed_diagrams.append(title)
-
-                failed_diagrams = new_failed_diagrams
+            # Каждая диаграмма рендерится, как только готов её код; при ошибке код и ошибка рендерера
+            # уходят модели на исправление (до 3 раз), поэтому общая задержка — как у самой медленной
+            # диаграммы, а не сумма всех
+            # Одновременный одинаковый запрос (двойная отправка, вторая вкладка) ждёт этот, а не
+            # запускает свою генерацию и рендер
+            diagrams_dict, errors = await pipeline.arender_all_diagrams(
+                structured_response, access_token, texts, arender_diagram, attempts=4)
+            for title, error in errors.items():
+                logger.warning(f'Diagram {title} failed after all attempts: {error}')
 
             # Convert diagrams_dict to images_b64 list for response
             images_b64 = list(diagrams_dict.values())
 
             # Save or update MermaidImage object
-            MermaidImage.objects.update_or_create(token=token, defaults={'images_b64': diagrams_dict})
+            await MermaidImage.objects.aupdate_or_create(token=token, defaults={'images_b64': diagrams_dict})
 
             return JsonResponse({"images": images_b64}, status=status.HTTP_200_OK)
 
@@ -0,0 +1,252 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") not in ("0", "false", "False")
+CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", str(24 * 60 * 60)))
+# Второй уровень в Postgres (модель chat.CompletionCacheEntry) — общий для всех воркеров
+CACHE_DB = os.environ.get("LLM_CACHE_DB", "0") not in ("0", "false", "False")
+# Сколько строк одного кэша хранится в Postgres; устаревшие и лишние удаляются раз в CACHE_DB_PRUNE_EVERY записей
+CACHE_DB_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_DB_MAX_ENTRIES", "10000"))
+CACHE_DB_PRUNE_EVERY = int(os.environ.get("LLM_CACHE_DB_PRUNE_EVERY", "100"))
+
+
+def cache_key(model: str | None, temperature: float | None, prompt: str) -> str:
+    """Ключ кэша — sha256 от (модель, температура, промпт)."""
+    digest = hashlib.sha256()
+    digest.update(str(model).encode())
+    digest.update(b"\0")
+    digest.update(repr(temperature).encode())
+    digest.update(b"\0")
+    digest.update(prompt.encode())
+    return digest.hexdigest()
+
+
+class CompletionCache:
+    """
+    Кэш ответов LLM с адресацией по содержимому запроса.
+
+    Первый уровень — LRU в памяти процесса с ограничением по числу записей и TTL,
+    второй (необязательный) — таблица в Postgres, где строки кэша помечены его именем name.
+    Каждые db_prune_every записей из таблицы удаляются устаревшие строки этого кэша и самые
+    старые сверх max_db_entries. Ошибки второго уровня не ломают запрос: кэш просто
+    считается промахнувшимся.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL, use_db: bool = CACHE_DB,
+                 enabled: bool = CACHE_ENABLED, name: str = "completions", max_db_entries: int = CACHE_DB_MAX_ENTRIES,
+                 db_prune_every: int = CACHE_DB_PRUNE_EVERY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.use_db = use_db
+        self.enabled = enabled
+        self.name = name
+        self.max_db_entries = max_db_entries
+        self.db_prune_every = max(1, db_prune_every)
+        self._entries = OrderedDict()
+        self._db_writes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "db_hits": 0, "misses": 0, "bypasses": 0, "evictions": 0, "db_pruned": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def _get_memory(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set_memory(self, key: str, value: str, stored_at: float | None = None) -> None:
+        with self._lock:
+            self._entries[key] = (value, stored_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def _db_entries(self):
+        from chat.models import CompletionCacheEntry
+
+        return CompletionCacheEntry.objects.filter(cache=self.name)
+
+    def _db_expired_before(self):
+        """Граница TTL для строк в Postgres; None, если записи не устаревают."""
+        from django.utils import timezone
+
+        return timezone.now() - timedelta(seconds=self.ttl) if math.isfinite(self.ttl) else None
+
+    def _db_queryset(self, key: str):
+        queryset = self._db_entries().filter(key=key)
+        expired_before = self._db_expired_before()
+        return queryset if expired_before is None else queryset.filter(created_at__gte=expired_before)
+
+    def _db_written(self) -> bool:
+        """Считает запись в Postgres; True, если пора чистить таблицу."""
+        with self._lock:
+            self._db_writes += 1
+            return self._db_writes % self.db_prune_every == 0
+
+    def prune_db(self) -> int:
+        """Удаляет из Postgres устаревшие строки кэша и самые старые сверх max_db_entries; возвращает их число."""
+        entries = self._db_entries()
+        deleted = 0
+        expired_before = self._db_expired_before()
+        if expired_before is not None:
+            deleted += entries.filter(created_at__lt=expired_before).delete()[0]
+        # Время самой новой строки сверх лимита: она и все более старые удаляются
+        cutoff = entries.order_by("-created_at").values_list("created_at", flat=True)[self.max_db_entries:].first()
+        if cutoff is not None:
+            deleted += entries.filter(created_at__lte=cutoff).delete()[0]
+        with self._lock:
+            self._counters["db_pruned"] += deleted
+        return deleted
+
+    async def aprune_db(self) -> int:
+        entries = self._db_entries()
+        deleted = 0
+        expired_before = self._db_expired_before()
+        if expired_before is not None:
+            deleted += (await entries.filter(created_at__lt=expired_before).adelete())[0]
+        cutoff = await entries.order_by("-created_at").values_list("created_at", flat=True)[
+            self.max_db_entries:].afirst()
+        if cutoff is not None:
+            deleted += (await entries.filter(created_at__lte=cutoff).adelete())[0]
+        with self._lock:
+            self._counters["db_pruned"] += deleted
+        return deleted
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            self._count("hits")
+            return value
+
+        if self.use_db:
+            try:
+                entry = self._db_queryset(key).first()
+            except Exception as e:
+                logger.warning(f"Completion cache DB lookup failed: {e}")
+                entry = None
+            if entry is not None:
+                self._set_memory(key, entry.response)
+                self._count("db_hits")
+                return entry.response
+
+        self._count("misses")
+        return None
+
+    async def aget(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            self._count("hits")
+            return value
+
+        if self.use_db:
+            try:
+                entry = await self._db_queryset(key).afirst()
+            except Exception as e:
+                logger.warning(f"Completion cache DB lookup failed: {e}")
+                entry = None
+            if entry is not None:
+                self._set_memory(key, entry.response)
+                self._count("db_hits")
+                return entry.response
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+        self._set_memory(key, value)
+        if self.use_db:
+            from chat.models import CompletionCacheEntry
+            try:
+                CompletionCacheEntry.objects.update_or_create(key=key, defaults={"cache": self.name, "response": value})
+                if self._db_written():
+                    self.prune_db()
+            except Exception as e:
+                logger.warning(f"Completion cache DB write failed: {e}")
+
+    async def aset(self, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+        self._set_memory(key, value)
+        if self.use_db:
+            from chat.models import CompletionCacheEntry
+            try:
+                await CompletionCacheEntry.objects.aupdate_or_create(
+                    key=key, defaults={"cache": self.name, "response": value})
+                if self._db_written():
+                    await self.aprune_db()
+            except Exception as e:
+                logger.warning(f"Completion cache DB write failed: {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["db_hits"] + counters["misses"]
+        return {
+            **counters,
+            "size": size,
+            "max_entries": self.max_entries,
+            "hit_rate": round((counters["hits"] + counters["db_hits"]) / lookups, 3) if lookups else 0.0,
+        }
+
+
+completion_cache = CompletionCache()
+
+
+def cached_call(key: str, fn, *args, use_cache: bool = True, **kwargs) -> str:
+    """
+    Возвращает ответ из кэша или вызывает fn(*args, **kwargs) и запоминает результат.
+    use_cache=False пропускает чтение из кэша, но сохраняет свежий ответ.
+    """
+    if use_cache:
+        value = completion_cache.get(key)
+        if value is not None:
+            return value
+    else:
+        completion_cache._count("bypasses")
+
+    value = fn(*args, **kwargs)
+    completion_cache.set(key, value)
+    return value
+
+
+async def acached_call(key: str, afn, *args, use_cache: bool = True, **kwargs) -> str:
+    if use_cache:
+        value = await completion_cache.aget(key)
+        if value is not None:
+            return value
+    else:
+        completion_cache._count("bypasses")
+
+    value = await afn(*args, **kwargs)
+    await completion_cache.aset(key, value)
+    return value
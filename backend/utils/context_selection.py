@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+
+from utils.prompt_budget import count_tokens
+from utils.retrieval_cache import CachedRetriever, embed_query, search_ids, retrieval_cache
+
+# "mmr" — отбор фрагментов по MMR в пределах бюджета токенов без дублей перекрытий, "topk" — прежние k ближайших
+CRITIC_CONTEXT_SELECTION = os.environ.get("CRITIC_CONTEXT_SELECTION", "mmr")
+CRITIC_CONTEXT_TOKENS = int(os.environ.get("CRITIC_CONTEXT_TOKENS", "800"))
+# Сколько ближайших фрагментов рассматривается как кандидаты для MMR
+CRITIC_FETCH_K = int(os.environ.get("CRITIC_FETCH_K", "20"))
+# 1 — только релевантность, 0 — только разнообразие
+CRITIC_MMR_LAMBDA = float(os.environ.get("CRITIC_MMR_LAMBDA", "0.7"))
+# Перекрытия короче этого считаются случайным совпадением, а не общим куском соседних фрагментов
+MIN_OVERLAP_CHARS = 30
+
+
+def overlap_length(left: str, right: str, max_overlap: int) -> int:
+    """Длина самого длинного конца left, совпадающего с началом right (не короче MIN_OVERLAP_CHARS)."""
+    if len(left) < MIN_OVERLAP_CHARS or len(right) < MIN_OVERLAP_CHARS:
+        return 0
+    probe = right[:MIN_OVERLAP_CHARS]
+    position = left.find(probe, max(len(left) - max_overlap, 0))
+    while position != -1:
+        if right.startswith(left[position:]):
+            return len(left) - position
+        position = left.find(probe, position + 1)
+    return 0
+
+
+class ContextSpans:
+    """
+    Выбранный контекст: непрерывные куски документов рекомендаций. Фрагмент, перекрывающийся
+    с уже выбранным куском того же документа, приклеивается к нему без повтора общего текста.
+    """
+
+    def __init__(self, max_overlap: int):
+        self.max_overlap = max_overlap
+        self.spans: list[Document] = []
+
+    def merged(self, doc: Document) -> tuple[int | None, str]:
+        """Куда и каким текстом встанет фрагмент: (индекс куска или None для нового, новый текст куска)."""
+        source = doc.metadata.get("source")
+        text = doc.page_content
+        for i, span in enumerate(self.spans):
+            if span.metadata.get("source") != source:
+                continue
+            if text in span.page_content:
+                return i, span.page_content
+            overlap = overlap_length(span.page_content, text, self.max_overlap)
+            if overlap:
+                return i, span.page_content + text[overlap:]
+            overlap = overlap_length(text, span.page_content, self.max_overlap)
+            if overlap:
+                return i, text + span.page_content[overlap:]
+        return None, text
+
+    def add(self, doc: Document, budget: int) -> bool:
+        index, text = self.merged(doc)
+        current = self.spans[index].page_content if index is not None else ""
+        if text == current:
+            return True
+        if self.tokens() - count_tokens(current) + count_tokens(text) > budget:
+            return False
+        if index is None:
+            self.spans.append(Document(page_content=text, metadata={**doc.metadata, "chunks": 1}))
+        else:
+            span = self.spans[index]
+            span.page_content = text
+            span.metadata["chunks"] += 1
+        return True
+
+    def tokens(self) -> int:
+        return sum(count_tokens(span.page_content) for span in self.spans)
+
+
+def docstore_positions(vs: FAISS, version: str) -> dict:
+    """ID фрагмента → позиция вектора в FAISS; для версии индекса считается один раз."""
+    key = f"positions:{version}"
+    positions = retrieval_cache.get(key)
+    if positions is None:
+        positions = {doc_id: position for position, doc_id in vs.index_to_docstore_id.items()}
+        retrieval_cache.set(key, positions)
+    return positions
+
+
+def select_context(vs: FAISS, query: str, version: str, budget: int = CRITIC_CONTEXT_TOKENS,
+                   fetch_k: int = CRITIC_FETCH_K, lambda_mult: float = CRITIC_MMR_LAMBDA,
+                   max_overlap: int = 400) -> list[Document]:
+    """
+    Контекст для критика: из fetch_k ближайших фрагментов по MMR набираются разнообразные,
+    пока хватает бюджета токенов; перекрывающиеся соседние фрагменты склеиваются в один кусок.
+    """
+    vector = embed_query(vs.embedding_function, query)
+    ids = search_ids(vs, vector, fetch_k, version)
+    if not ids:
+        return []
+    positions = docstore_positions(vs, version)
+    candidates = np.array([vs.index.reconstruct(positions[doc_id]) for doc_id in ids], dtype=np.float32)
+    order = maximal_marginal_relevance(vector, candidates, lambda_mult=lambda_mult, k=len(ids))
+
+    spans = ContextSpans(max_overlap)
+    for i in order:
+        spans.add(vs.docstore.search(ids[i]), budget)
+    if not spans.spans:
+        # Даже самый релевантный фрагмент не влез — лучше он один, чем пустой контекст
+        spans.spans.append(vs.docstore.search(ids[0]))
+    return spans.spans
+
+
+class BudgetedRetriever(CachedRetriever):
+    """Ретривер критика, отдающий вместо k ближайших фрагментов контекст select_context()."""
+
+    token_budget: int = CRITIC_CONTEXT_TOKENS
+    fetch_k: int = CRITIC_FETCH_K
+    lambda_mult: float = CRITIC_MMR_LAMBDA
+    max_overlap: int = 400
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        if self.vectorstore is None:
+            return []
+        return select_context(self.vectorstore, query, self.version, budget=self.token_budget,
+                              fetch_k=self.fetch_k, lambda_mult=self.lambda_mult, max_overlap=self.max_overlap)
+
+    @property
+    def cache_tag(self) -> str:
+        return f"mmr:{self.fetch_k}:{self.lambda_mult}:{self.token_budget}"
@@ -0,0 +1,17 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Эмбеддинги и поиск по FAISS нагружают CPU; больше потоков, чем ядер, им не помогает
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(os.cpu_count() or 2)))
+
+_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """
+    Выполняет CPU-нагруженную функцию в ограниченном пуле потоков, не блокируя event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
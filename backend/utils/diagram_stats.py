@@ -0,0 +1,66 @@
+import threading
+
+
+class DiagramStats:
+    """
+    Счётчики цепочек «генерация → рендер → исправление» по стратегиям ("repair" — исправление
+    по ошибке рендера, "regenerate" — повторная генерация с нуля): сколько вызовов LLM и времени
+    ушло на диаграмму до успешного рендера.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._strategies = {}
+
+    def record(self, strategy: str, llm_calls: int, seconds: float, rendered: bool) -> None:
+        with self._lock:
+            counters = self._strategies.setdefault(strategy, {
+                "diagrams": 0, "rendered": 0, "failed": 0, "llm_calls": 0, "first_try": 0, "seconds": 0.0,
+            })
+            counters["diagrams"] += 1
+            counters["rendered" if rendered else "failed"] += 1
+            counters["llm_calls"] += llm_calls
+            counters["first_try"] += int(rendered and llm_calls == 1)
+            counters["seconds"] += seconds
+
+    def reset(self) -> None:
+        with self._lock:
+            self._strategies.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            strategies = {name: dict(counters) for name, counters in self._strategies.items()}
+        for counters in strategies.values():
+            # Вызовы на отрисованную диаграмму учитывают и те, что ушли на так и не отрисованные
+            counters["llm_calls_per_rendered"] = (
+                round(counters["llm_calls"] / counters["rendered"], 2) if counters["rendered"] else None)
+            counters["avg_seconds"] = round(counters.pop("seconds") / counters["diagrams"], 2)
+        return strategies
+
+
+class RenderStats:
+    """
+    Счётчики рендера: сколько вариантов кода (исходный и после очисток) отброшено как повторы
+    или не похожие на диаграмму, сколько кандидатов отклонила локальная проверка синтаксиса,
+    сколько запросов ушло в Kroki и сколько сэкономлено по сравнению с отправкой всех вариантов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def add(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+diagram_stats = DiagramStats()
+render_stats = RenderStats()
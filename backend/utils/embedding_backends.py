@@ -0,0 +1,76 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+# Меньшая многоязычная модель той же серии: 12 слоёв MiniLM вместо mpnet-base, размерность 384
+SMALL_EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8", "small")
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+# Куда сохраняется экспортированная и квантованная ONNX-модель
+ONNX_MODEL_DIR = os.environ.get("EMBEDDING_ONNX_DIR", "embedding_models")
+# Набор инструкций для динамической int8-квантизации ONNX Runtime: avx2, avx512, avx512_vnni, arm64
+ONNX_QUANTIZATION = os.environ.get("EMBEDDING_ONNX_QUANTIZATION", "avx2")
+
+ENCODE_KWARGS = {"normalize_embeddings": False}
+
+
+def _default_device() -> str:
+    import torch
+
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def quantized_onnx_model(model_name: str = EMBEDDING_MODEL_NAME, quantization: str = ONNX_QUANTIZATION,
+                         model_dir: str = ONNX_MODEL_DIR) -> tuple[str, str]:
+    """
+    Экспортирует модель в ONNX с динамической int8-квантизацией (один раз, дальше берётся с диска).
+    Возвращает (каталог модели, путь к .onnx-файлу внутри него).
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    path = os.path.join(model_dir, model_name.replace("/", "__"))
+    file_name = os.path.join("onnx", f"model_qint8_{quantization}.onnx")
+    if not os.path.isfile(os.path.join(path, file_name)):
+        logger.info(f"Exporting {model_name} to int8 ONNX ({quantization}) in {path}")
+        model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        model.save_pretrained(path)
+        export_dynamic_quantized_onnx_model(model, quantization, path)
+    return path, file_name
+
+
+def build_embeddings(backend: str = EMBEDDING_BACKEND, device: str | None = None):
+    """
+    Модель эмбеддингов для выбранного бэкенда:
+    torch — исходная fp32-модель через PyTorch;
+    onnx — та же модель через ONNX Runtime;
+    onnx-int8 — ONNX с динамической int8-квантизацией весов;
+    small — меньшая многоязычная модель (индекс рекомендаций пересобирается под неё).
+    """
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    if backend == "torch":
+        model_name, model_kwargs = EMBEDDING_MODEL_NAME, {"device": device or _default_device()}
+    elif backend == "small":
+        model_name, model_kwargs = SMALL_EMBEDDING_MODEL_NAME, {"device": device or _default_device()}
+    elif backend == "onnx":
+        model_name, model_kwargs = EMBEDDING_MODEL_NAME, {"device": "cpu", "backend": "onnx"}
+    elif backend == "onnx-int8":
+        model_name, file_name = quantized_onnx_model()
+        model_kwargs = {"device": "cpu", "backend": "onnx", "model_kwargs": {"file_name": file_name}}
+    else:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {', '.join(EMBEDDING_BACKENDS)}")
+
+    return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs, encode_kwargs=ENCODE_KWARGS)
+
+
+def backend_variant(embedding_model) -> str | None:
+    """Отличие бэкенда от PyTorch fp32 (например, "onnx" или "onnx:onnx/model_qint8_avx2.onnx") для версии индекса."""
+    model_kwargs = getattr(embedding_model, "model_kwargs", None) or {}
+    backend = model_kwargs.get("backend")
+    if not backend or backend == "torch":
+        return None
+    file_name = (model_kwargs.get("model_kwargs") or {}).get("file_name")
+    return f"{backend}:{file_name}" if file_name else backend
@@ -0,0 +1,116 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BATCHING = os.environ.get("EMBEDDING_BATCHING", "1") not in ("0", "false", "False")
+MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_MAX_SIZE", "32"))
+MAX_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Обёртка над моделью эмбеддингов, объединяющая одновременные вызовы из разных запросов.
+
+    Фоновый поток собирает тексты в течение max_wait_ms (или пока не наберётся max_batch_size)
+    и прогоняет их одним вызовом embed_documents, а затем раздаёт результаты вызывающим.
+    Запросы и документы кодируются одинаково, что верно для sentence-transformers без префиксов.
+    Большие вызовы (сборка индекса) делятся на пачки по max_batch_size и идут через тот же поток:
+    модель никогда не вызывается из нескольких потоков одновременно.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_WAIT_MS):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "batches": 0, "texts": 0}
+
+    @property
+    def model_name(self) -> str | None:
+        # Версия индекса рекомендаций зависит от имени модели — обёртка его не меняет
+        return getattr(self.embeddings, "model_name", None)
+
+    @property
+    def model_kwargs(self) -> dict | None:
+        return getattr(self.embeddings, "model_kwargs", None)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        texts = list(texts)
+        # Все пачки ставятся в очередь сразу: между ними могут попасть запросы других пользователей
+        futures = [self._enqueue(texts[start:start + self.max_batch_size])
+                   for start in range(0, len(texts), self.max_batch_size)]
+        return [vector for future in futures for vector in future.result()]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._enqueue([text]).result()[0]
+
+    def _enqueue(self, texts: list[str]) -> Future:
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+            except Exception as e:
+                logger.warning(f"Embedding batch of {len(texts)} texts failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._lock:
+                self._counters["calls"] += len(batch)
+                self._counters["batches"] += 1
+                self._counters["texts"] += len(texts)
+
+            offset = 0
+            for item_texts, future in batch:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            **counters,
+            "avg_batch_size": round(counters["texts"] / counters["batches"], 2) if counters["batches"] else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
@@ -0,0 +1,198 @@
+import asyncio
+import base64
+import logging
+import threading
+import time
+import uuid
+from functools import cached_property
+from typing import Any, Optional
+
+import environ
+import gigachat
+import requests
+from langchain_gigachat.chat_models import GigaChat
+from pydantic import Field
+
+logger = logging.getLogger(__name__)
+
+AUTH_URL = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
+SCOPE = "GIGACHAT_API_PERS"
+
+
+class GigaChatTokenProvider:
+    """
+    Общий на процесс источник OAuth-токена GigaChat.
+
+    Токен кэшируется до момента `expires_at - refresh_margin`, а фоновый таймер
+    обновляет его заранее, чтобы запросы не ждали OAuth. Одновременные вызовы
+    разделяют одно обновление под блокировкой.
+    """
+
+    def __init__(self, credentials: str, scope: str = SCOPE, auth_url: str = AUTH_URL,
+                 refresh_margin: float = 60.0, timeout: float = 10.0):
+        self.credentials = credentials
+        self.scope = scope
+        self.auth_url = auth_url
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._timer: Optional[threading.Timer] = None
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin
+
+    def is_fresh(self) -> bool:
+        return self._is_fresh()
+
+    def cached_token(self) -> Optional[str]:
+        """Текущий токен без обращения к OAuth; None, если его нет или он уже истёк."""
+        token, expires_at = self._token, self._expires_at
+        return token if token is not None and time.time() < expires_at else None
+
+    def get_token(self) -> str:
+        if self._is_fresh():
+            return self._token
+
+        with self._lock:
+            if not self._is_fresh():
+                self._refresh_locked()
+            return self._token
+
+    async def aget_token(self) -> str:
+        if self._is_fresh():
+            return self._token
+        # Обновление — блокирующий HTTP-запрос, выносим его из event loop
+        return await asyncio.to_thread(self.get_token)
+
+    def invalidate(self) -> None:
+        """Сбрасывает токен (например, после 401), следующий вызов получит новый."""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _refresh_locked(self) -> None:
+        headers = {
+            "Authorization": f"Basic {self.credentials}",
+            "Content-Type": "application/x-www-form-urlencoded",
+            "RqUID": str(uuid.uuid4())
+        }
+        response = requests.post(self.auth_url, headers=headers, data={"scope": self.scope},
+                                 verify=False, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+
+        self._token = data["access_token"]
+        # expires_at приходит в миллисекундах; если его нет, считаем токен живущим 30 минут
+        self._expires_at = data["expires_at"] / 1000 if data.get("expires_at") else time.time() + 30 * 60
+        logger.debug(f"GigaChat access token refreshed, expires in {self._expires_at - time.time():.0f}s")
+        self._schedule_refresh()
+
+    def _schedule_refresh(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        # Обновляем с запасом в два refresh_margin, чтобы успеть до того, как токен перестанет считаться свежим
+        delay = max(self._expires_at - 2 * self.refresh_margin - time.time(), 1.0)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self) -> None:
+        with self._lock:
+            try:
+                self._refresh_locked()
+            except Exception as e:
+                # Следующий get_token() повторит попытку синхронно
+                logger.warning(f"Background GigaChat token refresh failed: {e}")
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_token_provider(client_id: str, client_secret: str) -> GigaChatTokenProvider:
+    credentials = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+    with _providers_lock:
+        provider = _providers.get(credentials)
+        if provider is None:
+            provider = GigaChatTokenProvider(credentials)
+            _providers[credentials] = provider
+    return provider
+
+
+def default_token_provider() -> GigaChatTokenProvider:
+    env = environ.Env()
+    return get_token_provider(env('CLIENT_ID'), env('CLIENT_SECRET'))
+
+
+# === Получение токена доступа ===
+def get_access_token(client_id: str, client_secret: str) -> str:
+    """
+    Возвращает OAuth2 access_token GigaChat из общего кэша процесса.
+    """
+    return get_token_provider(client_id, client_secret).get_token()
+
+
+async def aget_access_token(client_id: str, client_secret: str) -> str:
+    return await get_token_provider(client_id, client_secret).aget_token()
+
+
+async def aget_default_access_token() -> str:
+    return await default_token_provider().aget_token()
+
+
+class _ProviderGigaChatClient(gigachat.GigaChat):
+    """Клиент gigachat, который не авторизуется сам, а берёт токен у GigaChatTokenProvider."""
+
+    def __init__(self, token_provider: GigaChatTokenProvider, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._token_provider = token_provider
+
+    @property
+    def token(self) -> Optional[str]:
+        # Асинхронные вызовы обновляют токен заранее через _aupdate_token(), поэтому здесь он уже есть,
+        # и блокирующий OAuth-запрос остаётся только синхронным вызовам
+        return self._token_provider.cached_token() or self._token_provider.get_token()
+
+    @property
+    def _use_auth(self) -> bool:
+        return True
+
+    def _check_validity_token(self) -> bool:
+        # Несвежий токен клиент gigachat обновит через _update_token() / _aupdate_token() до запроса
+        return self._token_provider.is_fresh()
+
+    def _reset_token(self) -> None:
+        self._token_provider.invalidate()
+
+    def _update_token(self) -> None:
+        self._token_provider.get_token()
+
+    async def _aupdate_token(self) -> None:
+        await self._token_provider.aget_token()
+
+
+class SharedTokenGigaChat(GigaChat):
+    """GigaChat для LangChain, использующий общий GigaChatTokenProvider вместо своей OAuth-авторизации."""
+
+    token_provider: Any = Field(default=None, exclude=True)
+
+    @cached_property
+    def _client(self) -> gigachat.GigaChat:
+        return _ProviderGigaChatClient(
+            token_provider=self.token_provider,
+            base_url=self.base_url,
+            scope=self.scope,
+            model=self.model,
+            profanity_check=self.profanity_check,
+            timeout=self.timeout,
+            ssl_context=self.ssl_context,
+            verify_ssl_certs=self.verify_ssl_certs,
+            ca_bundle_file=self.ca_bundle_file,
+            cert_file=self.cert_file,
+            key_file=self.key_file,
+            key_file_password=self.key_file_password,
+            verbose=self.verbose,
+            flags=self.flags,
+        )
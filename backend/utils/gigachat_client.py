@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import uuid
+import weakref
+
+import httpx
+
+from utils.token_usage import record_response_usage
+
+logger = logging.getLogger(__name__)
+
+GIGACHAT_API_URL = "https://gigachat.devices.sberbank.ru/api/v1"
+DEFAULT_MODEL = "GigaChat-Pro"
+
+CONNECT_TIMEOUT = float(os.environ.get("GIGACHAT_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.environ.get("GIGACHAT_READ_TIMEOUT", "120"))
+POOL_SIZE = int(os.environ.get("GIGACHAT_POOL_SIZE", "20"))
+# Асинхронный клиент держит много одновременных запросов в одном процессе
+ASYNC_POOL_SIZE = int(os.environ.get("GIGACHAT_ASYNC_POOL_SIZE", "200"))
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _client_kwargs(base_url: str, pool_size: int, connect_timeout: float, read_timeout: float,
+                   http2: bool | None) -> dict:
+    if http2 is None:
+        http2 = http2_available()
+    return {
+        "base_url": base_url,
+        "http2": http2,
+        "limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        "timeout": httpx.Timeout(read_timeout, connect=connect_timeout),
+        "verify": False,
+    }
+
+
+def build_payload(prompt: str, model: str = DEFAULT_MODEL, temperature: float = 0.5, stream: bool = False) -> dict:
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+        "stream": stream
+    }
+
+
+def build_headers(access_token: str, accept: str = "application/json") -> dict:
+    return {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+        "Accept": accept,
+        "RqUID": str(uuid.uuid4())
+    }
+
+
+class GigaChatClient:
+    """
+    Клиент chat/completions GigaChat с пулом keep-alive соединений и явными таймаутами.
+    Если установлен пакет h2, запросы мультиплексируются поверх HTTP/2.
+    """
+
+    def __init__(
+            self,
+            base_url: str = GIGACHAT_API_URL,
+            pool_size: int = POOL_SIZE,
+            connect_timeout: float = CONNECT_TIMEOUT,
+            read_timeout: float = READ_TIMEOUT,
+            http2: bool | None = None
+    ):
+        kwargs = _client_kwargs(base_url, pool_size, connect_timeout, read_timeout, http2)
+        self._client = httpx.Client(**kwargs)
+        logger.debug(f"GigaChat HTTP client created (pool={pool_size}, http2={kwargs['http2']})")
+
+    def complete(self, prompt: str, access_token: str, temperature: float = 0.5, model: str = DEFAULT_MODEL) -> str:
+        response = self._client.post(
+            "/chat/completions",
+            headers=build_headers(access_token),
+            json=build_payload(prompt, model=model, temperature=temperature)
+        )
+        response.raise_for_status()
+        data = response.json()
+        content = data["choices"][0]["message"]["content"]
+        record_response_usage(model, data.get("usage"), prompt, content)
+        return content
+
+    def close(self) -> None:
+        self._client.close()
+
+
+class AsyncGigaChatClient:
+    """Асинхронный аналог GigaChatClient (общий пул соединений в рамках одного event loop)."""
+
+    def __init__(
+            self,
+            base_url: str = GIGACHAT_API_URL,
+            pool_size: int = ASYNC_POOL_SIZE,
+            connect_timeout: float = CONNECT_TIMEOUT,
+            read_timeout: float = READ_TIMEOUT,
+            http2: bool | None = None
+    ):
+        self._client = httpx.AsyncClient(**_client_kwargs(base_url, pool_size, connect_timeout, read_timeout, http2))
+
+    async def complete(self, prompt: str, access_token: str, temperature: float = 0.5,
+                       model: str = DEFAULT_MODEL) -> str:
+        response = await self._client.post(
+            "/chat/completions",
+            headers=build_headers(access_token),
+            json=build_payload(prompt, model=model, temperature=temperature)
+        )
+        response.raise_for_status()
+        data = response.json()
+        content = data["choices"][0]["message"]["content"]
+        record_response_usage(model, data.get("usage"), prompt, content)
+        return content
+
+    async def stream(self, prompt: str, access_token: str, temperature: float = 0.5, model: str = DEFAULT_MODEL):
+        """Отдаёт фрагменты ответа модели по мере генерации (режим stream=True, SSE)."""
+        async with self._client.stream(
+                "POST",
+                "/chat/completions",
+                headers=build_headers(access_token, accept="text/event-stream"),
+                json=build_payload(prompt, model=model, temperature=temperature, stream=True)
+        ) as response:
+            response.raise_for_status()
+            parts = []
+            usage = None
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                # Последний фрагмент потока несёт usage за весь ответ
+                usage = chunk.get("usage") or usage
+                delta = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        record_response_usage(model, usage, prompt, "".join(parts))
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+_client = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_client() -> GigaChatClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GigaChatClient()
+    return _client
+
+
+def complete(prompt: str, access_token: str, temperature: float = 0.5, model: str = DEFAULT_MODEL) -> str:
+    """Один запрос chat/completions через общий на процесс пул соединений."""
+    return get_client().complete(prompt, access_token, temperature=temperature, model=model)
+
+
+def get_async_client() -> AsyncGigaChatClient:
+    # httpx.AsyncClient привязан к event loop, поэтому держим по клиенту на loop
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncGigaChatClient()
+        _async_clients[loop] = client
+    return client
+
+
+async def acomplete(prompt: str, access_token: str, temperature: float = 0.5, model: str = DEFAULT_MODEL) -> str:
+    return await get_async_client().complete(prompt, access_token, temperature=temperature, model=model)
+
+
+async def astream_complete(prompt: str, access_token: str, temperature: float = 0.5, model: str = DEFAULT_MODEL):
+    async for delta in get_async_client().stream(prompt, access_token, temperature=temperature, model=model):
+        yield delta
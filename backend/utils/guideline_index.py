@@ -0,0 +1,655 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOC_PATH = "tz_guidelines.docx"
+DEFAULT_INDEX_DIR = os.environ.get("GUIDELINE_INDEX_DIR", "guideline_index")
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_CHUNK_OVERLAP = 200
+
+# Меняется при несовместимых изменениях формата сохранённого индекса
+INDEX_FORMAT_VERSION = 2
+
+SUPPORTED_EXTENSIONS = (".docx", ".md", ".markdown", ".txt", ".pdf")
+
+# "fast" — разбор docx через python-docx с заголовками в метаданных фрагментов,
+# "unstructured" — прежний UnstructuredWordDocumentLoader (тяжёлый импорт, медленный разбор)
+DOCX_LOADER = os.environ.get("GUIDELINE_DOCX_LOADER", "fast")
+HEADING_STYLE_RE = re.compile(r"^(?:Heading|Заголовок)\s*(\d+)$", re.IGNORECASE)
+NUMBERED_HEADING_RE = re.compile(r"^(\d+(?:\.\d+)*)[.)]?\s")
+LETTERED_HEADING_RE = re.compile(r"^[a-zа-я][.)]\s", re.IGNORECASE)
+MAX_HEADING_LENGTH = 200
+
+# Пространства имён — независимые корпуса рекомендаций (ГОСТ, внутренний стандарт и т.п.)
+DEFAULT_NAMESPACE = "default"
+NAMESPACE_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Сколько памяти могут занимать загруженные индексы всех пространств имён вместе
+INDEX_MEMORY_BUDGET_MB = float(os.environ.get("GUIDELINE_INDEX_MEMORY_MB", "1024"))
+
+
+def embedding_model_name(embedding_model) -> str:
+    from utils.embedding_backends import backend_variant
+
+    name = getattr(embedding_model, "model_name", None) or type(embedding_model).__name__
+    # ONNX и квантованная модель дают другие векторы, поэтому и индекс для них свой
+    variant = backend_variant(embedding_model)
+    return f"{name}@{variant}" if variant else name
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def validate_namespace(namespace: str) -> str:
+    if not NAMESPACE_RE.match(namespace or ""):
+        raise ValueError(f"Invalid guideline namespace '{namespace}': use 1-64 latin letters, digits, '_' or '-'")
+    return namespace
+
+
+def namespace_dir(index_dir: str, namespace: str = DEFAULT_NAMESPACE) -> str:
+    # Пространство имён по умолчанию лежит прямо в index_dir — так остаются валидны уже собранные индексы
+    if namespace == DEFAULT_NAMESPACE:
+        return index_dir
+    return os.path.join(index_dir, "ns", validate_namespace(namespace))
+
+
+def list_namespaces(index_dir: str = DEFAULT_INDEX_DIR) -> list[str]:
+    directory = os.path.join(index_dir, "ns")
+    names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+    return [DEFAULT_NAMESPACE] + [name for name in names if NAMESPACE_RE.match(name) and name != DEFAULT_NAMESPACE]
+
+
+def corpus_key(model_name: str, chunk_size: int, chunk_overlap: int) -> str:
+    """
+    Ключ корпуса — хэш от формата, модели эмбеддингов и параметров нарезки.
+    Векторы из разных моделей или нарезок несовместимы, поэтому у каждого ключа свой индекс.
+    """
+    key = json.dumps({
+        "format": INDEX_FORMAT_VERSION,
+        # Загрузчики по-разному режут docx на элементы, поэтому и фрагменты у них разные
+        "docx_loader": DOCX_LOADER,
+        "model": model_name,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _heading_level(paragraph, text: str, outline_level: int) -> int | None:
+    """
+    Уровень заголовка или None для обычного абзаца. Кроме стилей Heading N учитываются
+    жирные абзацы с нумерацией («1.», «2.3», «a.») — так оформлены заголовки в tz_guidelines.docx.
+    """
+    style = paragraph.style.name if paragraph.style is not None else ""
+    if style == "Title":
+        return 1
+    match = HEADING_STYLE_RE.match(style)
+    if match:
+        return int(match.group(1))
+
+    runs = [run for run in paragraph.runs if run.text.strip()]
+    if not runs or len(text) > MAX_HEADING_LENGTH or not all(run.bold for run in runs):
+        return None
+    match = NUMBERED_HEADING_RE.match(text)
+    if match:
+        return match.group(1).count(".") + 1
+    if LETTERED_HEADING_RE.match(text):
+        return outline_level + 1
+    return None
+
+
+def _table_text(table) -> str:
+    rows = []
+    for row in table.rows:
+        cells = []
+        for cell in row.cells:
+            text = cell.text.strip()
+            # Объединённые ячейки python-docx возвращает несколько раз подряд
+            if text and (not cells or cells[-1] != text):
+                cells.append(text)
+        if cells:
+            rows.append(" | ".join(cells))
+    return "\n".join(rows)
+
+
+def load_docx(path: str) -> list:
+    """
+    Разбирает docx через python-docx: документ делится на разделы по заголовкам,
+    у каждого раздела в метаданных путь заголовков («1. Что должно быть в ТЗ? > c. Требования к продукту»).
+    Таблицы идут в текст раздела построчно, ячейки через « | ».
+    """
+    import docx
+    from docx.table import Table
+    from langchain_core.documents import Document
+
+    sections = []
+    headings: list[tuple[int, str]] = []
+    outline_level = 0
+    blocks: list[str] = []
+
+    def flush():
+        if blocks:
+            sections.append(Document(
+                page_content="\n\n".join(blocks),
+                metadata={
+                    "source": path,
+                    "heading": " > ".join(text for _, text in headings),
+                    "section": len(sections),
+                },
+            ))
+            blocks.clear()
+
+    for block in docx.Document(path).iter_inner_content():
+        if isinstance(block, Table):
+            text = _table_text(block)
+            if text:
+                blocks.append(text)
+            continue
+
+        text = block.text.strip()
+        if not text:
+            continue
+        level = _heading_level(block, text, outline_level)
+        if level is None:
+            blocks.append(text)
+            continue
+
+        flush()
+        while headings and headings[-1][0] >= level:
+            headings.pop()
+        headings.append((level, " ".join(text.split())))
+        if not LETTERED_HEADING_RE.match(text):
+            outline_level = level
+        # Заголовок остаётся и в тексте — по нему тоже ищут
+        blocks.append(text)
+    flush()
+    return sections
+
+
+def load_docx_unstructured(path: str) -> list:
+    from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+
+    return UnstructuredWordDocumentLoader(path).load()
+
+
+def load_document(path: str) -> list:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".docx":
+        if DOCX_LOADER == "unstructured":
+            return load_docx_unstructured(path)
+        try:
+            documents = load_docx(path)
+        except Exception as e:
+            logger.warning(f"python-docx failed to parse {path}, falling back to unstructured: {e}")
+            return load_docx_unstructured(path)
+        if not documents:
+            logger.warning(f"python-docx found no text in {path}, falling back to unstructured")
+            return load_docx_unstructured(path)
+        return documents
+    if extension in (".md", ".markdown", ".txt"):
+        from langchain_community.document_loaders import TextLoader
+        return TextLoader(path, encoding="utf-8").load()
+    if extension == ".pdf":
+        from langchain_community.document_loaders import PyPDFLoader
+        return PyPDFLoader(path).load()
+    raise ValueError(f"Unsupported guideline document type '{extension}', expected one of {', '.join(SUPPORTED_EXTENSIONS)}")
+
+
+def split_document(doc_path: str, chunk_size: int, chunk_overlap: int) -> list:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    ).split_documents(load_document(doc_path))
+
+
+def chunk_ids(doc_id: str, chunks: list) -> list[str]:
+    """
+    ID фрагмента — документ плюс хэш его текста: при замене документа неизменившиеся
+    фрагменты сохраняют ID и не эмбеддятся заново.
+    """
+    ids = []
+    seen = {}
+    for chunk in chunks:
+        base = f"{doc_id}:{hashlib.sha256(chunk.page_content.encode()).hexdigest()[:16]}"
+        seen[base] = seen.get(base, 0) + 1
+        ids.append(base if seen[base] == 1 else f"{base}:{seen[base]}")
+    return ids
+
+
+def copy_index(vs: FAISS) -> FAISS:
+    """Независимая копия индекса: изменения не видны тем, кто читает текущую версию."""
+    return FAISS(
+        vs.embedding_function,
+        faiss.clone_index(vs.index),
+        InMemoryDocstore(dict(vs.docstore._dict)),
+        dict(vs.index_to_docstore_id),
+    )
+
+
+def save_index(vs: FAISS, index_dir: str, version: str, manifest: dict | None = None) -> str:
+    """Сохраняет индекс атомарно: пишем во временный каталог и переименовываем."""
+    os.makedirs(index_dir, exist_ok=True)
+    target = os.path.join(index_dir, version)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{version}-", dir=index_dir)
+    try:
+        if vs is not None:
+            vs.save_local(tmp_dir)
+        if manifest is not None:
+            with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(tmp_dir, target)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return target
+
+
+def load_index(path: str, embedding_model) -> FAISS:
+    """Загружает индекс с диска, по возможности отображая его в память (mmap)."""
+    index_file = os.path.join(path, "index.faiss")
+    try:
+        index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        index = faiss.read_index(index_file)
+
+    # index.pkl пишется нами же через FAISS.save_local, поэтому ему можно доверять
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embedding_model, index, docstore, index_to_docstore_id)
+
+
+def index_memory_bytes(vs: FAISS | None) -> int:
+    """Оценка памяти индекса: векторы float32 плюс тексты фрагментов в docstore."""
+    if vs is None:
+        return 0
+    texts = sum(len(doc.page_content.encode()) for doc in vs.docstore._dict.values())
+    return vs.index.ntotal * vs.index.d * 4 + texts
+
+
+def _write_atomic(path: str, content: str) -> None:
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class GuidelineCorpus:
+    """
+    Корпус рекомендаций по ТЗ: набор документов и общий FAISS-индекс по ним.
+
+    Каждое изменение (добавление, замена, удаление документа) применяется к копии индекса:
+    эмбеддятся только новые фрагменты, удалённые убираются по ID. Копия сохраняется
+    как новая версия, после чего указатель CURRENT и снимок в памяти переключаются
+    атомарно — читатели видят либо старую, либо новую версию целиком.
+    """
+
+    def __init__(self, embedding_model, index_dir: str = DEFAULT_INDEX_DIR, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, namespace: str = DEFAULT_NAMESPACE):
+        self.embedding_model = embedding_model
+        self.index_dir = index_dir
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.namespace = namespace
+        self.root = corpus_root(embedding_model, index_dir, chunk_size, chunk_overlap, namespace)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._current_mtime = None
+        self._memory_bytes = 0
+
+    def _current_path(self) -> str:
+        return os.path.join(self.root, "CURRENT")
+
+    def _current_changed(self) -> bool:
+        # Другой процесс (воркер, management-команда) мог переключить версию
+        try:
+            return os.stat(self._current_path()).st_mtime_ns != self._current_mtime
+        except FileNotFoundError:
+            return False
+
+    def _load_locked(self) -> tuple:
+        if self._snapshot is not None:
+            return self._snapshot
+
+        version, vs, manifest = None, None, {"documents": {}}
+        if os.path.isfile(self._current_path()):
+            self._current_mtime = os.stat(self._current_path()).st_mtime_ns
+            with open(self._current_path(), encoding="utf-8") as f:
+                version = f.read().strip()
+            path = os.path.join(self.root, version)
+            with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+                manifest = json.load(f)
+            if os.path.isfile(os.path.join(path, "index.faiss")):
+                logger.info(f"Loading guideline index {self.namespace}/{version} from {path}")
+                vs = load_index(path, self.embedding_model)
+        self._snapshot = (version, vs, manifest)
+        self._memory_bytes = index_memory_bytes(vs)
+        return self._snapshot
+
+    def is_loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def memory_bytes(self) -> int:
+        return self._memory_bytes if self._snapshot is not None else 0
+
+    def unload(self) -> None:
+        """Выгружает индекс из памяти; следующее обращение загрузит его с диска заново."""
+        with self._lock:
+            self._snapshot = None
+            self._current_mtime = None
+            self._memory_bytes = 0
+
+    def snapshot(self) -> tuple[str | None, FAISS | None]:
+        """(версия, индекс) текущей версии; индекс None, если в корпусе нет ни одного фрагмента."""
+        snapshot = self._snapshot
+        if snapshot is None or self._current_changed():
+            with self._lock:
+                if self._current_changed():
+                    self._snapshot = None
+                snapshot = self._load_locked()
+        return snapshot[0], snapshot[1]
+
+    def documents(self) -> dict:
+        with self._lock:
+            return dict(self._load_locked()[2]["documents"])
+
+    def is_initialized(self) -> bool:
+        # Без загрузки индекса: достаточно, что корпус хоть раз сохранялся
+        return os.path.isfile(self._current_path()) or (self._snapshot is not None and self._snapshot[0] is not None)
+
+    def ingest(self, doc_id: str, path: str) -> str:
+        """Добавляет или заменяет документ; возвращает новую версию корпуса."""
+        sha256 = file_sha256(path)
+        with self._lock:
+            version, vs, manifest = self._load_locked()
+            old = manifest["documents"].get(doc_id)
+            if old is not None and old["sha256"] == sha256:
+                logger.info(f"Guideline document {doc_id} is unchanged, index {version} kept")
+                return version
+
+            chunks = split_document(path, self.chunk_size, self.chunk_overlap)
+            ids = chunk_ids(doc_id, chunks)
+            for chunk in chunks:
+                chunk.metadata["doc_id"] = doc_id
+
+            old_ids = set(old["chunk_ids"]) if old is not None else set()
+            removed = [chunk_id for chunk_id in old_ids if chunk_id not in set(ids)]
+            added = [(chunk_id, chunk) for chunk_id, chunk in zip(ids, chunks) if chunk_id not in old_ids]
+
+            vs = self._apply(vs, removed, added)
+            documents = dict(manifest["documents"])
+            documents[doc_id] = {"sha256": sha256, "path": path, "chunk_ids": ids}
+            logger.info(f"Guideline document {doc_id}: {len(added)} chunks embedded, "
+                        f"{len(ids) - len(added)} reused, {len(removed)} removed")
+            return self._commit_locked(vs, {"documents": documents})
+
+    def remove(self, doc_id: str) -> str | None:
+        with self._lock:
+            version, vs, manifest = self._load_locked()
+            old = manifest["documents"].get(doc_id)
+            if old is None:
+                return version
+            vs = self._apply(vs, old["chunk_ids"], [])
+            documents = {key: value for key, value in manifest["documents"].items() if key != doc_id}
+            return self._commit_locked(vs, {"documents": documents})
+
+    def rebuild(self) -> str:
+        """
+        Заново эмбеддит все документы корпуса (например, после обновления весов модели под тем же именем).
+        Новый индекс собирается целиком в стороне и фиксируется одной версией: до этого читатели видят
+        прежнюю версию, а при ошибке (документ пропал с диска и т.п.) она и остаётся текущей.
+        """
+        with self._lock:
+            _, _, manifest = self._load_locked()
+            documents, added = {}, []
+            for doc_id, document in manifest["documents"].items():
+                path = document["path"]
+                chunks = split_document(path, self.chunk_size, self.chunk_overlap)
+                ids = chunk_ids(doc_id, chunks)
+                for chunk in chunks:
+                    chunk.metadata["doc_id"] = doc_id
+                documents[doc_id] = {"sha256": file_sha256(path), "path": path, "chunk_ids": ids}
+                added.extend(zip(ids, chunks))
+            vs = self._apply(None, [], added)
+            logger.info(f"Guideline index {self.namespace} rebuilt: {len(documents)} documents, "
+                        f"{len(added)} chunks embedded")
+            return self._commit_locked(vs, {"documents": documents})
+
+    def _apply(self, vs: FAISS | None, removed: list[str], added: list[tuple]) -> FAISS | None:
+        if vs is not None and (removed or added):
+            vs = copy_index(vs)
+        if removed:
+            vs.delete(removed)
+        if added:
+            ids = [chunk_id for chunk_id, _ in added]
+            docs = [chunk for _, chunk in added]
+            if vs is None:
+                vs = FAISS.from_documents(docs, self.embedding_model, ids=ids)
+            else:
+                vs.add_documents(docs, ids=ids)
+        if vs is not None and vs.index.ntotal == 0:
+            return None
+        return vs
+
+    def _commit_locked(self, vs: FAISS | None, manifest: dict) -> str:
+        previous = self._snapshot[0] if self._snapshot else None
+        # Версия определяется составом фрагментов: одинаковое содержимое — одинаковая версия
+        state = json.dumps({doc_id: doc["chunk_ids"] for doc_id, doc in manifest["documents"].items()}, sort_keys=True)
+        version = hashlib.sha256(state.encode()).hexdigest()[:16]
+
+        save_index(vs, self.root, version, manifest)
+        _write_atomic(self._current_path(), version)
+        self._current_mtime = os.stat(self._current_path()).st_mtime_ns
+        self._snapshot = (version, vs, manifest)
+        self._memory_bytes = index_memory_bytes(vs)
+        logger.info(f"Guideline index {self.namespace} switched to {version}")
+
+        self._cleanup(keep={version, previous})
+        return version
+
+    def _cleanup(self, keep: set) -> None:
+        # Предыдущая версия остаётся на диске: её ещё могут читать через mmap другие воркеры
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and not name.startswith(".") and name not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def corpus_root(embedding_model, index_dir: str, chunk_size: int, chunk_overlap: int,
+                namespace: str = DEFAULT_NAMESPACE) -> str:
+    return os.path.join(namespace_dir(index_dir, namespace),
+                        corpus_key(embedding_model_name(embedding_model), chunk_size, chunk_overlap))
+
+
+# Корпуса в порядке последнего обращения (LRU); выгружаются индексы, сами объекты остаются
+_corpora = OrderedDict()
+_corpora_lock = threading.Lock()
+
+
+def get_corpus(embedding_model, index_dir: str = DEFAULT_INDEX_DIR, chunk_size: int = DEFAULT_CHUNK_SIZE,
+               chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, seed_doc_path: str | None = DEFAULT_DOC_PATH,
+               namespace: str = DEFAULT_NAMESPACE) -> GuidelineCorpus:
+    """
+    Общий на процесс корпус пространства имён для данной модели и нарезки; индекс загружается
+    при первом обращении. Новый корпус заполняется ранее загруженными в пространство документами.
+    В пространство по умолчанию при каждом вызове загружается документ seed_doc_path (исходный
+    tz_guidelines.docx): если файл изменился, его фрагменты эмбеддятся заново, иначе ingest()
+    сразу возвращает текущую версию.
+    """
+    root = corpus_root(embedding_model, index_dir, chunk_size, chunk_overlap, namespace)
+    with _corpora_lock:
+        corpus = _corpora.get(root)
+        if corpus is None:
+            corpus = GuidelineCorpus(embedding_model, index_dir, chunk_size, chunk_overlap, namespace)
+            _corpora[root] = corpus
+        _corpora.move_to_end(root)
+
+    initialized = corpus.is_initialized()
+    # Исходный документ мог измениться при деплое, а ключ корпуса от его содержимого не зависит
+    if seed_doc_path and namespace == DEFAULT_NAMESPACE and (not initialized or os.path.isfile(seed_doc_path)):
+        corpus.ingest(os.path.basename(seed_doc_path), seed_doc_path)
+    if not initialized:
+        for doc_id, path in stored_documents(index_dir, namespace).items():
+            corpus.ingest(doc_id, path)
+    corpus.snapshot()
+    _enforce_memory_budget(keep=root)
+    return corpus
+
+
+def _enforce_memory_budget(keep: str, budget_mb: float | None = None) -> None:
+    """Выгружает давно не использовавшиеся индексы, пока суммарный объём превышает бюджет."""
+    budget = (INDEX_MEMORY_BUDGET_MB if budget_mb is None else budget_mb) * 1024 * 1024
+    with _corpora_lock:
+        corpora = list(_corpora.items())
+    total = sum(corpus.memory_bytes() for _, corpus in corpora)
+    for root, corpus in corpora:
+        if total <= budget:
+            break
+        if root == keep or not corpus.is_loaded():
+            continue
+        total -= corpus.memory_bytes()
+        logger.info(f"Unloading guideline index {corpus.namespace} ({corpus.memory_bytes() / 1024 / 1024:.1f} MB) "
+                    f"to stay within {budget / 1024 / 1024:.0f} MB")
+        # Критики, уже получившие снимок, дорабатывают на нём: выгружается только ссылка корпуса
+        corpus.unload()
+
+
+def corpora_stats() -> dict:
+    with _corpora_lock:
+        corpora = list(_corpora.values())
+    return {
+        "budget_mb": INDEX_MEMORY_BUDGET_MB,
+        "loaded_mb": round(sum(corpus.memory_bytes() for corpus in corpora) / 1024 / 1024, 1),
+        "corpora": [
+            {"namespace": corpus.namespace, "loaded": corpus.is_loaded(),
+             "memory_mb": round(corpus.memory_bytes() / 1024 / 1024, 1)}
+            for corpus in corpora
+        ],
+    }
+
+
+def default_corpus(namespace: str = DEFAULT_NAMESPACE) -> GuidelineCorpus:
+    """Корпус пространства имён для модели эмбеддингов из общего реестра и параметров по умолчанию."""
+    from utils.model_registry import get_embedding_model
+
+    return get_corpus(get_embedding_model(), namespace=namespace)
+
+
+# === Фоновая загрузка документов ===
+# Один поток: изменения корпуса применяются строго по очереди
+_ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="guideline-ingest")
+# Завершённые задачи хранятся для опроса статуса, но не больше FINISHED_JOBS_KEPT последних
+FINISHED_JOBS_KEPT = int(os.environ.get("GUIDELINE_FINISHED_JOBS_KEPT", "100"))
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def documents_dir(index_dir: str = DEFAULT_INDEX_DIR, namespace: str = DEFAULT_NAMESPACE) -> str:
+    """Каталог, где хранятся исходники загруженных документов (для пересборки под другую модель)."""
+    return os.path.join(namespace_dir(index_dir, namespace), "documents")
+
+
+def store_document(doc_id: str, source, index_dir: str = DEFAULT_INDEX_DIR, namespace: str = DEFAULT_NAMESPACE) -> str:
+    """Сохраняет загруженный файл (путь или файловый объект) в каталог документов корпуса."""
+    os.makedirs(documents_dir(index_dir, namespace), exist_ok=True)
+    path = os.path.join(documents_dir(index_dir, namespace), doc_id)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    if isinstance(source, str):
+        shutil.copyfile(source, tmp_path)
+    else:
+        with open(tmp_path, "wb") as f:
+            for block in source.chunks() if hasattr(source, "chunks") else iter(lambda: source.read(1024 * 1024), b""):
+                f.write(block)
+    os.replace(tmp_path, path)
+    return path
+
+
+def stored_documents(index_dir: str = DEFAULT_INDEX_DIR, namespace: str = DEFAULT_NAMESPACE) -> dict:
+    directory = documents_dir(index_dir, namespace)
+    if not os.path.isdir(directory):
+        return {}
+    return {
+        name: os.path.join(directory, name)
+        for name in sorted(os.listdir(directory)) if not name.endswith(".tmp")
+    }
+
+
+def delete_document(doc_id: str, index_dir: str = DEFAULT_INDEX_DIR, namespace: str = DEFAULT_NAMESPACE) -> None:
+    """Удаляет сохранённый исходник, чтобы документ не вернулся при сборке корпуса под другую модель."""
+    path = os.path.join(documents_dir(index_dir, namespace), doc_id)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def _finish_job_locked(job_id: str, **fields) -> None:
+    _jobs[job_id].update(fields)
+    # Порядок _jobs — порядок завершения: самые давние завершённые задачи забываются первыми
+    _jobs.move_to_end(job_id)
+    finished = [key for key, job in _jobs.items() if job["status"] in ("done", "failed")]
+    for key in finished[:max(len(finished) - FINISHED_JOBS_KEPT, 0)]:
+        del _jobs[key]
+
+
+def _run_job(job_id: str, corpus_factory, action: str, doc_id: str, path: str | None) -> None:
+    with _jobs_lock:
+        _jobs[job_id]["status"] = "running"
+    try:
+        corpus = corpus_factory()
+        if action == "ingest":
+            version = corpus.ingest(doc_id, path)
+        else:
+            version = corpus.remove(doc_id)
+            delete_document(doc_id, corpus.index_dir, corpus.namespace)
+    except Exception as e:
+        logger.exception(f"Guideline job {job_id} ({action} {doc_id}) failed: {e}")
+        with _jobs_lock:
+            _finish_job_locked(job_id, status="failed", error=str(e))
+    else:
+        with _jobs_lock:
+            _finish_job_locked(job_id, status="done", version=version)
+
+
+def submit_job(corpus_factory, action: str, doc_id: str, path: str | None = None,
+               namespace: str = DEFAULT_NAMESPACE) -> str:
+    """
+    Ставит в очередь добавление/замену ("ingest") или удаление ("remove") документа.
+    corpus_factory вызывается уже в фоновом потоке — загрузка модели не блокирует запрос.
+    """
+    job_id = uuid.uuid4().hex
+    with _jobs_lock:
+        _jobs[job_id] = {"id": job_id, "action": action, "doc_id": doc_id, "namespace": namespace,
+                         "status": "queued", "version": None, "error": None}
+    _ingest_executor.submit(_run_job, job_id, corpus_factory, action, doc_id, path)
+    return job_id
+
+
+def get_job(job_id: str) -> dict | None:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+def list_jobs() -> list[dict]:
+    with _jobs_lock:
+        return [dict(job) for job in _jobs.values()]
@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU в памяти процесса для значений любого типа (векторы, списки ID и т.п.)
+    с ограничением по числу записей, без TTL и без второго уровня. Значения отдаются как есть,
+    поэтому изменяемые объекты не должны меняться после set().
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return value
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "size": size,
+            "max_entries": self.max_entries,
+            "hit_rate": round(counters["hits"] / lookups, 3) if lookups else 0.0,
+        }
@@ -1,31 +1,210 @@
+import asyncio
+import base64
+import hashlib
+import os
+import textwrap
+import weakref
+
+import httpx
 import requests
 import logging
 
+from utils.diagram_stats import render_stats
+from utils.mermaid_validator import validate_mermaid, diagram_type
+from utils.render_cache import render_cache
+from utils.sanitize_mermaid_code import sanitize_mermaid_code
+from utils.sanitize_mermaid_code_2 import sanitize_mermaid_code_2
+
 logger = logging.getLogger(__name__)
 
+KROKI_URL = "https://kroki.io/mermaid/png"
+KROKI_CONNECT_TIMEOUT = float(os.environ.get("KROKI_CONNECT_TIMEOUT", "10"))
+KROKI_READ_TIMEOUT = float(os.environ.get("KROKI_READ_TIMEOUT", "60"))
+# Проверять код локально (utils/mermaid_validator.py) до запроса к Kroki
+MERMAID_VALIDATION = os.environ.get("MERMAID_VALIDATION", "1") not in ("0", "false", "False")
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+# Сколько символов ответа Kroki (текст ошибки разбора) сохраняется для промпта исправления
+MAX_ERROR_DETAIL = 1000
+
 
 class MermaidRenderError(Exception):
     """Custom exception for Mermaid rendering errors"""
-    pass
+
+    def __init__(self, message: str, detail: str | None = None):
+        super().__init__(message)
+        # Текст ошибки от рендерера (например, "Parse error on line 3: ..."), если он есть
+        self.detail = detail
+
+
+def render_key(mermaid_code: str, output_format: str = "png") -> str:
+    """Ключ кэша рендера — sha256 от формата и нормализованного кода: отступы и пустые строки не важны."""
+    return hashlib.sha256(f"{output_format}\0{normalize_mermaid(mermaid_code)}".encode()).hexdigest()
 
 
 def render_mermaid_to_png(mermaid_code: str) -> bytes:
     if not mermaid_code or not isinstance(mermaid_code, str):
         raise ValueError("Mermaid code must be a non-empty string")
 
+    key = render_key(mermaid_code)
+    cached = render_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
         response = requests.post(
-            "https://kroki.io/mermaid/png",
+            KROKI_URL,
             json={"diagram_source": mermaid_code},
-            headers={"Content-Type": "application/json"}
+            headers={"Content-Type": "application/json"},
+            timeout=(KROKI_CONNECT_TIMEOUT, KROKI_READ_TIMEOUT),
         )
         response.raise_for_status()
 
+        render_cache.set(key, response.content)
         return response.content
 
+    except requests.exceptions.HTTPError as e:
+        logger.error(f"Kroki API request failed: {str(e)}")
+        raise MermaidRenderError(f"Kroki API request failed: {str(e)}",
+                                 detail=e.response.text.strip()[:MAX_ERROR_DETAIL] if e.response is not None else None)
     except requests.exceptions.RequestException as e:
         logger.error(f"Kroki API request failed: {str(e)}")
         raise MermaidRenderError(f"Kroki API request failed: {str(e)}")
     except Exception as e:
         logger.exception("Unexpected error during Mermaid rendering")
         raise MermaidRenderError(f"Error rendering Mermaid diagram: {str(e)}")
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    # httpx.AsyncClient привязан к event loop, поэтому держим по клиенту на loop
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(timeout=httpx.Timeout(KROKI_READ_TIMEOUT, connect=KROKI_CONNECT_TIMEOUT))
+        _async_clients[loop] = client
+    return client
+
+
+async def arender_mermaid_to_png(mermaid_code: str) -> bytes:
+    if not mermaid_code or not isinstance(mermaid_code, str):
+        raise ValueError("Mermaid code must be a non-empty string")
+
+    key = render_key(mermaid_code)
+    cached = await render_cache.aget(key)
+    if cached is not None:
+        return cached
+
+    try:
+        response = await _get_async_client().post(
+            KROKI_URL,
+            json={"diagram_source": mermaid_code},
+            headers={"Content-Type": "application/json"}
+        )
+        response.raise_for_status()
+
+        await render_cache.aset(key, response.content)
+        return response.content
+
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Kroki API request failed: {str(e)}")
+        raise MermaidRenderError(f"Kroki API request failed: {str(e)}",
+                                 detail=e.response.text.strip()[:MAX_ERROR_DETAIL])
+    except httpx.HTTPError as e:
+        logger.error(f"Kroki API request failed: {str(e)}")
+        raise MermaidRenderError(f"Kroki API request failed: {str(e)}")
+    except Exception as e:
+        logger.exception("Unexpected error during Mermaid rendering")
+        raise MermaidRenderError(f"Error rendering Mermaid diagram: {str(e)}")
+
+
+def normalize_mermaid(code: str) -> str:
+    """
+    Единый вид кода для сравнения кандидатов: переводы строк \n, без отступов и пустых строк.
+    Для типов, где отступы значимы (mindmap и др.), снимается только общий отступ.
+    """
+    text = code.replace("\r\n", "\n").replace("\r", "\n")
+    if diagram_type(text) in ("flowchart", "er", "c4"):
+        return "\n".join(line.strip() for line in text.split("\n") if line.strip())
+    return "\n".join(line.rstrip() for line in textwrap.dedent(text).split("\n")).strip("\n")
+
+
+def extract_candidates(code: str) -> tuple[list[str], list[str]]:
+    """
+    Кандидаты на рендер из ответа модели: код как есть, после sanitize_mermaid_code_2 и после
+    sanitize_mermaid_code — нормализованные, без повторов и без вариантов, которые не начинаются
+    с заголовка диаграммы (ответ с пояснениями или markdown-блоком заведомо не отрисуется).
+    Возвращает (кандидаты по порядку, нормализованные непустые результаты всех очисток).
+    """
+    candidates, outputs = [], []
+    for sanitize in (lambda c: c, sanitize_mermaid_code_2, sanitize_mermaid_code):
+        candidate = normalize_mermaid(sanitize(code) or "")
+        if not candidate:
+            continue
+        outputs.append(candidate)
+        if diagram_type(candidate) is None:
+            render_stats.add("implausible")
+        elif candidate in candidates:
+            render_stats.add("duplicates")
+        else:
+            candidates.append(candidate)
+    return candidates, outputs
+
+
+def render_candidates(title: str, code: str) -> tuple[list[str], list[str], str | None, str | None]:
+    """
+    Кандидаты extract_candidates(), прошедшие validate_mermaid(), — только они отправляются в Kroki.
+    Возвращает (прошедшие проверку кандидаты, результаты всех очисток, ошибки проверки
+    для промпта исправления или None, код, к строкам которого относятся эти ошибки).
+    """
+    candidates, outputs = extract_candidates(code)
+    valid, error, error_code = [], None, None
+    for candidate in candidates:
+        render_stats.add("candidates")
+        errors = validate_mermaid(candidate) if MERMAID_VALIDATION else []
+        if not errors:
+            valid.append(candidate)
+            continue
+        render_stats.add("rejected_by_validator")
+        logger.debug(f"Render candidate for {title} rejected: {errors}")
+        if error is None:
+            error, error_code = "\n".join(errors), candidate
+    if not candidates:
+        # Диаграммы в ответе не нашлось — модели уходит ошибка заголовка блока из markdown (или всего ответа)
+        error_code = normalize_mermaid(sanitize_mermaid_code_2(code) or code)
+        error = "\n".join(validate_mermaid(error_code))
+    if not valid:
+        render_stats.add("diagrams_without_kroki")
+    return valid, outputs, error, error_code
+
+
+def _record_saved_calls(outputs: list[str], rendered: str | None, kroki_calls: int) -> None:
+    # Без отбора кандидатов в Kroki уходил каждый непустой результат очистки по очереди до первого успешного
+    calls_before = outputs.index(rendered) + 1 if rendered is not None else len(outputs)
+    render_stats.add("kroki_calls_saved", max(calls_before - kroki_calls, 0))
+
+
+async def arender_diagram(title: str, code: str) -> tuple[str | None, str | None, str | None]:
+    """
+    Рендерит код диаграммы в PNG (base64): по очереди кандидатов render_candidates(), прошедших
+    локальную проверку. Возвращает (png в base64, None, None) или (None, ошибка, код) — ошибку
+    рендерера или, если в Kroki ничего не отправлялось, ошибки проверки с номерами строк, и тот
+    нормализованный кандидат, к которому они относятся; по ним модель исправляет диаграмму.
+    """
+    candidates, outputs, error, error_code = render_candidates(title, code)
+    kroki_error = None
+    for kroki_calls, clear_code in enumerate(candidates, start=1):
+        render_stats.add("kroki_calls")
+        try:
+            png_bytes = await arender_mermaid_to_png(clear_code)
+            _record_saved_calls(outputs, clear_code, kroki_calls)
+            return base64.b64encode(png_bytes).decode(), None, None
+        except Exception as e:
+            logger.debug(f"Render attempt failed for {title}: {e}")
+            if kroki_error is None:
+                kroki_error = getattr(e, "detail", None) or str(e)
+                error, error_code = kroki_error, clear_code
+    _record_saved_calls(outputs, None, len(candidates))
+    logger.warning(f"Error rendering diagram {title}: {error}")
+    return None, error or "render failed", error_code or code
@@ -0,0 +1,353 @@
+import re
+
+# Типы диаграмм, которые генерируют наши агенты: их синтаксис проверяется построчно
+FLOWCHART_HEADER_RE = re.compile(r"^(graph|flowchart)(?:\s+(\S+))?\s*;?$")
+FLOWCHART_DIRECTIONS = {"TD", "TB", "BT", "RL", "LR"}
+C4_HEADERS = {"C4Context", "C4Container", "C4Component", "C4Dynamic", "C4Deployment"}
+# Остальные типы Mermaid не разбираются — такой код уходит в рендерер без проверки
+OTHER_HEADERS = {
+    "sequenceDiagram", "classDiagram", "classDiagram-v2", "stateDiagram", "stateDiagram-v2", "gantt", "journey",
+    "pie", "gitGraph", "mindmap", "timeline", "quadrantChart", "requirementDiagram", "sankey-beta", "xychart-beta",
+    "block-beta", "packet-beta", "architecture-beta", "kanban", "zenuml",
+}
+
+MAX_ERRORS = 10
+MAX_SNIPPET = 80
+
+# --- flowchart ---
+NODE_ID_RE = re.compile(r"\w+(?:[.\-]\w+)*")
+# Формы узлов: открывающие скобки (длинные раньше коротких) и закрывающие к ним
+NODE_SHAPES = [
+    ("(((", (")))",)), ("((", ("))",)), ("([", ("])",)), ("[[", ("]]",)), ("[(", (")]",)), ("{{", ("}}",)),
+    ("[/", ("/]", "\\]")), ("[\\", ("\\]", "/]")), ("(", (")",)), ("[", ("]",)), ("{", ("}",)), (">", ("]",)),
+]
+LINK_END = r"(?:-{2,}[>ox]|-{3,}|={2,}[>ox]|={3,}|\.-+[>ox]?|-\.+-[>ox]?)"
+LINK_RE = re.compile(r"\s*[<ox]?(?:-{2,}[>ox]|-{3,}|={2,}[>ox]|={3,}|-\.+-[>ox]?)")
+TEXT_LINK_RE = re.compile(rf"\s*[<ox]?(?:--|==|-\.)\s*([^|]*?)\s*{LINK_END}")
+LINK_LABEL_RE = re.compile(r"\s*\|([^|]*)\|")
+CLASS_SUFFIX_RE = re.compile(r":::\w+")
+SUBGRAPH_RE = re.compile(r"^subgraph\b(.*)$")
+FLOWCHART_SKIP_RE = re.compile(r"^(?:classDef|class|style|linkStyle|click|direction|accTitle|accDescr)\b")
+# Синтаксис, который проверка не разбирает: метаданные узлов и связей (A@{ shape: rect }) и id связей
+# (A e1@--> B). Такие строки пропускаются — их проверит рендерер
+UNMODELED_RE = re.compile(r"@\{|\w@[-=.~<ox]")
+BRACKET_CHARS = set("[](){}")
+
+# --- erDiagram ---
+ER_ENTITY_RE = re.compile(r'^(?:\w[\w\-]*|"[^"]+")(?:\s*\[\s*"?[^\]]*"?\s*\])?$')
+ER_BLOCK_RE = re.compile(r'^(\w[\w\-]*|"[^"]+")(?:\s*\[\s*"?[^\]]*"?\s*\])?\s*\{\s*$')
+ER_KEYS = r"(?:PK|FK|UK)(?:\s*,\s*(?:PK|FK|UK))*"
+# Тип и имя атрибута: varchar(255), decimal(10,2), string[], *id
+ER_WORD = r"\*?\w[\w\-]*(?:\([\d\s,]*\))?(?:\[\])?"
+ER_ATTRIBUTE_RE = re.compile(rf'^{ER_WORD}\s+{ER_WORD}(?:\s+{ER_KEYS})?(?:\s+"[^"]*")?$')
+ER_SKIP_RE = re.compile(r"^(?:direction|style|classDef|class|accTitle|accDescr)\b")
+ER_RELATION_RE = re.compile(
+    r'^(\w[\w\-]*|"[^"]+")\s*(\|o|\|\||\}o|\}\|)(--|\.\.)(o\||\|\||o\{|\|\{)\s*(\w[\w\-]*|"[^"]+")'
+    r'\s*:\s*(\S.*)$')
+
+# --- C4 ---
+C4_ELEMENTS = {
+    "Person", "Person_Ext", "System", "System_Ext", "SystemDb", "SystemDb_Ext", "SystemQueue", "SystemQueue_Ext",
+    "Container", "Container_Ext", "ContainerDb", "ContainerDb_Ext", "ContainerQueue", "ContainerQueue_Ext",
+    "Component", "Component_Ext", "ComponentDb", "ComponentDb_Ext", "ComponentQueue", "ComponentQueue_Ext",
+}
+C4_BOUNDARIES = {
+    "Boundary", "Enterprise_Boundary", "System_Boundary", "Container_Boundary",
+    "Deployment_Node", "Node", "Node_L", "Node_R",
+}
+C4_RELATIONS = {
+    "Rel", "BiRel", "Rel_U", "Rel_Up", "Rel_D", "Rel_Down", "Rel_L", "Rel_Left", "Rel_R", "Rel_Right", "Rel_Back",
+    "RelIndex",
+}
+C4_STYLES = {"UpdateElementStyle", "UpdateRelStyle", "UpdateBoundaryStyle", "UpdateLayoutConfig"}
+C4_CALL_RE = re.compile(r"^(\w+)\s*\((.*)\)\s*(\{)?\s*$")
+
+
+def _snippet(line: str) -> str:
+    return line if len(line) <= MAX_SNIPPET else line[:MAX_SNIPPET] + "…"
+
+
+def _strip_comment(line: str) -> str:
+    """Отрезает комментарий %% в конце строки (A --> B %% note); %% внутри кавычек — часть текста."""
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == "%" and not quoted and line.startswith("%%", i):
+            return line[:i].rstrip()
+    return line
+
+
+def _statements(code: str):
+    """(номер строки, текст) без пустых строк, комментариев %% и директив %%{...}%%."""
+    lines = code.splitlines()
+    start = 0
+    # Front matter (---\ntitle: ...\n---) перед заголовком
+    first = next((i for i, line in enumerate(lines) if line.strip()), None)
+    if first is not None and lines[first].strip() == "---":
+        closing = next((i for i in range(first + 1, len(lines)) if lines[i].strip() == "---"), None)
+        if closing is not None:
+            start = closing + 1
+    for number in range(start, len(lines)):
+        line = _strip_comment(lines[number].strip())
+        if line:
+            yield number + 1, line
+
+
+def _split_quoted(text: str, separator: str) -> list[str] | None:
+    """Делит строку по separator вне кавычек; None, если кавычка не закрыта."""
+    parts, current, quoted = [], [], False
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        if char == separator and not quoted:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    if quoted:
+        return None
+    parts.append("".join(current))
+    return parts
+
+
+def _parse_node(text: str, pos: int) -> tuple[int, str | None, str | None]:
+    """Узел flowchart с позиции pos: (новая позиция, id узла, ошибка)."""
+    match = NODE_ID_RE.match(text, pos)
+    if not match:
+        found = text[pos] if pos < len(text) else "end of line"
+        return pos, None, f"expected node id, found '{found}'"
+    node_id, pos = match.group(), match.end()
+    for opening, closings in NODE_SHAPES:
+        if not text.startswith(opening, pos):
+            continue
+        start = pos + len(opening)
+        if text.startswith('"', start):
+            quote_end = text.find('"', start + 1)
+            if quote_end == -1:
+                return pos, node_id, f"unclosed quote in node '{node_id}'"
+            start = quote_end + 1
+        ends = [(text.find(closing, start), closing) for closing in closings]
+        ends = [(end, closing) for end, closing in ends if end != -1]
+        if not ends:
+            return pos, node_id, f"unclosed '{opening}' in node '{node_id}'"
+        end, closing = min(ends)
+        label = text[start:end]
+        if BRACKET_CHARS & set(label):
+            return pos, node_id, (f"brackets inside unquoted text of node '{node_id}', "
+                                  f"wrap the text in double quotes")
+        if '"' in label:
+            return pos, node_id, f"stray quote in text of node '{node_id}'"
+        pos = end + len(closing)
+        break
+    match = CLASS_SUFFIX_RE.match(text, pos)
+    if match:
+        pos = match.end()
+    return pos, node_id, None
+
+
+def _parse_link(text: str, pos: int) -> tuple[int, str | None]:
+    """Связь с позиции pos (с подписью -- текст --> или -->|текст|): (новая позиция, ошибка) или (pos, None)."""
+    match = LINK_RE.match(text, pos) or TEXT_LINK_RE.match(text, pos)
+    if not match:
+        return pos, None
+    pos = match.end()
+    if text[pos:].lstrip().startswith("|"):
+        label = LINK_LABEL_RE.match(text, pos)
+        if not label:
+            return pos, "unclosed '|' in link label"
+        pos = label.end()
+    return pos, ""
+
+
+def _validate_flowchart_statement(statement: str) -> str | None:
+    """Цепочка узлов и связей: A --> B & C -->|подпись| D."""
+    pos, expect_node = 0, True
+    while True:
+        if expect_node:
+            pos, node_id, error = _parse_node(statement, pos)
+            if error:
+                return error
+            if node_id == "end":
+                return "'end' is a reserved word and cannot be used as a node id"
+            expect_node = False
+            continue
+        rest = statement[pos:].strip()
+        if not rest or rest == ";":
+            return None
+        if rest.startswith("&"):
+            pos = statement.index("&", pos) + 1
+            while pos < len(statement) and statement[pos].isspace():
+                pos += 1
+            expect_node = True
+            continue
+        new_pos, error = _parse_link(statement, pos)
+        if error is None:
+            return f"unexpected '{_snippet(rest)}' after node"
+        if error:
+            return error
+        pos = new_pos
+        while pos < len(statement) and statement[pos].isspace():
+            pos += 1
+        if pos >= len(statement) or statement[pos] == ";":
+            return "link without target node"
+        expect_node = True
+
+
+def _validate_flowchart(lines: list[tuple[int, str]]) -> list[str]:
+    errors = []
+    subgraphs = []
+    metadata = False
+    for number, line in lines:
+        if metadata:
+            # Многострочный блок A@{ ... } заканчивается строкой с '}'
+            metadata = "}" not in line
+            continue
+        if UNMODELED_RE.search(line):
+            opening = line.rfind("@{")
+            metadata = opening != -1 and "}" not in line[opening:]
+            continue
+        for statement in _split_quoted(line, ";") or [line]:
+            statement = statement.strip()
+            if not statement:
+                continue
+            if statement == "end":
+                if subgraphs:
+                    subgraphs.pop()
+                else:
+                    errors.append(f"line {number}: 'end' without matching 'subgraph'")
+                continue
+            if SUBGRAPH_RE.match(statement):
+                subgraphs.append(number)
+                continue
+            if FLOWCHART_SKIP_RE.match(statement):
+                continue
+            error = _validate_flowchart_statement(statement)
+            if error:
+                errors.append(f"line {number}: {error}: {_snippet(statement)}")
+    errors.extend(f"line {number}: 'subgraph' is not closed with 'end'" for number in subgraphs)
+    return errors
+
+
+def _validate_er(lines: list[tuple[int, str]]) -> list[str]:
+    errors = []
+    block = None
+    for number, line in lines:
+        if block is not None:
+            if line == "}":
+                block = None
+            elif not ER_ATTRIBUTE_RE.match(line):
+                errors.append(f"line {number}: invalid attribute, expected 'type name [PK|FK|UK] [\"comment\"]' "
+                              f"without trailing commas: {_snippet(line)}")
+            continue
+        if ER_BLOCK_RE.match(line):
+            block = number
+        elif line == "}":
+            errors.append(f"line {number}: '}}' without an entity block")
+        elif ER_RELATION_RE.match(line) or ER_ENTITY_RE.match(line) or ER_SKIP_RE.match(line):
+            continue
+        elif "--" in line or ".." in line:
+            errors.append(f"line {number}: invalid relationship, expected 'A ||--o{{ B : label': {_snippet(line)}")
+        else:
+            errors.append(f"line {number}: unexpected statement: {_snippet(line)}")
+    if block is not None:
+        errors.append(f"line {block}: entity block is not closed with '}}'")
+    return errors
+
+
+def _validate_c4(lines: list[tuple[int, str]]) -> list[str]:
+    errors = []
+    boundaries = []
+    for number, line in lines:
+        if line == "}":
+            if boundaries:
+                boundaries.pop()
+            else:
+                errors.append(f"line {number}: '}}' without an open boundary")
+            continue
+        if line.startswith("title ") or line.startswith("accTitle") or line.startswith("accDescr"):
+            continue
+        match = C4_CALL_RE.match(line)
+        if not match:
+            errors.append(f"line {number}: expected a C4 call like 'Person(alias, \"Label\")': {_snippet(line)}")
+            continue
+        name, arguments, opens = match.groups()
+        args = _split_quoted(arguments, ",")
+        if args is None:
+            errors.append(f"line {number}: unclosed quote: {_snippet(line)}")
+            continue
+        args = [arg.strip() for arg in args if arg.strip()]
+        if name in C4_BOUNDARIES or name in C4_ELEMENTS:
+            minimum = 2
+        elif name in C4_RELATIONS:
+            minimum = 4 if name == "RelIndex" else 3
+        elif name in C4_STYLES:
+            minimum = 1
+        else:
+            errors.append(f"line {number}: unknown C4 element '{name}': {_snippet(line)}")
+            continue
+        if len(args) < minimum:
+            errors.append(f"line {number}: '{name}' needs at least {minimum} arguments: {_snippet(line)}")
+        if opens:
+            if name in C4_BOUNDARIES:
+                boundaries.append(number)
+            else:
+                errors.append(f"line {number}: only boundaries can contain elements, '{name}' cannot: "
+                              f"{_snippet(line)}")
+        elif name in C4_BOUNDARIES:
+            errors.append(f"line {number}: boundary '{name}' must be followed by '{{': {_snippet(line)}")
+    errors.extend(f"line {number}: boundary is not closed with '}}'" for number in boundaries)
+    return errors
+
+
+def diagram_type(code: str) -> str | None:
+    """Тип диаграммы по первой значимой строке: "flowchart", "er", "c4", "other" или None, если заголовка нет."""
+    header = next((line for _, line in _statements(code)), None)
+    if header is None:
+        return None
+    keyword = header.split()[0]
+    if FLOWCHART_HEADER_RE.match(header) or keyword in ("graph", "flowchart"):
+        return "flowchart"
+    if keyword == "erDiagram":
+        return "er"
+    if keyword in C4_HEADERS:
+        return "c4"
+    if keyword in OTHER_HEADERS:
+        return "other"
+    return None
+
+
+def validate_mermaid(code: str) -> list[str]:
+    """
+    Проверяет код Mermaid до отправки в рендерер: заголовок, узлы, связи, скобки и блоки
+    (subgraph/end, сущности ER, границы C4) для типов, которые генерируют агенты.
+    Возвращает ошибки вида "line N: ..." — пустой список, если ошибок не найдено.
+    Прочие типы Mermaid и конструкции, которые проверка не разбирает (UNMODELED_RE), не проверяются —
+    их проверяет рендерер.
+    """
+    lines = list(_statements(code or ""))
+    if not lines:
+        return ["diagram is empty"]
+    number, header = lines[0]
+    kind = diagram_type(code)
+    if kind is None:
+        return [f"line {number}: unknown diagram type, expected 'graph TD', 'flowchart TB', 'erDiagram' "
+                f"or 'C4Context': {_snippet(header)}"]
+    body = lines[1:]
+    if kind == "flowchart":
+        match = FLOWCHART_HEADER_RE.match(header)
+        if not match or (match.group(2) and match.group(2).rstrip(";") not in FLOWCHART_DIRECTIONS):
+            errors = [f"line {number}: invalid flowchart header, expected 'graph TD' or 'flowchart TB': "
+                      f"{_snippet(header)}"]
+        else:
+            errors = []
+        errors += _validate_flowchart(body)
+    elif kind == "er":
+        errors = [] if header == "erDiagram" else [f"line {number}: unexpected text after 'erDiagram'"]
+        errors += _validate_er(body)
+    elif kind == "c4":
+        errors = [] if header in C4_HEADERS else [f"line {number}: unexpected text after '{header.split()[0]}'"]
+        errors += _validate_c4(body)
+    else:
+        return []
+    return errors[:MAX_ERRORS]
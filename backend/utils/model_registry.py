@@ -0,0 +1,124 @@
+import logging
+import os
+import resource
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def current_rss_mb() -> float:
+    """
+    Текущий RSS процесса в мегабайтах (на Linux — из /proc, иначе пиковый RSS).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ModelRegistry:
+    """
+    Потокобезопасный реестр тяжёлых объектов (эмбеддинги, LLM-клиент),
+    которые загружаются один раз на процесс и переиспользуются всеми запросами.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._models = {}
+        self._locks = {}
+        self._stats = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name: str, factory) -> None:
+        with self._registry_lock:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        if name not in self._factories:
+            raise KeyError(f"Model '{name}' is not registered")
+
+        with self._locks[name]:
+            model = self._models.get(name)
+            if model is not None:
+                return model
+
+            rss_before = current_rss_mb()
+            started = time.perf_counter()
+            model = self._factories[name]()
+            load_seconds = time.perf_counter() - started
+            rss_delta = current_rss_mb() - rss_before
+
+            self._stats[name] = {"load_seconds": round(load_seconds, 3), "rss_delta_mb": round(rss_delta, 1)}
+            logger.info(f"Model '{name}' loaded in {load_seconds:.2f}s, RSS +{rss_delta:.1f} MB")
+            self._models[name] = model
+        return model
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def warm_up(self) -> None:
+        """Загружает все зарегистрированные модели заранее (например, из AppConfig.ready())."""
+        for name in list(self._factories):
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.exception(f"Error preloading model '{name}': {e}")
+
+    def stats(self) -> dict:
+        return {
+            "models": dict(self._stats),
+            "rss_mb": round(current_rss_mb(), 1),
+        }
+
+
+def _build_embedding_model():
+    from utils.embedding_backends import build_embeddings
+    from utils.embedding_batcher import BatchingEmbeddings, EMBEDDING_BATCHING
+
+    # Бэкенд (torch / onnx / onnx-int8 / small) выбирается переменной EMBEDDING_BACKEND
+    embeddings = build_embeddings()
+    # Одновременные запросы кодируются одним батчем вместо отдельных проходов модели
+    return BatchingEmbeddings(embeddings) if EMBEDDING_BATCHING else embeddings
+
+
+def _build_llm():
+    from utils.gigachat_auth import SharedTokenGigaChat, default_token_provider
+    from utils.token_usage import TokenUsageCallback
+
+    # Токен берётся у общего провайдера, а не через собственную OAuth-авторизацию клиента
+    return SharedTokenGigaChat(
+        token_provider=default_token_provider(),
+        base_url="https://gigachat.devices.sberbank.ru/api/v1",
+        scope="GIGACHAT_API_PERS",
+        verify_ssl_certs=False,
+        # Токены на входе и выходе каждого вызова критика — в лог и в /chat/stats
+        callbacks=[TokenUsageCallback("critic")],
+    )
+
+
+def _build_tokenizer():
+    from utils.prompt_budget import load_tokenizer
+
+    return load_tokenizer()
+
+
+registry = ModelRegistry()
+registry.register("embedding", _build_embedding_model)
+registry.register("llm", _build_llm)
+registry.register("tokenizer", _build_tokenizer)
+
+
+def get_embedding_model():
+    return registry.get("embedding")
+
+
+def get_llm():
+    return registry.get("llm")
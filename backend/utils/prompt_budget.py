@@ -0,0 +1,218 @@
+import hashlib
+import logging
+import os
+import re
+
+from utils.completion_cache import CompletionCache, CACHE_DB
+from utils.cpu_pool import run_cpu
+from utils.model_registry import registry
+from utils.single_flight import summary_flight
+
+logger = logging.getLogger(__name__)
+
+# Токенизатор GigaChat с Hugging Face; если он недоступен — токенизатор модели эмбеддингов, затем оценка по символам
+PROMPT_TOKENIZER = os.environ.get("PROMPT_TOKENIZER", "ai-sage/GigaChat-20B-A3B-instruct")
+APPROX_CHARS_PER_TOKEN = 3
+DEFAULT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "6000"))
+# Бюджеты отдельных агентов: "description=3000,requirements=8000,diagrams=10000"
+AGENT_TOKEN_BUDGETS = {
+    name.strip(): int(value)
+    for name, _, value in (item.partition("=") for item in os.environ.get("AGENT_TOKEN_BUDGETS", "").split(","))
+    if name.strip() and value.strip()
+}
+# До скольких токенов сжимается один фрагмент, не поместившийся в бюджет
+SUMMARY_TOKENS = int(os.environ.get("PROMPT_SUMMARY_TOKENS", "400"))
+SUMMARY_CACHE_SIZE = int(os.environ.get("PROMPT_SUMMARY_CACHE_SIZE", "512"))
+
+# Краткое изложение текста не устаревает — храним без TTL (и в Postgres, если включён второй уровень кэша)
+summary_cache = CompletionCache(max_entries=SUMMARY_CACHE_SIZE, ttl=float("inf"), use_db=CACHE_DB, enabled=True,
+                                name="summaries")
+
+# Разделы собранного ТЗ: «1. Общее описание проекта:» и т.п. в начале строки
+SECTION_HEADING_RE = re.compile(r"^\d+\.\s+\S.*:\s*$", re.MULTILINE)
+
+
+class Tokenizer:
+    """Подсчёт и обрезка по токенам; без модели — оценка APPROX_CHARS_PER_TOKEN символа на токен."""
+
+    def __init__(self, tokenizer=None, name: str = "approx"):
+        self.tokenizer = tokenizer
+        self.name = name
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.tokenizer is None:
+            return -(-len(text) // APPROX_CHARS_PER_TOKEN)
+        return len(self.tokenizer.encode(text, add_special_tokens=False, verbose=False))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Первые max_tokens токенов текста."""
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        if self.tokenizer is None or not getattr(self.tokenizer, "is_fast", False):
+            return text[:max_tokens * APPROX_CHARS_PER_TOKEN]
+        offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True,
+                                 verbose=False)["offset_mapping"]
+        return text[:offsets[max_tokens - 1][1]]
+
+
+def load_tokenizer() -> Tokenizer:
+    from transformers import AutoTokenizer
+    from utils.embedding_backends import EMBEDDING_MODEL_NAME
+
+    for name in (PROMPT_TOKENIZER, EMBEDDING_MODEL_NAME):
+        try:
+            return Tokenizer(AutoTokenizer.from_pretrained(name), name)
+        except Exception as e:
+            logger.warning(f"Tokenizer '{name}' is not available: {e}")
+    logger.warning(f"Counting prompt tokens approximately, {APPROX_CHARS_PER_TOKEN} characters per token")
+    return Tokenizer()
+
+
+def get_tokenizer() -> Tokenizer:
+    return registry.get("tokenizer")
+
+
+def count_tokens(text: str) -> int:
+    return get_tokenizer().count(text)
+
+
+def budget_for(name: str) -> int:
+    return AGENT_TOKEN_BUDGETS.get(name, DEFAULT_TOKEN_BUDGET)
+
+
+def split_sections(text: str) -> list[str]:
+    """Разделы собранного ТЗ по заголовкам «N. Название:»; без заголовков — абзацы."""
+    starts = [match.start() for match in SECTION_HEADING_RE.finditer(text)]
+    if not starts:
+        return [paragraph for paragraph in text.split("\n\n") if paragraph.strip()]
+    if starts[0] > 0:
+        starts.insert(0, 0)
+    return [text[start:end].strip() for start, end in zip(starts, starts[1:] + [len(text)]) if text[start:end].strip()]
+
+
+def summary_key(text: str, max_tokens: int) -> str:
+    return hashlib.sha256(f"summary:{max_tokens}\0{text}".encode()).hexdigest()
+
+
+def build_summary_prompt(text: str, max_tokens: int) -> str:
+    prompt = f"""
+        Сократи фрагмент технического задания примерно до {max_tokens} токенов.
+        Сохрани все сущности, роли, требования, числа и связи между ними, убери повторы и пояснения.
+
+        Фрагмент:
+        {text}
+
+        Верни только сокращённый текст.
+        """
+    return prompt.strip()
+
+
+def _summarize(key: str, text: str, max_tokens: int, llm_callable, token: str) -> str:
+    summary = llm_callable(build_summary_prompt(text, max_tokens), token).strip()
+    summary_cache.set(key, summary)
+    return summary
+
+
+async def _asummarize(key: str, text: str, max_tokens: int, allm_callable, token: str) -> str:
+    summary = (await allm_callable(build_summary_prompt(text, max_tokens), token)).strip()
+    await summary_cache.aset(key, summary)
+    return summary
+
+
+def summarize(text: str, max_tokens: int, llm_callable, token: str) -> str:
+    # Диаграммы одного ТЗ собираются параллельно и сжимают одни и те же разделы — сжимаем один раз
+    key = summary_key(text, max_tokens)
+    summary = summary_cache.get(key)
+    if summary is None:
+        summary = summary_flight.do(key, _summarize, key, text, max_tokens, llm_callable, token)
+    return summary
+
+
+async def asummarize(text: str, max_tokens: int, allm_callable, token: str) -> str:
+    key = summary_key(text, max_tokens)
+    summary = await summary_cache.aget(key)
+    if summary is None:
+        summary = await summary_flight.ado(key, _asummarize, key, text, max_tokens, allm_callable, token)
+    return summary
+
+
+class PromptBuilder:
+    """
+    Собирает промпт в пределах бюджета токенов.
+
+    render(parts) строит промпт из словаря частей. Если он не помещается, части из to_summarize
+    по очереди сжимаются через LLM до SUMMARY_TOKENS (краткие изложения кэшируются), затем
+    части из to_drop по очереди выбрасываются — в обоих списках сначала самое старое или наименее
+    важное. Последней мерой обрезается часть required.
+    """
+
+    def __init__(self, name: str, render, budget: int | None = None):
+        self.name = name
+        self.render = render
+        self.budget = budget or budget_for(name)
+
+    def _overflow(self, parts: dict) -> int:
+        return count_tokens(self.render(parts)) - self.budget
+
+    def _steps(self, parts: dict, to_summarize: list[str], to_drop: list[str]):
+        """Шаги сокращения ("summarize", имя) и ("drop", имя), пока промпт не влезет в бюджет."""
+        for name in to_summarize:
+            if self._overflow(parts) <= 0:
+                return
+            if count_tokens(parts[name]) > SUMMARY_TOKENS:
+                yield "summarize", name
+        for name in to_drop:
+            if self._overflow(parts) <= 0:
+                return
+            yield "drop", name
+
+    def _finish(self, parts: dict, required: str | None, original_tokens: int) -> str:
+        overflow = self._overflow(parts)
+        if overflow > 0 and required:
+            parts[required] = get_tokenizer().truncate(parts[required], count_tokens(parts[required]) - overflow)
+        prompt = self.render(parts)
+        logger.info(f"Prompt '{self.name}' reduced from {original_tokens} to {count_tokens(prompt)} tokens "
+                    f"(budget {self.budget})")
+        return prompt
+
+    def build(self, parts: dict, to_summarize: list[str] = (), to_drop: list[str] = (), required: str | None = None,
+              llm_callable=None, token: str | None = None) -> str:
+        parts = dict(parts)
+        original_tokens = count_tokens(self.render(parts))
+        if original_tokens <= self.budget:
+            return self.render(parts)
+        for action, name in self._steps(parts, list(to_summarize) if llm_callable else [], list(to_drop)):
+            if action == "summarize":
+                parts[name] = summarize(parts[name], SUMMARY_TOKENS, llm_callable, token)
+            else:
+                parts[name] = ""
+        return self._finish(parts, required, original_tokens)
+
+    async def abuild(self, parts: dict, to_summarize: list[str] = (), to_drop: list[str] = (),
+                     required: str | None = None, allm_callable=None, token: str | None = None) -> str:
+        if not registry.is_loaded("tokenizer"):
+            # Первая загрузка токенизатора (возможно, со скачиванием) — не в event loop
+            await run_cpu(get_tokenizer)
+        parts = dict(parts)
+        original_tokens = count_tokens(self.render(parts))
+        if original_tokens <= self.budget:
+            return self.render(parts)
+        for action, name in self._steps(parts, list(to_summarize) if allm_callable else [], list(to_drop)):
+            if action == "summarize":
+                parts[name] = await asummarize(parts[name], SUMMARY_TOKENS, allm_callable, token)
+            else:
+                parts[name] = ""
+        return self._finish(parts, required, original_tokens)
+
+
+def stats() -> dict:
+    return {
+        "tokenizer": get_tokenizer().name if registry.is_loaded("tokenizer") else None,
+        "default_budget": DEFAULT_TOKEN_BUDGET,
+        "budgets": dict(AGENT_TOKEN_BUDGETS),
+        "summaries": summary_cache.stats(),
+    }
@@ -0,0 +1,208 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from utils.cpu_pool import run_cpu
+
+logger = logging.getLogger(__name__)
+
+RENDER_CACHE_ENABLED = os.environ.get("MERMAID_RENDER_CACHE", "1") not in ("0", "false", "False")
+RENDER_CACHE_MEMORY_MB = float(os.environ.get("MERMAID_RENDER_CACHE_MEMORY_MB", "64"))
+# Второй уровень — файлы в каталоге, общем для всех воркеров; пустое значение отключает его
+RENDER_CACHE_DIR = os.environ.get("MERMAID_RENDER_CACHE_DIR", "render_cache")
+RENDER_CACHE_DISK_MB = float(os.environ.get("MERMAID_RENDER_CACHE_DISK_MB", "512"))
+
+
+class RenderCache:
+    """
+    Кэш отрисованных диаграмм с адресацией по содержимому: ключ — хэш нормализованного кода
+    и формата, значение — байты картинки.
+
+    Первый уровень — LRU в памяти процесса с ограничением по суммарному размеру, второй — файлы
+    в каталоге directory: при превышении max_disk_bytes удаляются давно не читанные. Ошибки
+    второго уровня не ломают рендер: кэш просто считается промахнувшимся.
+    """
+
+    def __init__(self, max_memory_bytes: int = int(RENDER_CACHE_MEMORY_MB * 1024 * 1024),
+                 directory: str | None = RENDER_CACHE_DIR,
+                 max_disk_bytes: int = int(RENDER_CACHE_DISK_MB * 1024 * 1024), enabled: bool = RENDER_CACHE_ENABLED):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory or None
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        # Размер каталога считается при первом обращении и дальше ведётся по записям этого процесса
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _get_memory(self, key: str) -> bytes | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def _set_memory(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._entries[key] = value
+            self._memory_bytes += len(value)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self._counters["evictions"] += 1
+
+    def _get_disk(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            # Время изменения служит временем последнего чтения для вытеснения
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Render cache disk lookup failed: {e}")
+            return None
+
+    def _disk_size(self) -> int:
+        total = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    total += entry.stat().st_size
+        return total
+
+    def _evict_disk(self) -> None:
+        """Удаляет самые давние файлы, пока каталог не уменьшится до 90% бюджета."""
+        with os.scandir(self.directory) as entries:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries if entry.is_file()]
+        total = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 0.9
+        evicted = 0
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self._counters["disk_evictions"] += evicted
+
+    def _set_disk(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_disk_bytes:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._disk_bytes is None:
+                self._disk_bytes = self._disk_size()
+            # Запись через временный файл: другой воркер не прочитает недописанную картинку
+            tmp_path = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(value)
+                os.replace(tmp_path, self._path(key))
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            with self._lock:
+                self._disk_bytes += len(value)
+                over_budget = self._disk_bytes > self.max_disk_bytes
+            if over_budget:
+                self._evict_disk()
+        except OSError as e:
+            logger.warning(f"Render cache disk write failed: {e}")
+
+    def get(self, key: str) -> bytes | None:
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            self._count("hits")
+            return value
+
+        if self.directory:
+            value = self._get_disk(key)
+            if value is not None:
+                self._set_memory(key, value)
+                self._count("disk_hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    async def aget(self, key: str) -> bytes | None:
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            self._count("hits")
+            return value
+
+        if self.directory:
+            value = await run_cpu(self._get_disk, key)
+            if value is not None:
+                self._set_memory(key, value)
+                self._count("disk_hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value: bytes) -> None:
+        if not self.enabled:
+            return
+        self._set_memory(key, value)
+        if self.directory:
+            self._set_disk(key, value)
+
+    async def aset(self, key: str, value: bytes) -> None:
+        if not self.enabled:
+            return
+        self._set_memory(key, value)
+        if self.directory:
+            await run_cpu(self._set_disk, key, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+            memory_bytes = self._memory_bytes
+            disk_bytes = self._disk_bytes
+        lookups = counters["hits"] + counters["disk_hits"] + counters["misses"]
+        return {
+            **counters,
+            "size": size,
+            "memory_mb": round(memory_bytes / 1024 / 1024, 2),
+            "disk_mb": round(disk_bytes / 1024 / 1024, 2) if disk_bytes is not None else None,
+            "hit_rate": round((counters["hits"] + counters["disk_hits"]) / lookups, 3) if lookups else 0.0,
+        }
+
+
+render_cache = RenderCache()
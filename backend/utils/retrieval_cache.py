@@ -0,0 +1,83 @@
+import hashlib
+import os
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from utils.guideline_index import embedding_model_name
+from utils.lru_cache import LRUCache
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "2048"))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", "4096"))
+
+# Эмбеддинг текста не устаревает, поэтому TTL не нужен — только размер. Значения (векторы numpy,
+# списки ID, позиции фрагментов) хранятся только в памяти процесса
+embedding_cache = LRUCache(max_entries=EMBEDDING_CACHE_SIZE)
+retrieval_cache = LRUCache(max_entries=RETRIEVAL_CACHE_SIZE)
+
+
+def text_key(embedding_model, text: str) -> str:
+    return hashlib.sha256(f"{embedding_model_name(embedding_model)}\0{text}".encode()).hexdigest()
+
+
+def embed_query(embedding_model, text: str) -> np.ndarray:
+    """Эмбеддинг запроса; повторный текст не прогоняется через трансформер."""
+    key = text_key(embedding_model, text)
+    vector = embedding_cache.get(key)
+    if vector is None:
+        vector = np.asarray(embedding_model.embed_query(text), dtype=np.float32)
+        vector.setflags(write=False)
+        embedding_cache.set(key, vector)
+    return vector
+
+
+def search_ids(vs: FAISS, vector: np.ndarray, k: int, version: str) -> list[str]:
+    """
+    ID фрагментов docstore для top-k по вектору, с кэшем по (хэш эмбеддинга, версия индекса, k).
+    Поиск повторяет FAISS.similarity_search_by_vector без фильтров.
+    """
+    key = hashlib.sha256(vector.tobytes() + f"\0{version}\0{k}".encode()).hexdigest()
+    ids = retrieval_cache.get(key)
+    if ids is None:
+        query = np.array([vector], dtype=np.float32)
+        if vs._normalize_L2:
+            faiss.normalize_L2(query)
+        _, indices = vs.index.search(query, k)
+        ids = [vs.index_to_docstore_id[i] for i in indices[0] if i != -1]
+        retrieval_cache.set(key, ids)
+    return ids
+
+
+def cached_retrieve(vs: FAISS, query: str, k: int, version: str) -> list:
+    """Аналог vs.as_retriever(search_kwargs={"k": k}).invoke(query) с кэшированием эмбеддинга и результата."""
+    vector = embed_query(vs.embedding_function, query)
+    return [vs.docstore.search(doc_id) for doc_id in search_ids(vs, vector, k, version)]
+
+
+class CachedRetriever(BaseRetriever):
+    """Ретривер по FAISS-индексу рекомендаций, переиспользующий эмбеддинги и результаты поиска."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: FAISS | None
+    k: int = 5
+    version: str
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        if self.vectorstore is None:
+            # Корпус рекомендаций пуст — критика идёт без контекста
+            return []
+        return cached_retrieve(self.vectorstore, query, self.k, self.version)
+
+    @property
+    def cache_tag(self) -> str:
+        """Параметры отбора контекста для ключа кэша ответов критика."""
+        return str(self.k)
+
+
+def stats() -> dict:
+    return {"embeddings": embedding_cache.stats(), "retrieval": retrieval_cache.stats()}
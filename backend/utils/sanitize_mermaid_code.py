@@ -1,59 +1,85 @@
 import re
 
+# Все регулярные выражения компилируются один раз при импорте
+MERMAID_BLOCK_RE = re.compile(r"```mermaid\s*(.*?)\s*```", flags=re.DOTALL)
+SCRIPT_RE = re.compile(r"<script.*?>.*?</script>", flags=re.DOTALL)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+# Строка остаётся, если в ней есть признак синтаксиса или она начинается с заголовка диаграммы
+SYNTAX_LINE_RE = re.compile(
+    r"-->|--|\[\[|\]\]|[(){}:]"
+    r"|^(?:graph|flowchart|sequenceDiagram|classDiagram|stateDiagram|erDiagram|gantt|journey|pie)\b"
+)
+
+# Ключевые слова для ответа без markdown-блока — в порядке приоритета
+KEYWORDS = [
+    "graph TD", "graph LR", "graph RL", "graph BT",
+    "flowchart TB", "flowchart TD", "sequenceDiagram",
+    "classDiagram", "stateDiagram", "erDiagram",
+    "gantt", "journey", "pie"
+]
+KEYWORD_PRIORITY = {keyword: priority for priority, keyword in enumerate(KEYWORDS)}
+KEYWORD_RE = re.compile("|".join(re.escape(keyword) for keyword in KEYWORDS))
+# Блок после ключевого слова заканчивается перед первой строкой без отступа
+BLOCK_END_RE = re.compile(r"\n\S")
 
-def sanitize_mermaid_code(mermaid_code: str) -> str:
-    def clean_block(block: str) -> str:
-        # Удаляем HTML и JS
-        block = re.sub(r"<script.*?>.*?</script>", "", block, flags=re.DOTALL)
-        block = re.sub(r"<[^>]+>", "", block)
 
-        # Удаляем однострочные комментарии // ...
-        block = re.sub(r"^\s*//.*$", "", block, flags=re.MULTILINE)
+def clean_block(block: str) -> str:
+    # Удаляем HTML и JS
+    if "<" in block:
+        block = SCRIPT_RE.sub("", block)
+        block = HTML_TAG_RE.sub("", block)
 
+    lines = []
+    for line in block.splitlines():
+        line = line.strip()
+        # Пустые строки и однострочные комментарии // ...
+        if not line or line.startswith("//"):
+            continue
         # Удаляем кавычки внутри стрелок и по краям
-        block = block.replace('"', '')
-
-        # Очищаем пустые и явно невалидные строки
-        lines = []
-        for line in block.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            # Пропускаем строки, не содержащие хотя бы один признак синтаксиса
-            if not re.search(r"(-->|\-\-|\[\[|\]\]|\(\)|\(|\)|{|\}|:)", line) and not re.match(
-                    r'^\s*(graph|flowchart|sequenceDiagram|classDiagram|stateDiagram|erDiagram|gantt|journey|pie)\b',
-                    line):
-                continue
+        line = line.replace('"', '')
+        # Пропускаем строки, не содержащие хотя бы один признак синтаксиса
+        if SYNTAX_LINE_RE.search(line):
             lines.append(line)
 
-        return '\n'.join(lines)
-
-    # Ищем все ```mermaid блоки
-    mermaid_blocks = re.findall(r"```mermaid\s*(.*?)\s*```", mermaid_code, flags=re.DOTALL)
-    if not mermaid_blocks:
-        # Вдруг это просто текст с `graph TD` и без markdown — тогда ищем по ключевым словам
-        keywords = [
-            "graph TD", "graph LR", "graph RL", "graph BT",
-            "flowchart TB", "flowchart TD", "sequenceDiagram",
-            "classDiagram", "stateDiagram", "erDiagram",
-            "gantt", "journey", "pie"
-        ]
-        for keyword in keywords:
-            pattern = rf"({re.escape(keyword)}[\s\S]+?)(?=\n\S|\Z)"
-            match = re.search(pattern, mermaid_code)
-            if match:
-                return clean_block(match.group(1))
+    return '\n'.join(lines)
 
-        return ""
 
-    # Берём первый валидный блок
-    for raw_block in mermaid_blocks:
-        cleaned = clean_block(raw_block)
-        if cleaned.strip():
-            return cleaned
+def find_keyword_block(text: str) -> str | None:
+    """
+    Блок диаграммы в тексте без markdown: от ключевого слова до первой строки без отступа.
+    Текст просматривается один раз; если ключевых слов несколько, берётся более приоритетное по KEYWORDS.
+    """
+    match = None
+    for candidate in KEYWORD_RE.finditer(text):
+        # После ключевого слова должен быть хотя бы один символ
+        if candidate.end() == len(text):
+            continue
+        if match is None or KEYWORD_PRIORITY[candidate.group()] < KEYWORD_PRIORITY[match.group()]:
+            match = candidate
+            if KEYWORD_PRIORITY[match.group()] == 0:
+                # Приоритетнее ключевого слова нет — дальше можно не смотреть
+                break
+    if match is None:
+        return None
+    end = BLOCK_END_RE.search(text, match.end() + 1)
+    return text[match.start():end.start() if end else len(text)]
+
 
-    return ""
+def sanitize_mermaid_code(mermaid_code: str) -> str:
+    # Ищем все ```mermaid блоки и берём первый валидный
+    found = False
+    if "```mermaid" in mermaid_code:
+        for match in MERMAID_BLOCK_RE.finditer(mermaid_code):
+            found = True
+            cleaned = clean_block(match.group(1))
+            if cleaned.strip():
+                return cleaned
+    if found:
+        return ""
 
+    # Вдруг это просто текст с `graph TD` и без markdown — тогда ищем по ключевым словам
+    block = find_keyword_block(mermaid_code)
+    return clean_block(block) if block is not None else ""
 
 if __name__ == "__main__":
     invalid_mermaid = """
@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import weakref
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(*parts) -> str:
+    """Ключ запроса — sha256 от его частей (токен, номер агента, входной текст и т.п.)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class _Raised:
+    # SystemExit нельзя выпускать из asyncio.Task — он остановит event loop,
+    # поэтому внутри задачи он заворачивается и поднимается заново у ожидающих
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых запросов, выполняющихся одновременно: первый вызов с ключом
+    выполняет работу, остальные с тем же ключом ждут его результат (или исключение).
+    Готовые результаты не хранятся — за это отвечает кэш ответов.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self._acalls = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._counters = {"leaders": 0, "shared": 0}
+
+    def do(self, key: str, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+            self._counters["leaders" if leader else "shared"] += 1
+
+        if not leader:
+            logger.info(f"{self.name}: joined in-flight request {key[:12]}")
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def ado(self, key: str, afn, *args, **kwargs):
+        # asyncio.Task привязана к своему event loop, поэтому учёт ведётся по loop
+        loop = asyncio.get_running_loop()
+        calls = self._acalls.setdefault(loop, {})
+        task = calls.get(key)
+        with self._lock:
+            self._counters["leaders" if task is None else "shared"] += 1
+
+        if task is None:
+            async def run():
+                try:
+                    return await afn(*args, **kwargs)
+                except SystemExit as e:
+                    return _Raised(e)
+
+            task = loop.create_task(run())
+            calls[key] = task
+            task.add_done_callback(lambda t: calls.pop(key, None) if calls.get(key) is t else None)
+        else:
+            logger.info(f"{self.name}: joined in-flight request {key[:12]}")
+
+        # shield: отмена одного из ожидающих (клиент закрыл соединение) не отменяет общую работу
+        result = await asyncio.shield(task)
+        if isinstance(result, _Raised):
+            raise result.exc
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+agent_flight = SingleFlight("agent")
+diagram_flight = SingleFlight("diagrams")
+summary_flight = SingleFlight("summaries")
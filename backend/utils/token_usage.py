@@ -0,0 +1,49 @@
+import logging
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_totals = {}
+
+
+def record_usage(source: str, tokens_in: int | None, tokens_out: int | None, estimated: bool = False) -> None:
+    """Логирует токены на входе и выходе одного вызова LLM и копит суммы по источнику."""
+    tokens_in, tokens_out = tokens_in or 0, tokens_out or 0
+    logger.info(f"LLM call [{source}]: tokens in={tokens_in} out={tokens_out}{' (estimated)' if estimated else ''}")
+    with _lock:
+        totals = _totals.setdefault(source, {"calls": 0, "tokens_in": 0, "tokens_out": 0})
+        totals["calls"] += 1
+        totals["tokens_in"] += tokens_in
+        totals["tokens_out"] += tokens_out
+
+
+def record_response_usage(source: str, usage: dict | None, prompt: str, output: str) -> None:
+    """Использование из ответа API, а если его нет — подсчёт токенизатором промптов."""
+    if usage:
+        record_usage(source, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        return
+    from utils.prompt_budget import count_tokens
+
+    record_usage(source, count_tokens(prompt), count_tokens(output), estimated=True)
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """Колбэк LangChain: логирует usage_metadata ответов чат-модели (критик, RetrievalQA)."""
+
+    def __init__(self, source: str = "langchain"):
+        self.source = source
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    record_usage(self.source, usage.get("input_tokens"), usage.get("output_tokens"))
+
+
+def stats() -> dict:
+    with _lock:
+        return {source: dict(totals) for source, totals in _totals.items()}
@@ -1,50 +1,12 @@
-import requests
-import uuid
-import base64
+import httpx
 
-
-# === Получение токена доступа ===
-def get_access_token(client_id: str, client_secret: str) -> str:
-    url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
-    credentials = f"{client_id}:{client_secret}"
-    encoded_credentials = base64.b64encode(credentials.encode()).decode()
-
-    headers = {
-        "Authorization": f"Basic {encoded_credentials}",
-        "Content-Type": "application/x-www-form-urlencoded",
-        "RqUID": str(uuid.uuid4())
-    }
-
-    data = {
-        "scope": "GIGACHAT_API_PERS"
-    }
-
-    response = requests.post(url, headers=headers, data=data, verify=False)
-    response.raise_for_status()
-    return response.json()["access_token"]
+from utils.gigachat_auth import get_access_token
+from utils.gigachat_client import complete
 
 
 # === Вызов GigaChat ===
 def call_gigachat(prompt: str, access_token: str) -> str:
-    url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
-
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "RqUID": str(uuid.uuid4())
-    }
-
-    payload = {
-        "model": "GigaChat",
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.5,
-        "stream": False
-    }
-
-    response = requests.post(url, headers=headers, json=payload, verify=False)
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
+    return complete(prompt, access_token, temperature=0.5, model="GigaChat")
 
 
 # === Базовый класс агента ===
@@ -191,28 +153,11 @@ class MermaidDiagramAgent:
 Верни только mermaid код, без пояснений и комментариев.
 """
 
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "RqUID": str(uuid.uuid4())
-        }
-
-        payload = {
-            "model": "GigaChat",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7,
-            "stream": False
-        }
-
         try:
-            response = requests.post("https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-                                     headers=headers, json=payload, verify=False)
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
-        except requests.exceptions.RequestException as e:
+            return complete(prompt, token, temperature=0.7, model="GigaChat")
+        except httpx.HTTPError as e:
             raise SystemExit(
-                f"Ошибка при запросе к GigaChat API: {e}\nОтвет: {getattr(e.response, 'text', 'нет данных')}")
+                f"Ошибка при запросе к GigaChat API: {e}\nОтвет: {getattr(getattr(e, 'response', None), 'text', 'нет данных')}")
 
 
 # === Контроллер пайплайна ===
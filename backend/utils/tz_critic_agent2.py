@@ -1,68 +1,63 @@
+import asyncio
+import logging
 import os
+import time
+from functools import cached_property
 
-import requests
-import uuid
-import base64
-from langchain_gigachat.chat_models import GigaChat
-from langchain_community.vectorstores import FAISS
+import httpx
 from langchain.chains import RetrievalQA
 from langchain_core.prompts import PromptTemplate
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.document_loaders import UnstructuredWordDocumentLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from utils.gigachat_auth import get_access_token, get_token_provider, SharedTokenGigaChat
+from utils.cpu_pool import run_cpu
+from utils.completion_cache import cache_key, cached_call, acached_call
+from utils.diagram_stats import diagram_stats
+from utils.context_selection import BudgetedRetriever, CRITIC_CONTEXT_SELECTION, CRITIC_CONTEXT_TOKENS
+from utils.gigachat_client import complete, acomplete, astream_complete, DEFAULT_MODEL
+from utils.guideline_index import get_corpus, DEFAULT_INDEX_DIR, DEFAULT_NAMESPACE
+from utils.model_registry import get_embedding_model, get_llm
+from utils.prompt_budget import PromptBuilder, split_sections
+from utils.retrieval_cache import CachedRetriever
+from utils.single_flight import agent_flight, diagram_flight, request_key
 
-# === Получение токена доступа ===
-def get_access_token(client_id: str, client_secret: str) -> str:
-    url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
-    credentials = f"{client_id}:{client_secret}"
-    encoded_credentials = base64.b64encode(credentials.encode()).decode()
+logger = logging.getLogger(__name__)
 
-    headers = {
-        "Authorization": f"Basic {encoded_credentials}",
-        "Content-Type": "application/x-www-form-urlencoded",
-        "RqUID": str(uuid.uuid4())
-    }
-
-    data = {
-        "scope": "GIGACHAT_API_PERS"
-    }
-
-    response = requests.post(url, headers=headers, data=data, verify=False)
-    response.raise_for_status()
-    return response.json()["access_token"]
+# Сколько диаграмм одного запроса генерируется параллельно
+DIAGRAM_CONCURRENCY = int(os.environ.get("DIAGRAM_CONCURRENCY", "5"))
+# Агенты разделов, работающие в один проход (поиск рекомендаций → генерация), через запятую; "all" — все
+SINGLE_PASS_AGENTS = os.environ.get("SINGLE_PASS_AGENTS", "")
+# Неотрисовавшаяся диаграмма исправляется по ошибке рендера; "0" — прежняя повторная генерация с нуля
+DIAGRAM_REPAIR = os.environ.get("DIAGRAM_REPAIR", "1") not in ("0", "false", "False")
 
 
 # === Вызов GigaChat ===
-def call_gigachat(prompt: str, access_token: str) -> str:
-    url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+def call_gigachat(prompt: str, access_token: str, use_cache: bool = True) -> str:
+    key = cache_key(DEFAULT_MODEL, 0.5, prompt)
+    return cached_call(key, complete, prompt, access_token, temperature=0.5, use_cache=use_cache)
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "RqUID": str(uuid.uuid4())
-    }
 
-    payload = {
-        "model": "GigaChat-Pro",
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.5,
-        "stream": False
-    }
-
-    response = requests.post(url, headers=headers, json=payload, verify=False)
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
+async def acall_gigachat(prompt: str, access_token: str, use_cache: bool = True) -> str:
+    key = cache_key(DEFAULT_MODEL, 0.5, prompt)
+    return await acached_call(key, acomplete, prompt, access_token, temperature=0.5, use_cache=use_cache)
 
 
 # === Базовый класс агента ===
 class BaseAgent:
+    # Ключ агента в TzPipeline.agents — по нему выбирается бюджет токенов (AGENT_TOKEN_BUDGETS)
+    key = "section"
+
     def __init__(self, name: str, prompt_template: str):
         self.name = name
         self.prompt_template = prompt_template
         self.last_response = ""
 
+    @staticmethod
+    def merge_input(previous: str, user_comment: str) -> str:
+        if not previous.strip():
+            return user_comment.strip()
+        return previous.strip() + "\n\nКомментарий пользователя:\n" + user_comment.strip()
+
     def build_prompt(self, user_input: str) -> str:
         return self.prompt_template.format(previous_response_and_comment=user_input)
 
@@ -71,11 +66,38 @@ class BaseAgent:
         self.last_response = response
         return response
 
+    def section_builder(self, render) -> PromptBuilder:
+        return PromptBuilder(self.key, lambda parts: render(self.merge_input(parts["previous"], parts["comment"])))
+
+    def fit_prompt(self, render, previous: str, user_comment: str, llm_callable, token: str) -> str:
+        """
+        Промпт из предыдущего текста раздела и комментария в пределах бюджета агента:
+        сверх бюджета предыдущий текст сначала сжимается (с кэшем), затем выбрасывается.
+        """
+        return self.section_builder(render).build(
+            {"previous": previous, "comment": user_comment}, to_summarize=["previous"], to_drop=["previous"],
+            required="comment", llm_callable=llm_callable, token=token)
+
+    async def afit_prompt(self, render, previous: str, user_comment: str, allm_callable, token: str) -> str:
+        return await self.section_builder(render).abuild(
+            {"previous": previous, "comment": user_comment}, to_summarize=["previous"], to_drop=["previous"],
+            required="comment", allm_callable=allm_callable, token=token)
+
     def run(self, previous: str, user_comment: str, llm_callable, token: str) -> str:
-        merged_input = previous.strip() + "\n\nКомментарий пользователя:\n" + user_comment.strip()
-        prompt = self.build_prompt(merged_input)
+        prompt = self.fit_prompt(self.build_prompt, previous, user_comment, llm_callable, token)
         return self.call_model(prompt, llm_callable, token)
 
+    def build_clarify_prompt(self, user_input: str) -> str:
+        prompt = f"""
+            Ты — эксперт по разделу «{self.name}».
+            У тебя на входе — предыдущий текст (если был) и пользовательский ввод:
+            {user_input}
+            
+            1) Если данных недостаточно для полноценного раздела — задай один уточняющий вопрос.
+            2) Иначе — сразу сгенерируй раздел по шаблону.
+            """
+        return prompt.strip()
+
     def clarify_or_generate(self, previous: str, user_input: str,
                             llm_callable, token: str) -> str:
         """
@@ -83,18 +105,79 @@ class BaseAgent:
         Если LLM возвращает текст, заканчивающийся на '?', считаем это уточняющим вопросом.
         Иначе — это готовый раздел.
         """
+        prompt = self.fit_prompt(self.build_clarify_prompt, previous, user_input, llm_callable, token)
+        return llm_callable(prompt, token).strip()
+
+    async def aclarify_or_generate(self, previous: str, user_input: str,
+                                   allm_callable, token: str) -> str:
+        prompt = await self.afit_prompt(self.build_clarify_prompt, previous, user_input, allm_callable, token)
+        return (await allm_callable(prompt, token)).strip()
+
+    def grounded_builder(self, docs: list) -> tuple[PromptBuilder, dict, list[str]]:
+        # Сверх бюджета предыдущий текст сжимается, затем выбрасываются наименее релевантные фрагменты
+        # рекомендаций (они в конце выдачи) и последним — сам предыдущий текст
+        doc_keys = [f"doc{i}" for i in range(len(docs))]
+        builder = PromptBuilder(self.key, lambda parts: self.render_grounded_prompt(
+            self.merge_input(parts["previous"], parts["comment"]), [parts[key] for key in doc_keys if parts[key]]))
+        parts = {"previous": "", "comment": "", **{key: doc.page_content for key, doc in zip(doc_keys, docs)}}
+        return builder, parts, doc_keys[::-1] + ["previous"]
+
+    def build_grounded_prompt(self, previous: str, user_comment: str, docs: list,
+                              llm_callable=None, token: str | None = None) -> str:
+        builder, parts, to_drop = self.grounded_builder(docs)
+        return builder.build({**parts, "previous": previous, "comment": user_comment}, to_summarize=["previous"],
+                             to_drop=to_drop, required="comment", llm_callable=llm_callable, token=token)
+
+    async def abuild_grounded_prompt(self, previous: str, user_comment: str, docs: list,
+                                     allm_callable=None, token: str | None = None) -> str:
+        builder, parts, to_drop = self.grounded_builder(docs)
+        return await builder.abuild({**parts, "previous": previous, "comment": user_comment}, to_summarize=["previous"],
+                                    to_drop=to_drop, required="comment", allm_callable=allm_callable, token=token)
+
+    def render_grounded_prompt(self, user_input: str, contexts: list[str]) -> str:
+        """
+        Промпт однопроходного режима: рекомендации по ТЗ подставляются сразу,
+        и модель пишет раздел, уже удовлетворяющий критериям критика.
+        """
+        context = "\n\n".join(contexts)
         prompt = f"""
             Ты — эксперт по разделу «{self.name}».
+            Контекст (рекомендации по ТЗ):
+            {context}
+            
             У тебя на входе — предыдущий текст (если был) и пользовательский ввод:
             {user_input}
             
             1) Если данных недостаточно для полноценного раздела — задай один уточняющий вопрос.
-            2) Иначе — сразу сгенерируй раздел по шаблону.
+            2) Иначе — сразу сгенерируй раздел по шаблону с учётом рекомендаций и критериев:
+               логичность структуры и полнота, конкретность формулировок, без избыточного,
+               с недостающими блоками (название, цели, роли, use-case, безопасность…).
+            
+            Верни только уточняющий вопрос или итоговый текст раздела без инструкций модели.
             """
-        return llm_callable(prompt.strip(), token).strip()
+        return prompt.strip()
 
 
 # === Агент-критик ===
+CRITIC_PROMPT = PromptTemplate(
+    input_variables=["context", "question"],
+    template="""
+        Контекст (рекомендации по ТЗ):
+        {context}
+        
+        Задача: улучшить блок ТЗ по критериям:
+        1. Логичность структуры и полнота
+        2. Конкретность формулировок
+        3. Удалить избыточное
+        4. Добавить недостающее (название, цели, роли, use-case, безопасность…)
+        
+        Текст блока:
+        {question}
+        
+        Верните только итоговый улучшённый текст без инструкций модели.
+        """.strip())
+
+
 class TzCriticAgent:
     def __init__(
             self,
@@ -103,37 +186,40 @@ class TzCriticAgent:
             llm,
             chunk_size: int = 1000,
             chunk_overlap: int = 200,
-            retriever_k: int = 5
+            retriever_k: int = 5,
+            index_dir: str = DEFAULT_INDEX_DIR,
+            namespace: str = DEFAULT_NAMESPACE,
+            context_selection: str = CRITIC_CONTEXT_SELECTION,
+            context_tokens: int = CRITIC_CONTEXT_TOKENS
     ):
-        # 1) Загружаем Word и разбиваем на чанки
-        docs = UnstructuredWordDocumentLoader(word_doc_path).load()
-        chunks = RecursiveCharacterTextSplitter(
+        # 1-2) FAISS-индекс корпуса рекомендаций (исходный документ плюс загруженные через API):
+        # хранится на диске и обновляется инкрементально. Критик работает с одной версией
+        # корпуса на всё время своей жизни, новые версии видят следующие запросы
+        corpus = get_corpus(
+            embedding_model,
+            index_dir=index_dir,
             chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        ).split_documents(docs)
-
-        # 2) FAISS + GigaChatEmbedddings
-        vs = FAISS.from_documents(chunks, embedding_model)
-        retriever = vs.as_retriever(search_kwargs={"k": retriever_k})
+            chunk_overlap=chunk_overlap,
+            seed_doc_path=word_doc_path,
+            namespace=namespace
+        )
+        version, vs = corpus.snapshot()
+        self.index_version = f"{namespace}/{os.path.basename(corpus.root)}/{version}"
+        # Эмбеддинги запросов и найденные фрагменты кэшируются: повторная критика не гоняет трансформер.
+        # В режиме "mmr" фрагменты отбираются по MMR под бюджет токенов, а общие куски соседних
+        # фрагментов (перекрытие нарезки) не повторяются в промпте
+        if context_selection == "mmr":
+            retriever = BudgetedRetriever(vectorstore=vs, k=retriever_k, version=self.index_version,
+                                          token_budget=context_tokens, max_overlap=2 * chunk_overlap)
+        else:
+            retriever = CachedRetriever(vectorstore=vs, k=retriever_k, version=self.index_version)
+        self.retriever = retriever
+        self.retriever_k = retriever_k
+        self.llm = llm
 
         # 3) Шаблон RAG-промпта
-        prompt = PromptTemplate(
-            input_variables=["context", "question"],
-            template="""
-                Контекст (рекомендации по ТЗ):
-                {context}
-                
-                Задача: улучшить блок ТЗ по критериям:
-                1. Логичность структуры и полнота
-                2. Конкретность формулировок
-                3. Удалить избыточное
-                4. Добавить недостающее (название, цели, роли, use-case, безопасность…)
-                
-                Текст блока:
-                {question}
-                
-                Верните только итоговый улучшённый текст без инструкций модели.
-                """.strip())
+        prompt = CRITIC_PROMPT
+        self.prompt = prompt
 
         # 4) Собираем RAG-цепочку через RetrievalQA
         self.rag_chain = RetrievalQA.from_chain_type(
@@ -143,12 +229,43 @@ class TzCriticAgent:
             chain_type_kwargs={"prompt": prompt},
         )
 
-    def review(self, tz_block: str) -> str:
-        return self.rag_chain.run(query=tz_block)
+    def review_cache_key(self, tz_block: str) -> str:
+        # Найденный контекст однозначно определяется версией индекса и параметрами отбора, поэтому
+        # при попадании в кэш не нужен даже поиск по FAISS
+        query = f"rag:{self.index_version}:{self.retriever.cache_tag}\n{tz_block}"
+        return cache_key(getattr(self.llm, "model", None), getattr(self.llm, "temperature", None), query)
+
+    def review(self, tz_block: str, use_cache: bool = True) -> str:
+        return cached_call(self.review_cache_key(tz_block), self.rag_chain.run, query=tz_block, use_cache=use_cache)
+
+    async def areview(self, tz_block: str, use_cache: bool = True) -> str:
+        return await acached_call(self.review_cache_key(tz_block), self._areview, tz_block, use_cache=use_cache)
+
+    async def _areview(self, tz_block: str) -> str:
+        # Эмбеддинг запроса и поиск по FAISS — в ограниченном CPU-пуле, генерация — асинхронно
+        docs = await run_cpu(self.retrieve, tz_block)
+        result = await self.llm.ainvoke(self.build_review_prompt(tz_block, docs))
+        return result.content
+
+    def retrieve(self, tz_block: str) -> list:
+        return self.retriever.invoke(tz_block)
+
+    def build_review_prompt(self, tz_block: str, docs: list) -> str:
+        # То же, что делает "stuff"-цепочка RetrievalQA: фрагменты через пустую строку
+        context = "\n\n".join(doc.page_content for doc in docs)
+        return self.prompt.format(context=context, question=tz_block)
+
+    async def astream_review(self, tz_block: str, docs: list):
+        """Потоковая версия review() по уже найденным фрагментам рекомендаций."""
+        async for chunk in self.llm.astream(self.build_review_prompt(tz_block, docs)):
+            if chunk.content:
+                yield chunk.content
 
 
 # === Специализированные агенты ===
 class DescriptionAgent(BaseAgent):
+    key = "description"
+
     def __init__(self):
         prompt = """
             Ты — профессиональный аналитик. На основе пользовательского ввода подготовь краткое, но структурированное описание проекта, включающее:
@@ -171,6 +288,8 @@ class DescriptionAgent(BaseAgent):
 
 
 class GoalsAgent(BaseAgent):
+    key = "goals"
+
     def __init__(self):
         prompt = """
             Ты — аналитик по бизнес-требованиям. На основе входного текста уточни цели проекта и структурируй их:
@@ -190,6 +309,8 @@ class GoalsAgent(BaseAgent):
 
 
 class UsersAgent(BaseAgent):
+    key = "users"
+
     def __init__(self):
         prompt = """
             Ты — системный аналитик. На основе ввода пользователя определи:
@@ -209,6 +330,8 @@ class UsersAgent(BaseAgent):
 
 
 class RequirementsAgent(BaseAgent):
+    key = "requirements"
+
     def __init__(self):
         prompt = """
             Ты — инженер по требованиям. На основе текста выдели и структурируй:
@@ -231,12 +354,81 @@ class RequirementsAgent(BaseAgent):
         super().__init__("Требования", prompt)
 
 
-class MermaidDiagramAgent:
+class DiagramAgent:
+    """
+    Базовый агент диаграмм: один запрос к GigaChat по промпту из build_prompt() —
+    инструкции prompt_template, за которыми идёт текст ТЗ.
+    """
+    temperature = 0.7
+    # Исправление — точечная правка, а не новая диаграмма, поэтому температура ниже
+    repair_temperature = 0.2
+
+    def build_prompt(self, tz_text: str) -> str:
+        return f'{self.prompt_template.strip()}\n\nТехническое задание:\n"""{tz_text}"""'
+
+    def tz_builder(self, tz_text: str) -> tuple[PromptBuilder, dict, list[str]]:
+        """
+        Бюджет "diagrams": сверх него сжимаются разделы ТЗ, начиная с самых длинных
+        (краткие изложения общие для всех агентов диаграмм), а последней мерой обрезается конец ТЗ.
+        """
+        parts = {f"section{i}": section for i, section in enumerate(split_sections(tz_text))}
+        builder = PromptBuilder("diagrams", lambda parts: self.build_prompt(
+            "\n\n".join(section for section in parts.values() if section)))
+        return builder, parts, sorted(parts, key=lambda name: len(parts[name]), reverse=True)
+
+    def fit_prompt(self, tz_text: str, token: str) -> str:
+        builder, parts, to_summarize = self.tz_builder(tz_text)
+        return builder.build(parts, to_summarize=to_summarize, required=next(reversed(parts), None),
+                             llm_callable=call_gigachat, token=token)
+
+    async def afit_prompt(self, tz_text: str, token: str) -> str:
+        builder, parts, to_summarize = self.tz_builder(tz_text)
+        return await builder.abuild(parts, to_summarize=to_summarize, required=next(reversed(parts), None),
+                                    allm_callable=acall_gigachat, token=token)
+
+    def generate(self, tz_text: str, token: str, use_cache: bool = True) -> str:
+        prompt = self.fit_prompt(tz_text, token)
+        return cached_call(cache_key(DEFAULT_MODEL, self.temperature, prompt), complete,
+                           prompt, token, temperature=self.temperature, use_cache=use_cache)
+
+    async def agenerate(self, tz_text: str, token: str, use_cache: bool = True) -> str:
+        prompt = await self.afit_prompt(tz_text, token)
+        return await acached_call(cache_key(DEFAULT_MODEL, self.temperature, prompt), acomplete,
+                                  prompt, token, temperature=self.temperature, use_cache=use_cache)
+
+    def build_repair_prompt(self, code: str, error: str) -> str:
+        prompt = f"""
+            Ты — помощник, исправляющий код диаграмм Mermaid.js.
+            Этот код не удалось отрисовать:
+            
+            \"\"\"{code}\"\"\"
+            
+            Ошибка рендерера или проверки синтаксиса (номера строк — в коде диаграммы):
+            
+            \"\"\"{error}\"\"\"
+            
+            Исправь только то, что вызывает ошибку, сохранив тип диаграммы, узлы, связи и подписи.
+            Верни только исправленный mermaid-код, без пояснений и комментариев.
+            """
+        return prompt.strip()
+
+    async def arepair(self, code: str, error: str, token: str) -> str:
+        prompt = self.build_repair_prompt(code, error)
+        return await acached_call(cache_key(DEFAULT_MODEL, self.repair_temperature, prompt), acomplete,
+                                  prompt, token, temperature=self.repair_temperature)
+
+
+def _gigachat_exit(e: httpx.HTTPError) -> SystemExit:
+    return SystemExit(
+        f"Ошибка при запросе к GigaChat API: {e}\nОтвет: {getattr(getattr(e, 'response', None), 'text', 'нет данных')}")
+
+
+class MermaidDiagramAgent(DiagramAgent):
     def __init__(self):
         self.name = "Генератор диаграммы"
 
-    def generate(self, tz_text: str, token: str) -> str:
-        prompt = f"""
+    def build_prompt(self, tz_text: str) -> str:
+        return f"""
             Ты — помощник, который генерирует DFD (Data Flow Diagram) диаграммы в формате Mermaid.js.
             
             Используй только синтаксис Mermaid.js с типом "graph TD". Обозначай:
@@ -251,31 +443,26 @@ class MermaidDiagramAgent:
             Верни только mermaid код, без пояснений и комментариев.
             """
 
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "RqUID": str(uuid.uuid4())
-        }
+    def generate(self, tz_text: str, token: str, use_cache: bool = True) -> str:
+        try:
+            return super().generate(tz_text, token, use_cache=use_cache)
+        except httpx.HTTPError as e:
+            raise _gigachat_exit(e)
 
-        payload = {
-            "model": "GigaChat-Pro",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7,
-            "stream": False
-        }
+    async def agenerate(self, tz_text: str, token: str, use_cache: bool = True) -> str:
+        try:
+            return await super().agenerate(tz_text, token, use_cache=use_cache)
+        except httpx.HTTPError as e:
+            raise _gigachat_exit(e)
 
+    async def arepair(self, code: str, error: str, token: str) -> str:
         try:
-            response = requests.post("https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-                                     headers=headers, json=payload, verify=False)
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(
-                f"Ошибка при запросе к GigaChat API: {e}\nОтвет: {getattr(e.response, 'text', 'нет данных')}")
+            return await super().arepair(code, error, token)
+        except httpx.HTTPError as e:
+            raise _gigachat_exit(e)
 
 
-class UseCaseDiagramAgent:
+class UseCaseDiagramAgent(DiagramAgent):
     def __init__(self):
         self.name = "Use Case Diagram Generator"
         self.prompt_template = '''
@@ -301,29 +488,8 @@ class UseCaseDiagramAgent:
                 Верни только mermaid-код без пояснений.
                 '''
 
-    def generate(self, tz_text: str, token: str) -> str:
-        prompt = self.prompt_template
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "RqUID": str(uuid.uuid4())
-        }
-        payload = {
-            "model": "GigaChat-Pro",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7,
-            "stream": False
-        }
-        response = requests.post(
-            "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-            headers=headers, json=payload, verify=False
-        )
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-
 
-class ActivityDiagramAgent:
+class ActivityDiagramAgent(DiagramAgent):
     def __init__(self):
         self.name = "Activity Diagram Generator"
         self.prompt_template = '''
@@ -351,19 +517,8 @@ class ActivityDiagramAgent:
             Верни только mermaid-фрагмент.
             '''
 
-    def generate(self, tz_text: str, token: str) -> str:
-        prompt = self.prompt_template
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json", "Accept": "application/json",
-                   "RqUID": str(uuid.uuid4())}
-        payload = {"model": "GigaChat-Pro", "messages": [{"role": "user", "content": prompt}], "temperature": 0.7,
-                   "stream": False}
-        response = requests.post("https://gigachat.devices.sberbank.ru/api/v1/chat/completions", headers=headers,
-                                 json=payload, verify=False)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
 
-
-class C4ContextDiagramAgent:
+class C4ContextDiagramAgent(DiagramAgent):
     def __init__(self):
         self.name = "C4 Context Diagram Generator"
         self.prompt_template = '''
@@ -388,19 +543,8 @@ class C4ContextDiagramAgent:
             Верни только mermaid-код.
             '''
 
-    def generate(self, tz_text: str, token: str) -> str:
-        prompt = self.prompt_template
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json",
-                   "Accept": "application/json", "RqUID": str(uuid.uuid4())}
-        payload = {"model": "GigaChat-Pro", "messages": [{"role": "user", "content": prompt}], "temperature": 0.7,
-                   "stream": False}
-        response = requests.post("https://gigachat.devices.sberbank.ru/api/v1/chat/completions", headers=headers,
-                                 json=payload, verify=False)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-
 
-class ERDiagramAgent:
+class ERDiagramAgent(DiagramAgent):
     def __init__(self):
         self.name = "ER Diagram Generator"
         self.prompt_template = '''
@@ -426,34 +570,55 @@ class ERDiagramAgent:
                     Верни только mermaid-описание.
                     '''
 
-    def generate(self, tz_text: str, token: str) -> str:
-        prompt = self.prompt_template
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json",
-                   "Accept": "application/json", "RqUID": str(uuid.uuid4())}
-        payload = {"model": "GigaChat-Pro", "messages": [{"role": "user", "content": prompt}],
-                   "temperature": 0.7, "stream": False}
-        response = requests.post("https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-                                 headers=headers, json=payload, verify=False)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-
 
 # === Контроллер пайплайна ===
 class TzPipeline:
-    def __init__(self, llm_callable, embedding_model, llm):
+    """
+    Агенты разделов, критик и агенты диаграмм создаются независимо при первом обращении:
+    запросу только на диаграммы не нужны ни эмбеддинги, ни индекс рекомендаций.
+    Если embedding_model / llm не переданы, они берутся из общего реестра моделей.
+    """
+
+    def __init__(self, llm_callable, embedding_model=None, llm=None, diagram_concurrency: int = DIAGRAM_CONCURRENCY,
+                 allm_callable=acall_gigachat, single_pass_agents=None,
+                 guideline_namespace: str = DEFAULT_NAMESPACE, diagram_repair: bool = DIAGRAM_REPAIR):
         self.llm = llm_callable
-        self.agents = {
+        self.allm = allm_callable
+        self.diagram_concurrency = diagram_concurrency
+        self._embedding_model = embedding_model
+        self._llm = llm
+        # Корпус рекомендаций, по которому работает критик (выбирается для чата)
+        self.guideline_namespace = guideline_namespace
+        if single_pass_agents is None:
+            single_pass_agents = [key.strip() for key in SINGLE_PASS_AGENTS.split(",") if key.strip()]
+        self.single_pass_agents = set(single_pass_agents)
+        self.diagram_repair = diagram_repair
+
+    @cached_property
+    def agents(self) -> dict:
+        return {
             "description": DescriptionAgent(),
             "goals": GoalsAgent(),
             "users": UsersAgent(),
             "requirements": RequirementsAgent()
         }
-        self.critic = TzCriticAgent(
+
+    def is_single_pass(self, agent_key: str) -> bool:
+        """Однопроходный режим: один запрос к модели вместо «уточнение/генерация → критика»."""
+        return agent_key in self.single_pass_agents or "all" in self.single_pass_agents
+
+    @cached_property
+    def critic(self) -> TzCriticAgent:
+        return TzCriticAgent(
             word_doc_path="tz_guidelines.docx",
-            embedding_model=embedding_model,
-            llm=llm
+            embedding_model=self._embedding_model if self._embedding_model is not None else get_embedding_model(),
+            llm=self._llm if self._llm is not None else get_llm(),
+            namespace=self.guideline_namespace
         )
-        self.diagram_agents = {
+
+    @cached_property
+    def diagram_agents(self) -> dict:
+        return {
             "DFD": MermaidDiagramAgent(),
             "Use Case": UseCaseDiagramAgent(),
             "Activity": ActivityDiagramAgent(),
@@ -461,20 +626,122 @@ class TzPipeline:
             "ER Diagram": ERDiagramAgent(),
         }
 
+    async def acritic(self) -> TzCriticAgent:
+        """Критик без блокировки event loop: первая загрузка эмбеддингов и индекса идёт в CPU-пуле."""
+        if "critic" in self.__dict__:
+            return self.critic
+        return await run_cpu(lambda: self.critic)
+
     def run_agent(self, agent_key: str, last_response: str, user_comment: str, token: str) -> str:
+        # Одинаковые запросы (двойная отправка формы, несколько вкладок) выполняются один раз
+        key = request_key(agent_key, self.is_single_pass(agent_key), self.guideline_namespace,
+                          last_response, user_comment)
+        text, is_question = agent_flight.do(key, self._run_agent, agent_key, last_response, user_comment, token)
+        if not is_question:
+            self.agents[agent_key].last_response = text
+        return text
+
+    def _run_agent(self, agent_key: str, last_response: str, user_comment: str, token: str) -> tuple[str, bool]:
         agent = self.agents[agent_key]
 
+        if self.is_single_pass(agent_key):
+            # Рекомендации ищутся по тому же тексту, из которого модель пишет раздел
+            docs = self.critic.retrieve(agent.merge_input(last_response, user_comment))
+            prompt = agent.build_grounded_prompt(last_response, user_comment, docs, self.llm, token)
+            resp = self.llm(prompt, token).strip()
+            return resp, resp.endswith("?")
+
         # Фаза уточнений
         resp = agent.clarify_or_generate(last_response, user_comment, self.llm, token)
         if resp.endswith("?"):
-            return resp
+            return resp, True
 
         # Фаза критики
-        improved_output = self.critic.review(resp)
+        return self.critic.review(resp), False
+
+    async def arun_agent(self, agent_key: str, last_response: str, user_comment: str, token: str) -> str:
+        key = request_key(agent_key, self.is_single_pass(agent_key), self.guideline_namespace,
+                          last_response, user_comment)
+        text, is_question = await agent_flight.ado(
+            key, self._arun_agent, agent_key, last_response, user_comment, token)
+        if not is_question:
+            self.agents[agent_key].last_response = text
+        return text
+
+    async def _arun_agent(self, agent_key: str, last_response: str, user_comment: str,
+                          token: str) -> tuple[str, bool]:
+        agent = self.agents[agent_key]
 
-        agent.last_response = improved_output
-        return improved_output
+        if self.is_single_pass(agent_key):
+            critic = await self.acritic()
+            docs = await run_cpu(critic.retrieve, agent.merge_input(last_response, user_comment))
+            prompt = await agent.abuild_grounded_prompt(last_response, user_comment, docs, self.allm, token)
+            resp = (await self.allm(prompt, token)).strip()
+            return resp, resp.endswith("?")
+
+        # Фаза уточнений
+        resp = await agent.aclarify_or_generate(last_response, user_comment, self.allm, token)
+        if resp.endswith("?"):
+            return resp, True
+
+        # Фаза критики
+        critic = await self.acritic()
+        return await critic.areview(resp), False
+
+    async def astream_agent(self, agent_key: str, last_response: str, user_comment: str, token: str):
+        """
+        Потоковая версия run_agent(). Отдаёт события (event, data):
+        ("stage", {"stage": ...}) при переходе к этапу clarify / retrieval / critic,
+        ("token", {"stage": ..., "text": ...}) для каждого фрагмента ответа модели
+        и в конце ("done", {"text": ..., "question": bool}).
+        """
+        agent = self.agents[agent_key]
+
+        if self.is_single_pass(agent_key):
+            # Однопроходный режим: сначала поиск рекомендаций, затем одна генерация с ними
+            yield "stage", {"stage": "retrieval"}
+            critic = await self.acritic()
+            docs = await run_cpu(critic.retrieve, agent.merge_input(last_response, user_comment))
+
+            yield "stage", {"stage": "clarify"}
+            parts = []
+            prompt = await agent.abuild_grounded_prompt(last_response, user_comment, docs, self.allm, token)
+            async for delta in astream_complete(prompt, token, temperature=0.5):
+                parts.append(delta)
+                yield "token", {"stage": "clarify", "text": delta}
+            resp = "".join(parts).strip()
+            if not resp.endswith("?"):
+                agent.last_response = resp
+            yield "done", {"text": resp, "question": resp.endswith("?")}
+            return
+
+        # Фаза уточнений
+        yield "stage", {"stage": "clarify"}
+        parts = []
+        prompt = await agent.afit_prompt(agent.build_clarify_prompt, last_response, user_comment, self.allm, token)
+        async for delta in astream_complete(prompt, token, temperature=0.5):
+            parts.append(delta)
+            yield "token", {"stage": "clarify", "text": delta}
+        resp = "".join(parts).strip()
+        if resp.endswith("?"):
+            yield "done", {"text": resp, "question": True}
+            return
+
+        # Поиск рекомендаций (CPU: эмбеддинг запроса и FAISS) — вне event loop
+        yield "stage", {"stage": "retrieval"}
+        critic = await self.acritic()
+        docs = await run_cpu(critic.retrieve, resp)
+
+        # Фаза критики
+        yield "stage", {"stage": "critic"}
+        parts = []
+        async for delta in critic.astream_review(resp, docs):
+            parts.append(delta)
+            yield "token", {"stage": "critic", "text": delta}
+        improved_output = "".join(parts)
 
+        agent.last_response = improved_output
+        yield "done", {"text": improved_output, "question": False}
 
     def get_all_responses(self) -> dict:
         return {key: agent.last_response for key, agent in self.agents.items()}
@@ -482,13 +749,141 @@ class TzPipeline:
     def get_full_text(self) -> str:
         return "\n\n".join(agent.last_response for agent in self.agents.values())
 
-    def generate_all_diagrams(self, full_text: str, token: str, diagram_types: list[str]) -> dict:
-        # full_text = self.get_full_text()
+    def _record_diagram(self, title: str, llm_calls: int, started: float, rendered: bool) -> None:
+        seconds = time.perf_counter() - started
+        strategy = "repair" if self.diagram_repair else "regenerate"
+        diagram_stats.record(strategy, llm_calls, seconds, rendered)
+        logger.info(f"Diagram {title} {'rendered' if rendered else 'failed'} after {llm_calls} LLM calls "
+                     f"in {seconds:.1f}s ({strategy})")
+
+    async def _agenerate_diagram(self, title: str, full_text: str, token: str,
+                                 use_cache: bool = True) -> tuple[str, str | None, str | None]:
+        try:
+            return title, await self.diagram_agents[title].agenerate(full_text, token, use_cache=use_cache), None
+        except (Exception, SystemExit) as e:
+            # SystemExit бросает MermaidDiagramAgent — он не должен ронять остальные диаграммы
+            logger.warning(f"Diagram {title} generation failed: {e}")
+            return title, None, str(e)
+
+    async def _arepair_diagram(self, title: str, code: str, render_error: str,
+                               token: str) -> tuple[str, str | None, str | None]:
+        try:
+            return title, await self.diagram_agents[title].arepair(code, render_error, token), None
+        except (Exception, SystemExit) as e:
+            logger.warning(f"Diagram {title} repair failed: {e}")
+            return title, None, str(e)
+
+    async def _agenerate_and_render(self, title: str, full_text: str, token: str, arender, attempts: int):
+        """
+        Генерация и рендер диаграммы. arender(title, code) — корутина, возвращающая (результат, None, None)
+        или (None, ошибка, код, к которому относится ошибка). Если рендер не удался, этот код и ошибка
+        рендерера уходят модели на исправление (при diagram_repair=False — генерация заново), всего
+        не больше attempts вызовов модели.
+        """
+        started = time.perf_counter()
+        code = render_error = error = None
+        for attempt in range(1, attempts + 1):
+            if self.diagram_repair and code is not None:
+                _, new_code, error = await self._arepair_diagram(title, code, render_error, token)
+                if error is None and new_code.strip() == code.strip():
+                    error = "repair returned unchanged code"
+            else:
+                # Повторная генерация после неудачного рендера должна получить новый код, а не тот же из кэша
+                _, new_code, error = await self._agenerate_diagram(title, full_text, token, use_cache=attempt == 1)
+            if error is None:
+                result, render_error, failed_code = await arender(title, new_code)
+                if render_error is None:
+                    self._record_diagram(title, attempt, started, True)
+                    return title, result, None
+                # Номера строк в ошибке относятся к коду, ушедшему в рендерер, а не к ответу модели целиком
+                code = failed_code or new_code
+                error = render_error
+            else:
+                # Исправить не удалось — следующая попытка генерирует диаграмму заново
+                code = None
+            logger.info(f"Diagram {title} attempt {attempt}/{attempts} failed: {error}")
+        self._record_diagram(title, attempts, started, False)
+        return title, None, error
+
+    async def _arun_concurrently(self, diagram_types: list[str], atask):
+        titles = [title for title in self.diagram_agents if title in diagram_types]
+        semaphore = asyncio.Semaphore(max(1, self.diagram_concurrency))
+
+        async def limited(title):
+            async with semaphore:
+                return await atask(title)
+
+        for future in asyncio.as_completed([limited(title) for title in titles]):
+            yield await future
+
+    async def aiter_rendered_diagrams(self, full_text: str, token: str, diagram_types: list[str], arender,
+                                      attempts: int = 4):
+        """
+        Для каждой диаграммы независимо выполняет цепочку «генерация → arender(title, code) → исправление»
+        (не более diagram_concurrency одновременно), не дожидаясь остальных: рендер одной диаграммы
+        идёт параллельно с генерацией других. Отдаёт (title, результат arender, error) по мере готовности.
+        """
+        async for item in self._arun_concurrently(
+                diagram_types, lambda title: self._agenerate_and_render(title, full_text, token, arender, attempts)):
+            yield item
+
+    def diagrams_key(self, full_text: str, diagram_types: list[str], kind: str = "diagrams", *options) -> str:
+        """Ключ одинаковых запросов диаграмм; options — параметры, от которых зависит результат."""
+        titles = [title for title in self.diagram_agents if title in diagram_types]
+        return request_key(kind, full_text, *options, *titles)
+
+    async def arender_all_diagrams(self, full_text: str, token: str, diagram_types: list[str], arender,
+                                   attempts: int = 4) -> tuple[dict, dict]:
+        """
+        Собирает результаты aiter_rendered_diagrams() в (результаты рендера в порядке diagram_agents, ошибки).
+        Одновременные одинаковые запросы разделяют одну генерацию и один рендер.
+        """
+        # Рендерер — объект в памяти процесса: разные функции рендера не должны делить один результат
+        renderer = f"{getattr(arender, '__qualname__', type(arender).__name__)}@{id(arender)}"
+        key = self.diagrams_key(full_text, diagram_types, "rendered", attempts, self.diagram_repair, renderer)
+        return await diagram_flight.ado(key, self._arender_all_diagrams, full_text, token, diagram_types, arender,
+                                        attempts)
+
+    async def _arender_all_diagrams(self, full_text: str, token: str, diagram_types: list[str], arender,
+                                    attempts: int) -> tuple[dict, dict]:
         outputs = {}
-        for title, agent in self.diagram_agents.items():
-            if title in diagram_types:
-                outputs[title] = agent.generate(full_text, token)
-        return outputs
+        errors = {}
+        async for title, result, error in self.aiter_rendered_diagrams(
+                full_text, token, diagram_types, arender, attempts=attempts):
+            if error is None:
+                outputs[title] = result
+            else:
+                errors[title] = error
+        # Порядок ответа не зависит от того, какая диаграмма была готова первой
+        outputs = {title: outputs[title] for title in self.diagram_agents if title in outputs}
+        return outputs, errors
+
+    async def agenerate_all_diagrams(self, full_text: str, token: str, diagram_types: list[str]) -> tuple[dict, dict]:
+        return await diagram_flight.ado(self.diagrams_key(full_text, diagram_types),
+                                        self._agenerate_all_diagrams, full_text, token, diagram_types)
+
+    async def _agenerate_all_diagrams(self, full_text: str, token: str, diagram_types: list[str]) -> tuple[dict, dict]:
+        outputs = {}
+        errors = {}
+        async for title, code, error in self._arun_concurrently(
+                diagram_types, lambda title: self._agenerate_diagram(title, full_text, token)):
+            if error is None:
+                outputs[title] = code
+            else:
+                errors[title] = error
+        return outputs, errors
+
+    def generate_all_diagrams(self, full_text: str, token: str, diagram_types: list[str]) -> tuple[dict, dict]:
+        """Синхронная обёртка над agenerate_all_diagrams() для запуска вне event loop (CLI)."""
+        return asyncio.run(self.agenerate_all_diagrams(full_text, token, diagram_types))
+
+
+async def abuild_pipeline(**kwargs) -> TzPipeline:
+    """
+    Собирает TzPipeline на моделях общего реестра. Сборка дешёвая: тяжёлые части
+    (эмбеддинги, индекс рекомендаций) загружаются только при первой критике, см. TzPipeline.acritic().
+    """
+    return TzPipeline(llm_callable=call_gigachat, **kwargs)
 
 
 # === CLI-запуск ===
@@ -497,19 +892,13 @@ if __name__ == "__main__":
     client_id = ""
     client_secret = ""
 
-    # Получение токена
-    token = get_access_token(client_id, client_secret)
-
-    basic_creds = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-
-    # 2) (Опционально) Через переменную окружения
-    os.environ["GIGACHAT_CREDENTIALS"] = basic_creds
+    # Получение токена (кэшируется и обновляется общим провайдером)
+    token_provider = get_token_provider(client_id, client_secret)
+    token = token_provider.get_token()
 
     # 3) Инициализируем LLM и эмбеддинги
-    llm = GigaChat(
-        # либо просто GigaChat(), если задали GIGACHAT_CREDENTIALS
-        credentials=basic_creds,
-        auth_url="https://ngw.devices.sberbank.ru:9443/api/v2/oauth",
+    llm = SharedTokenGigaChat(
+        token_provider=token_provider,
         base_url="https://gigachat.devices.sberbank.ru/api/v1",
         scope="GIGACHAT_API_PERS",
         verify_ssl_certs=False,
@@ -551,7 +940,7 @@ if __name__ == "__main__":
         print(f"\n=== {key.upper()} ===\n{value}\n")
 
     print("\n📊 Генерация всех диаграмм по техническому заданию…")
-    all_diags = pipeline.generate_all_diagrams(token)
+    all_diags, _ = pipeline.generate_all_diagrams(pipeline.get_full_text(), token, list(pipeline.diagram_agents))
     for title, code in all_diags.items():
         print(f"\n🔧 {title} диаграмма:\n")
         print("```mermaid")